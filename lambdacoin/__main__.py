@@ -0,0 +1,5 @@
+import sys
+
+from lambdacoin.cli import main
+
+sys.exit(main())
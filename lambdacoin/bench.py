@@ -0,0 +1,436 @@
+"""
+Benchmarks
+
+Run with `python -m lambdacoin.bench`. Results are written as JSON, one entry
+per measurement:
+
+    {"block_verify": {"value": 512345.6, "unit": "nonces/s",
+                      "higher_is_better": true}, ...}
+
+Pass `--baseline` with a previous output to compare against it. The exit
+status is 1 if any measurement regressed by more than `--tolerance`.
+"""
+
+import argparse
+import json
+import logging
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Callable, Dict, List
+
+from lambdacoin.broadcast import (
+    LocalBroadcastNode, TCPBroadcastNode, TCPBroadcastServer)
+import lambdacoin.constants as constants
+from lambdacoin.core import Block, Client, Transaction
+from lambdacoin.utils import generate_hash
+from lambdacoin.verify import SignatureVerifier
+import lambdacoin.wire as wire
+
+# Minimum seconds to spend on each rate measurement
+MIN_TIME = 0.5
+
+
+def measure_rate(func: Callable[[], int], min_time: float = MIN_TIME) -> float:
+    """
+    Calls `func` repeatedly for at least `min_time` seconds and returns the
+    number of operations per second. `func` returns how many operations it
+    did.
+    """
+    operations = 0
+    started = time.perf_counter()
+    while True:
+        operations += func()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time:
+            return operations / elapsed
+
+
+def result(value: float, unit: str, higher_is_better: bool = True,
+           **extra) -> dict:
+    doc = {'value': value, 'unit': unit, 'higher_is_better': higher_is_better}
+    doc.update(extra)
+    return doc
+
+
+def _signed_transactions(count: int, key=None) -> List[Transaction]:
+    key = key or Client().key
+    transactions = []
+    for i in range(count):
+        transaction = Transaction(outputs={'address{}'.format(i): 1})
+        transaction.sign(key)
+        transactions.append(transaction)
+    return transactions
+
+
+def bench_block_verify(transactions: int = 1000) -> Dict[str, dict]:
+    """Nonces/second through Block.verify, for a small and a large block"""
+    results = {}
+    for size in (1, transactions):
+        block = Block(transactions=[Transaction() for _ in range(size)])
+        block.verify('0')
+        nonces = iter(range(10 ** 12))
+
+        def verify_batch():
+            for _ in range(1000):
+                block.verify(str(next(nonces)))
+            return 1000
+
+        results['block_verify_{}tx'.format(size)] = result(
+            measure_rate(verify_batch), 'nonces/s')
+    return results
+
+
+def bench_transactions() -> Dict[str, dict]:
+    """Transaction.verify and Transaction.from_dict per second"""
+    transactions = _signed_transactions(100)
+    docs = [json.loads(t.to_json()) for t in transactions]
+
+    def verify_all():
+        for transaction in transactions:
+            transaction.verify()
+        return len(transactions)
+
+    def from_dict_all():
+        for doc in docs:
+            Transaction.from_dict(doc)
+        return len(docs)
+
+    return {
+        'transaction_verify': result(measure_rate(verify_all), 'ops/s'),
+        'transaction_from_dict': result(measure_rate(from_dict_all), 'ops/s'),
+    }
+
+
+def bench_verify_workers(transactions: int = 2000,
+                         workers=(1, 2, 4)) -> Dict[str, dict]:
+    """
+    Signatures/second through SignatureVerifier.verify_many, inline and with
+    worker processes, without the results cache
+    """
+    to_verify = _signed_transactions(transactions)
+    results = {}
+    for count in workers:
+        verifier = SignatureVerifier(workers=count, cache_size=0)
+        try:
+            # Starts the worker processes outside the measurement
+            verifier.verify_many(to_verify[:count])
+
+            def verify_batch():
+                assert all(verifier.verify_many(to_verify))
+                return len(to_verify)
+
+            results['verify_{}workers'.format(count)] = result(
+                measure_rate(verify_batch), 'signatures/s', workers=count)
+        finally:
+            verifier.close()
+    return results
+
+
+def bench_balances(lengths=(10, 100, 1000),
+                   addresses: int = 100) -> Dict[str, dict]:
+    """value_for_address and total_value as the chain grows"""
+    results = {}
+    for length in lengths:
+        client = Client()
+        for i in range(length):
+            client.blockchain.append(Block(
+                transactions=[Transaction(outputs={'address{}'.format(i): 1})],
+                gen_transaction=Transaction(outputs={'miner': 1})))
+        query = ['address{}'.format(i) for i in range(addresses)]
+
+        # The first query replays the chain into the UTXO index
+        started = time.perf_counter()
+        client.blockchain.value_for_address('miner')
+        first = time.perf_counter() - started
+
+        def value_for_address():
+            client.blockchain.value_for_address('miner')
+            return 1
+
+        def total_value():
+            client.total_value(query)
+            return 1
+
+        results['value_for_address_{}blocks'.format(length)] = result(
+            measure_rate(value_for_address, MIN_TIME / 5), 'ops/s')
+        results['total_value_{}blocks'.format(length)] = result(
+            measure_rate(total_value, MIN_TIME / 5), 'ops/s',
+            addresses=addresses)
+        results['first_balance_{}blocks'.format(length)] = result(
+            first, 's', higher_is_better=False)
+    return results
+
+
+def bench_add_transaction(sizes=(100, 1000, 10000)) -> Dict[str, dict]:
+    """Transactions/second added to a block of growing size"""
+    results = {}
+    for size in sizes:
+        transactions = [Transaction() for _ in range(size)]
+
+        def fill_block():
+            block = Block()
+            # Mining keeps the hash state around as transactions arrive
+            block.midstate()
+            for transaction in transactions:
+                block.add_transaction(transaction)
+            return size
+
+        results['add_transaction_{}tx'.format(size)] = result(
+            measure_rate(fill_block), 'ops/s')
+    return results
+
+
+def bench_receive(clients: int = 5, transactions: int = 200,
+                  relay_mode: str = constants.RELAY_FLOOD) -> Dict[str, dict]:
+    """
+    End to end transactions/second through receive_broadcast across fully
+    connected clients, measured until every client has every transaction.
+    Transactions are signed and packaged before the clock starts, so only
+    their delivery is timed.
+    """
+    network = [Client(name='client{}'.format(i), relay_mode=relay_mode)
+               for i in range(clients)]
+    for client in network:
+        for other in network:
+            if other is not client:
+                client.register_broadcast_node(LocalBroadcastNode(other))
+
+    sender = network[0]
+    docs = []
+    for transaction in _signed_transactions(transactions, sender.key):
+        # Kept to serve the clients that ask for it in inventory mode
+        sender.accept_transaction(transaction)
+        docs.append(sender.package_for_broadcast(
+            constants.B_TYPE_TRANSACTION, transaction.to_dict()))
+
+    started = time.perf_counter()
+    for doc in docs:
+        sender.relay(doc)
+    elapsed = time.perf_counter() - started
+
+    assert all(len(c.mempool) == transactions for c in network)
+    return {
+        'receive_{}_{}clients'.format(relay_mode, clients): result(
+            transactions / elapsed, 'tx/s', clients=clients,
+            duplicates=sum(c.duplicates for c in network)),
+    }
+
+
+def bench_ingest(transactions: int = 2000) -> Dict[str, dict]:
+    """
+    Transactions/second from a backlog of broadcasts, handed to
+    receive_broadcast one at a time and to receive_broadcasts in bulk, with
+    the time spent in each stage of the bulk pipeline
+    """
+    sender = Client()
+    messages = [wire.encode(sender.package_for_broadcast(
+        constants.B_TYPE_TRANSACTION, t.to_dict()), constants.FORMAT_BINARY)
+        for t in _signed_transactions(transactions, sender.key)]
+
+    client = Client()
+    started = time.perf_counter()
+    for data in messages:
+        client.receive_broadcast(data)
+    single = time.perf_counter() - started
+
+    client = Client()
+    started = time.perf_counter()
+    client.receive_broadcasts(messages)
+    bulk = time.perf_counter() - started
+    assert len(client.mempool) == transactions
+
+    stages = {stage: stats['seconds']
+              for stage, stats in client.ingest_stats().items()}
+    return {
+        'ingest_single': result(transactions / single, 'tx/s'),
+        'ingest_bulk': result(transactions / bulk, 'tx/s',
+                              stage_seconds=stages),
+    }
+
+
+def bench_memory(transactions: int = 100000,
+                 block_size: int = 1000) -> Dict[str, dict]:
+    """
+    Memory held by transactions decoded from JSON, as a node holds them in
+    its mempool, and by the blocks they're confirmed in, scaled to 1M
+    transactions. Allocations are counted with tracemalloc.
+    """
+    sender = Client()
+    signed = _signed_transactions(1, sender.key)[0]
+    docs = []
+    for _ in range(transactions):
+        doc = signed.to_dict()
+        doc['hash'] = generate_hash()
+        doc['inputs'] = [{'hash': generate_hash(), 'n': 0}]
+        doc['outputs'] = {generate_hash(): 5, sender.generate_address(): 1}
+        docs.append(json.dumps(doc))
+
+    tracemalloc.start()
+    try:
+        start = tracemalloc.get_traced_memory()[0]
+        decoded = [Transaction.from_dict(json.loads(d)) for d in docs]
+        held = tracemalloc.get_traced_memory()[0]
+
+        blocks = [Block(transactions=decoded[i:i + block_size])
+                  for i in range(0, transactions, block_size)]
+        for block in blocks:
+            block.midstate()  # Builds the Merkle tree, as verifying does
+        end = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+    scale = 1000000 / transactions / (1024 * 1024)
+    return {
+        'memory_transactions': result((held - start) * scale, 'MB/1M tx',
+                                      higher_is_better=False),
+        'memory_blocks': result((end - held) * scale, 'MB/1M tx',
+                                higher_is_better=False),
+    }
+
+
+class _CountingReceiver(object):
+    """Stands in for a Client, counting the broadcasts it receives"""
+
+    wire_formats = (constants.FORMAT_BINARY, constants.FORMAT_JSON)
+
+    def __init__(self):
+        self.received = 0
+
+    def receive_broadcast(self, data):
+        self.received += 1
+
+
+def bench_tcp(messages: int = 100000, size: int = 250) -> Dict[str, dict]:
+    """
+    Measures messages/second from a TCPBroadcastNode to a TCPBroadcastServer
+    over loopback, including the handoff to the receiving thread
+
+    :param size: Size of each message in bytes. The default is about the size
+        of a transaction in the binary wire format.
+    """
+    receiver = _CountingReceiver()
+    server = TCPBroadcastServer(receiver, max_queue=messages).start()
+    node = TCPBroadcastNode(*server.address, max_queue=messages)
+    data = b'x' * size
+
+    def receive(count):
+        while receiver.received < count:
+            server.process(0.1)
+
+    try:
+        # Connect before timing
+        node.broadcast(data)
+        receive(1)
+
+        started = time.perf_counter()
+        for _ in range(messages):
+            node.broadcast(data)
+        receive(1 + messages)
+        elapsed = time.perf_counter() - started
+    finally:
+        node.close()
+        server.close()
+
+    return {
+        'tcp_loopback': result(
+            messages / elapsed, 'messages/s', message_bytes=size,
+            batches=node.batches - 1),
+    }
+
+
+BENCHMARKS = {
+    'block_verify': bench_block_verify,
+    'transactions': bench_transactions,
+    'verify_workers': bench_verify_workers,
+    'balances': bench_balances,
+    'add_transaction': bench_add_transaction,
+    'receive': bench_receive,
+    'ingest': bench_ingest,
+    'memory': bench_memory,
+    'tcp': bench_tcp,
+}
+
+
+def run(names: List[str] = None) -> Dict[str, dict]:
+    """Runs the named benchmarks, or all of them"""
+    # Debug logging in the hot paths would swamp the measurements
+    lambdacoin_logger = logging.getLogger('lambdacoin')
+    level = lambdacoin_logger.level
+    lambdacoin_logger.setLevel(logging.WARNING)
+
+    results = {}
+    try:
+        for name in names or BENCHMARKS:
+            results.update(BENCHMARKS[name]())
+    finally:
+        lambdacoin_logger.setLevel(level)
+    return results
+
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict],
+            tolerance: float = 0.2) -> List[dict]:
+    """
+    Returns the measurements that are worse than the baseline by more than
+    `tolerance`, as a fraction of the baseline value
+    """
+    regressions = []
+    for name, current in sorted(results.items()):
+        previous = baseline.get(name)
+        if previous is None or not previous['value']:
+            continue
+
+        change = (current['value'] - previous['value']) / previous['value']
+        if not current.get('higher_is_better', True):
+            change = -change
+
+        if change < -tolerance:
+            regressions.append({
+                'name': name,
+                'baseline': previous['value'],
+                'value': current['value'],
+                'change': change,
+            })
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m lambdacoin.bench', description='Run benchmarks')
+    parser.add_argument('benchmarks', nargs='*',
+                        help='Benchmarks to run, out of {}. Defaults to all '
+                             'of them.'.format(', '.join(BENCHMARKS)))
+    parser.add_argument('--output', help='File to write results to')
+    parser.add_argument('--baseline', help='Results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed slowdown as a fraction of the baseline')
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        parser.error('Unknown benchmarks: {}'.format(', '.join(unknown)))
+
+    results = run(args.benchmarks)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print('REGRESSION {name}: {baseline:.6g} -> {value:.6g} '
+                  '({change:+.1%})'.format(**regression), file=sys.stderr)
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
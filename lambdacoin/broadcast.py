@@ -1,9 +1,76 @@
+import asyncio
+import concurrent.futures
+import logging
+import queue
+import socket
+import struct
+import threading
+import time
+from collections import namedtuple
+
+import lambdacoin.constants as constants
+
+logger = logging.getLogger('lambdacoin')
+
+# Number of messages waiting for a remote node before new ones are dropped
+DEFAULT_QUEUE_SIZE = 1000
+
+# TCP frames: payload length, payload kind
+FRAME_HEADER = struct.Struct('>IB')
+FRAME_TEXT = 0
+FRAME_BYTES = 1
+FRAME_HELLO = 2
+
+# Most bytes of queued messages to coalesce into one write
+MAX_BATCH_BYTES = 256 * 1024
+
+# Seconds to wait between reconnection attempts, doubling up to the maximum
+MIN_BACKOFF = 0.1
+MAX_BACKOFF = 5.0
+
+RECV_SIZE = 65536
+
+# Least seconds between warnings that a server's client can't keep up
+FULL_WARNING_INTERVAL = 10.0
+
+
 class BroadcastNode(object):
     """Abstract class to implement remote nodes to broadcast data to"""
 
+    # Wire format agreed with the remote node by `negotiate`
+    wire_format = constants.FORMAT_JSON
+
+    # Node ID of the client on the other end, used to route replies
+    peer_id = None
+
     def broadcast(self, data):
         raise NotImplementedError()
 
+    def formats(self) -> tuple:
+        """Wire formats the remote node accepts"""
+        return (constants.FORMAT_JSON,)
+
+    def negotiate(self, formats) -> str:
+        """
+        Picks the first of the given formats, in order of preference, that
+        the remote node also accepts. Falls back to JSON.
+        """
+        accepted = self.formats()
+        for wire_format in formats:
+            if wire_format in accepted:
+                self.wire_format = wire_format
+                break
+        else:
+            self.wire_format = constants.FORMAT_JSON
+
+        return self.wire_format
+
+    def close(self):
+        """Stops sending. Nothing to do for nodes without a connection."""
+
+    async def wait_closed(self):
+        """Waits until `close` has finished, for nodes that stop in a task"""
+
 
 class LocalBroadcastNode(BroadcastNode):
     """
@@ -14,5 +81,532 @@ class LocalBroadcastNode(BroadcastNode):
     def __init__(self, client):
         self.client = client
 
+    @property
+    def peer_id(self):
+        return self.client.node_id
+
     def broadcast(self, data):
         self.client.receive_broadcast(data)
+
+    def formats(self) -> tuple:
+        return self.client.wire_formats
+
+
+class AsyncBroadcastNode(BroadcastNode):
+    """
+    Abstract broadcast node that sends from its own asyncio task
+
+    `broadcast` only puts the data on a bounded queue, so the sender never
+    waits for the remote node and a slow node can't hold up the others. When
+    the queue is full, `broadcast` drops the data and counts it, while the
+    coroutine `send` waits for room instead.
+
+    Must be used from within a running event loop. Subclasses implement
+    `deliver`.
+    """
+
+    def __init__(self, max_queue: int = DEFAULT_QUEUE_SIZE):
+        self.max_queue = max_queue
+        self._queue = None
+        self._task = None
+
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+
+    @property
+    def queue(self) -> asyncio.Queue:
+        # Created on first use so it belongs to the running loop
+        if self._queue is None:
+            self._queue = asyncio.Queue(self.max_queue)
+        return self._queue
+
+    def broadcast(self, data) -> bool:
+        self.start()
+        try:
+            self.queue.put_nowait(data)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return False
+        return True
+
+    async def send(self, data):
+        """Queues data, waiting for room if the queue is full"""
+        self.start()
+        await self.queue.put(data)
+
+    async def deliver(self, data):
+        raise NotImplementedError()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def drain(self):
+        """Waits until everything queued so far has been delivered"""
+        await self.queue.join()
+
+    def close(self):
+        """Stops the sending task. Await `wait_closed` for it to finish."""
+        if self._task is not None:
+            self._task.cancel()
+
+    async def wait_closed(self):
+        if self._task is not None:
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        queue = self.queue
+        while True:
+            data = await queue.get()
+            try:
+                await self.deliver(data)
+                self.sent += 1
+            except Exception:
+                self.failed += 1
+                logger.exception('Could not deliver broadcast')
+            finally:
+                queue.task_done()
+
+
+class AsyncLocalBroadcastNode(AsyncBroadcastNode):
+    """
+    Asyncio broadcast node for clients within a single Python application.
+    Delivers into the client's inbox, which `Client.receive_loop` processes.
+    """
+
+    def __init__(self, client, max_queue: int = DEFAULT_QUEUE_SIZE):
+        super().__init__(max_queue)
+        self.client = client
+
+    @property
+    def peer_id(self):
+        return self.client.node_id
+
+    async def deliver(self, data):
+        await self.client.inbox.put(data)
+
+    def formats(self) -> tuple:
+        return self.client.wire_formats
+
+
+# Handshake sent each way when a TCPBroadcastNode connects, with the wire
+# formats that side accepts, most preferred first
+Hello = namedtuple('Hello', ['formats'])
+
+
+def pack_frame(data) -> bytes:
+    """Frames a message as length | kind | payload"""
+    if isinstance(data, str):
+        payload = data.encode(constants.STRING_ENCODING)
+        kind = FRAME_TEXT
+    elif isinstance(data, Hello):
+        payload = ','.join(data.formats).encode(constants.STRING_ENCODING)
+        kind = FRAME_HELLO
+    else:
+        payload = bytes(data)
+        kind = FRAME_BYTES
+    return FRAME_HEADER.pack(len(payload), kind) + payload
+
+
+def read_frames(buffer: bytearray) -> list:
+    """
+    Takes every complete frame off the front of the buffer. Returns the
+    messages, as str for text frames, Hello for handshakes and bytes
+    otherwise.
+    """
+    messages = []
+    offset = 0
+    while len(buffer) - offset >= FRAME_HEADER.size:
+        length, kind = FRAME_HEADER.unpack_from(buffer, offset)
+        end = offset + FRAME_HEADER.size + length
+        if len(buffer) < end:
+            break
+
+        payload = bytes(buffer[offset + FRAME_HEADER.size:end])
+        if kind == FRAME_TEXT:
+            messages.append(payload.decode(constants.STRING_ENCODING))
+        elif kind == FRAME_HELLO:
+            formats = payload.decode(constants.STRING_ENCODING)
+            messages.append(Hello(tuple(formats.split(',')) if formats
+                                  else ()))
+        else:
+            messages.append(payload)
+        offset = end
+
+    del buffer[:offset]
+    return messages
+
+
+class TCPBroadcastNode(BroadcastNode):
+    """
+    Broadcast node that sends to a remote TCPBroadcastServer over one
+    persistent connection
+
+    `broadcast` queues the data and returns. A sender thread takes everything
+    waiting in the queue, up to `max_batch_bytes`, and sends it in one write.
+    If the connection drops, the thread reconnects with exponential backoff
+    and resends the batch that failed.
+
+    Each connection starts with a handshake. The node sends the formats its
+    client accepts, and the server replies with the formats its own client
+    accepts. The wire format is picked from the reply, so it's JSON until
+    the first connection is made.
+    """
+
+    def __init__(self, host: str, port: int, peer_id: str = None,
+                 max_queue: int = DEFAULT_QUEUE_SIZE,
+                 max_batch_bytes: int = MAX_BATCH_BYTES,
+                 connect_timeout: float = 5.0,
+                 min_backoff: float = MIN_BACKOFF,
+                 max_backoff: float = MAX_BACKOFF):
+        """
+        :param peer_id: Node ID of the client behind the server
+        """
+        self.address = (host, port)
+        self.peer_id = peer_id
+        # Formats this side prefers, given to `negotiate`, and those the
+        # server accepts, from its handshake
+        self._preferred = (constants.FORMAT_JSON,)
+        self._formats = (constants.FORMAT_JSON,)
+        self.max_batch_bytes = max_batch_bytes
+        self.connect_timeout = connect_timeout
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+
+        self._queue = queue.Queue(max_queue)
+        self._socket = None
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._started = False
+        self._start_lock = threading.Lock()
+
+        self.sent = 0
+        self.batches = 0
+        self.dropped = 0
+        self.reconnects = 0
+
+    def formats(self) -> tuple:
+        return self._formats
+
+    def negotiate(self, formats) -> str:
+        """
+        Remembers the formats to offer in the handshake. Until a server has
+        replied, only JSON is known to be accepted.
+        """
+        self._preferred = tuple(formats)
+        return super().negotiate(formats)
+
+    def broadcast(self, data) -> bool:
+        self.start()
+        try:
+            self._queue.put_nowait(data)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def start(self):
+        with self._start_lock:
+            if not self._started:
+                self._started = True
+                self._thread.start()
+
+    def flush(self, timeout: float = None) -> bool:
+        """
+        Waits until everything queued so far has been sent. Returns False if
+        the timeout ran out first.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                self._queue.all_tasks_done.wait(remaining)
+        return True
+
+    def close(self, timeout: float = 5.0):
+        """Sends whatever is queued, then closes the connection"""
+        if self._started:
+            self.flush(timeout)
+        self._closed.set()
+        if self._started:
+            self._thread.join(timeout)
+        self._disconnect()
+
+    def _connect(self):
+        backoff = self.min_backoff
+        while not self._closed.is_set():
+            sock = None
+            try:
+                sock = socket.create_connection(self.address,
+                                                self.connect_timeout)
+                self._handshake(sock)
+            except OSError as e:
+                if sock is not None:
+                    sock.close()
+                logger.warning('Could not connect to %s:%s (%s). Retrying in '
+                               '%.1fs', *self.address, e, backoff)
+                self._closed.wait(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+
+            sock.settimeout(None)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._socket = sock
+            return
+
+    def _handshake(self, sock: socket.socket):
+        """Exchanges Hellos with the server and picks the wire format"""
+        sock.sendall(pack_frame(Hello(self._preferred)))
+
+        buffer = bytearray()
+        frames = []
+        while not frames:
+            chunk = sock.recv(RECV_SIZE)
+            if not chunk:
+                raise ConnectionError('Closed during the handshake')
+            buffer += chunk
+            frames = read_frames(buffer)
+        if not isinstance(frames[0], Hello):
+            raise ConnectionError('Expected a handshake')
+
+        self._formats = frames[0].formats
+        wire_format = BroadcastNode.negotiate(self, self._preferred)
+        logger.debug('Sending %s to %s:%s', wire_format, *self.address)
+
+    def _disconnect(self):
+        if self._socket is not None:
+            try:
+                self._socket.close()
+            except OSError:
+                pass
+            self._socket = None
+
+    def _next_batch(self) -> list:
+        """Waits for a message, then takes whatever else is already queued"""
+        while not self._closed.is_set():
+            try:
+                batch = [self._queue.get(timeout=0.1)]
+                break
+            except queue.Empty:
+                continue
+        else:
+            return []
+
+        size = len(batch[0])
+        while size < self.max_batch_bytes:
+            try:
+                data = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(data)
+            size += len(data)
+        return batch
+
+    def _run(self):
+        while not self._closed.is_set():
+            batch = self._next_batch()
+            if not batch:
+                continue
+
+            frames = b''.join(pack_frame(data) for data in batch)
+            while not self._closed.is_set():
+                if self._socket is None:
+                    self._connect()
+                    if self._socket is None:
+                        break
+                try:
+                    self._socket.sendall(frames)
+                except OSError as e:
+                    logger.warning('Lost connection to %s:%s (%s)',
+                                   *self.address, e)
+                    self._disconnect()
+                    self.reconnects += 1
+                    continue
+
+                self.sent += len(batch)
+                self.batches += 1
+                break
+
+            for _ in batch:
+                self._queue.task_done()
+
+
+class TCPBroadcastServer(object):
+    """
+    Accepts connections from TCPBroadcastNodes and passes every message they
+    send to `client.receive_broadcast`
+
+    Messages are read on the server's threads but never handed to the client
+    there, since the client's owner may be using it at the same time. With an
+    event loop, they go into `client.inbox` from the loop's thread, for
+    `Client.receive_loop`. Otherwise they wait until the owner calls
+    `process` from its own thread. Either way, a connection stops being read
+    while there's no room for its next message, so senders are held back
+    rather than messages dropped.
+    """
+
+    def __init__(self, client, host: str = '127.0.0.1', port: int = 0,
+                 loop: asyncio.AbstractEventLoop = None,
+                 max_queue: int = DEFAULT_QUEUE_SIZE):
+        """
+        :param port: Port to listen on. 0 picks a free port, see `address`.
+        :param loop: Event loop running the client's `receive_loop`. Its
+            `client.inbox` is the queue connections wait on.
+        :param max_queue: Most messages waiting for `process`. Connections
+            stop being read while it's full.
+        """
+        self.client = client
+        self.loop = loop
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind((host, port))
+        self._listener.listen()
+        self._listener.settimeout(0.1)
+        self._inbox = queue.Queue(max_queue)
+        self._closed = threading.Event()
+        self._threads = []
+        self._connections = []
+
+        self._last_full_warning = None
+
+        self.received = 0
+        # Number of messages that had to wait for room
+        self.stalled = 0
+
+    @property
+    def address(self):
+        return self._listener.getsockname()[:2]
+
+    def start(self):
+        thread = threading.Thread(target=self._accept_loop, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+        return self
+
+    def close(self):
+        self._closed.set()
+        for thread in self._threads:
+            thread.join()
+        self._listener.close()
+        for connection in self._connections:
+            connection.close()
+
+    def process(self, timeout: float = 0.0) -> int:
+        """
+        Passes the messages waiting so far to the client, from the calling
+        thread. Waits up to `timeout` seconds for the first one. Returns how
+        many were passed on.
+        """
+        processed = 0
+        try:
+            data = self._inbox.get(timeout=timeout) if timeout > 0 \
+                else self._inbox.get_nowait()
+            while True:
+                processed += 1
+                try:
+                    self.client.receive_broadcast(data)
+                except Exception:
+                    logger.exception('Could not process a broadcast')
+                data = self._inbox.get_nowait()
+        except queue.Empty:
+            return processed
+
+    def _accept_loop(self):
+        while not self._closed.is_set():
+            try:
+                connection, _ = self._listener.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+
+            connection.settimeout(0.1)
+            self._connections.append(connection)
+            thread = threading.Thread(target=self._read_loop,
+                                      args=(connection,), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _read_loop(self, connection):
+        buffer = bytearray()
+        while not self._closed.is_set():
+            try:
+                chunk = connection.recv(RECV_SIZE)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            if not chunk:
+                break
+
+            buffer += chunk
+            for data in read_frames(buffer):
+                if isinstance(data, Hello):
+                    self._reply_hello(connection)
+                    continue
+                self.received += 1
+                self._hand_off(data)
+
+        connection.close()
+
+    def _reply_hello(self, connection):
+        """Tells a connecting node which wire formats the client accepts"""
+        try:
+            connection.sendall(pack_frame(Hello(self.client.wire_formats)))
+        except OSError as e:
+            logger.warning('Could not reply to a handshake (%s)', e)
+
+    def _hand_off(self, data):
+        """
+        Passes a message on, blocking the connection's thread until there's
+        room for it or the server closes
+        """
+        if self.loop is not None:
+            future = asyncio.run_coroutine_threadsafe(
+                self._put_in_inbox(data), self.loop)
+            while not self._closed.is_set():
+                try:
+                    future.result(timeout=0.1)
+                    return
+                except concurrent.futures.TimeoutError:
+                    continue
+            future.cancel()
+            return
+
+        try:
+            self._inbox.put_nowait(data)
+            return
+        except queue.Full:
+            self._full()
+        while not self._closed.is_set():
+            try:
+                self._inbox.put(data, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    async def _put_in_inbox(self, data):
+        """Puts a message in the client's inbox, from the loop's thread"""
+        inbox = self.client.inbox
+        if inbox.full():
+            self._full()
+        await inbox.put(data)
+
+    def _full(self):
+        """Counts a message waiting for room, warning now and then"""
+        self.stalled += 1
+        now = time.monotonic()
+        if self._last_full_warning is None or \
+                now - self._last_full_warning >= FULL_WARNING_INTERVAL:
+            self._last_full_warning = now
+            logger.warning('Client %s is falling behind. Pausing reads until '
+                           'it catches up.', self.client.name)
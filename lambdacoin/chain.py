@@ -0,0 +1,365 @@
+"""
+Block storage and fork choice
+
+`Blockchain` owns the main chain, the blocks from the Genesis block up to the
+best tip. The blocks themselves are kept by a store, which indexes them by
+hash and by height so lookups don't have to walk `prev_block` pointers.
+`MemoryBlockStore` keeps everything in memory; `lambdacoin.storage.BlockStore`
+keeps blocks on disk and loads them on access.
+
+Blocks that build on something other than the tip are kept in memory as side
+blocks, forming a tree with the main chain. The tip is the block with the most
+cumulative work. Every block's work is 16 ** the chain's target, the expected
+number of nonces it takes to solve a block. The target a block claims comes
+from whoever sent it, so it's only checked against the chain's: blocks below
+it are rejected, and those above it count no more. When a side branch gets
+more work than the main chain, the blocks above the fork point are
+disconnected, rolling the UTXO index back with the undo records saved when
+they were applied, and the branch is connected in their place. A reorg
+touches only the blocks above the fork point, however long the chain is.
+
+Blocks whose parent isn't known yet are held as orphans until it arrives.
+"""
+
+from collections import OrderedDict
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import lambdacoin.constants as constants
+from lambdacoin.exceptions import SnapshotError
+from lambdacoin.utxo import UTXOSet
+
+# Number of blocks below the tip to keep undo records for. Deeper reorgs
+# rebuild the UTXO index from scratch.
+UNDO_DEPTH = 100
+
+# Most blocks to hold while waiting for their parent
+MAX_ORPHANS = 100
+
+
+def block_work(target: int) -> int:
+    """Expected number of nonces tried to solve a block with `target`"""
+    return 16 ** target
+
+
+class MemoryBlockStore(object):
+    def __init__(self):
+        self.blocks = {}  # {hash: Block}
+        self.heights = {}  # {hash: height}
+        self._by_height = []  # [Block], indexed by height
+
+    def __len__(self):
+        return len(self._by_height)
+
+    def __contains__(self, block_hash: str) -> bool:
+        return block_hash in self.blocks
+
+    def get(self, block_hash: str) -> Optional['Block']:
+        return self.blocks.get(block_hash)
+
+    def height_of(self, block_hash: str) -> Optional[int]:
+        return self.heights.get(block_hash)
+
+    def block_at(self, height: int) -> Optional['Block']:
+        if 0 <= height < len(self._by_height):
+            return self._by_height[height]
+        return None
+
+    def append(self, block: 'Block') -> int:
+        """Stores a block on top of the others. Returns its height."""
+        height = len(self._by_height)
+        self.blocks[block.hash] = block
+        self.heights[block.hash] = height
+        self._by_height.append(block)
+        return height
+
+    def truncate(self, height: int):
+        """Drops the blocks at `height` and above"""
+        for block in self._by_height[height:]:
+            del self.blocks[block.hash]
+            del self.heights[block.hash]
+        del self._by_height[height:]
+
+
+class Blockchain(object):
+    def __init__(self, block: 'Block' = None, store=None,
+                 target: int = constants.BLOCK_TARGET):
+        """
+        :param block: Genesis block of a new chain, or the tip of an existing
+            linked chain of blocks. Not needed when the store already holds a
+            chain.
+        :param store: Where the blocks of the main chain are kept. Defaults
+            to a MemoryBlockStore.
+        :param target: Least target a block needs to be added
+        """
+        self.store = MemoryBlockStore() if store is None else store
+        self.target = target
+        self.block_work = block_work(target)
+
+        # Called with (disconnected blocks, connected blocks) whenever the
+        # main chain changes, e.g. so a client can update its mempool
+        self.on_update = None
+
+        self.side_blocks = {}  # {hash: Block} not in the main chain
+        self.parents = {}  # {hash: parent hash} of the side blocks
+        self.orphans = OrderedDict()  # {hash: Block} with an unknown parent
+        self.tips = set()  # Hashes of blocks without children
+
+        # Cumulative work of blocks, relative to the tip when the chain was
+        # opened. Main chain blocks below it are worked out when needed.
+        self.work = {}  # {hash: work}
+
+        # Undo records of the most recent main chain blocks
+        self.undo = OrderedDict()  # {hash: undo record}
+
+        # (block hash, UTXOSet) from a snapshot of a block that isn't in the
+        # main chain yet, see `use_snapshot`
+        self._snapshot = None
+
+        if len(self.store):
+            self.tip = self.store.block_at(len(self.store) - 1)
+        elif block is not None:
+            chain = block.chain()
+            for b in chain:
+                self.store.append(b)
+            self.tip = chain[-1]
+        else:
+            raise ValueError('A Blockchain needs a block or a non-empty store')
+
+        self.tips.add(self.tip.hash)
+        self.work[self.tip.hash] = 0
+
+    def __len__(self):
+        return len(self.store)
+
+    def __contains__(self, block_hash: str) -> bool:
+        """Whether a block is in the main chain or a side branch"""
+        return block_hash in self.store or block_hash in self.side_blocks
+
+    def __iter__(self) -> Iterator['Block']:
+        return self.iter_range()
+
+    @property
+    def height(self) -> int:
+        """Height of the tip. The Genesis block is at height 0."""
+        return len(self.store) - 1
+
+    @property
+    def genesis(self) -> 'Block':
+        return self.store.block_at(0)
+
+    def get(self, block_hash: str) -> Optional['Block']:
+        """Returns a block in the main chain or a side branch"""
+        if block_hash == self.tip.hash:
+            return self.tip
+        block = self.side_blocks.get(block_hash)
+        if block is None:
+            block = self.store.get(block_hash)
+        return block
+
+    def height_of(self, block_hash: str) -> Optional[int]:
+        """Returns the height of a block in the main chain"""
+        return self.store.height_of(block_hash)
+
+    def block_at(self, height: int) -> Optional['Block']:
+        if height == self.height:
+            return self.tip
+        return self.store.block_at(height)
+
+    def iter_range(self, start: int = 0,
+                   end: int = None) -> Iterator['Block']:
+        """Iterates over the blocks with heights in [start, end)"""
+        if end is None:
+            end = len(self.store)
+        for height in range(max(start, 0), min(end, len(self.store))):
+            yield self.block_at(height)
+
+    def accepts_target(self, block: 'Block') -> bool:
+        """Whether a block's target is at least the chain's"""
+        return isinstance(block.target, int) and block.target >= self.target
+
+    def append(self, block: 'Block') -> bool:
+        """
+        Adds a block to the tree, switching the main chain to its branch if
+        that has the most work. Blocks without a `prev_hash` go on top of the
+        tip, which only suits blocks built locally. Clients reject blocks from
+        the network that don't have one.
+
+        Returns False without changing anything if the block is already known
+        or its target is below the chain's, and False if its parent isn't
+        known, in which case it's kept as an orphan and added once the parent
+        is.
+        """
+        if block.hash in self or block.hash in self.orphans or \
+                not self.accepts_target(block):
+            return False
+
+        parent_hash = self.tip.hash if block.prev_hash is None \
+            else block.prev_hash
+        if parent_hash not in self:
+            self.orphans[block.hash] = block
+            if len(self.orphans) > MAX_ORPHANS:
+                self.orphans.popitem(last=False)
+            return False
+
+        disconnected, connected = [], []
+        self._add(block, parent_hash, disconnected, connected)
+
+        # Orphans waiting for the blocks just added
+        added = [block.hash]
+        while added and self.orphans:
+            parent_hash = added.pop()
+            for orphan in [b for b in self.orphans.values()
+                           if b.prev_hash == parent_hash]:
+                del self.orphans[orphan.hash]
+                self._add(orphan, parent_hash, disconnected, connected)
+                added.append(orphan.hash)
+
+        if connected and self.on_update is not None:
+            self.on_update(disconnected, connected)
+        return True
+
+    def _add(self, block: 'Block', parent_hash: str, disconnected: list,
+             connected: list):
+        """Adds a block whose parent is known"""
+        self.work[block.hash] = self.work_of(parent_hash) + self.block_work
+        self.tips.discard(parent_hash)
+        self.tips.add(block.hash)
+
+        if parent_hash == self.tip.hash:
+            self._connect(block)
+            connected.append(block)
+            return
+
+        self.side_blocks[block.hash] = block
+        self.parents[block.hash] = parent_hash
+        if self.work[block.hash] > self.work_of(self.tip.hash):
+            self._reorg(block, disconnected, connected)
+
+    def work_of(self, block_hash: str) -> Optional[int]:
+        """
+        Returns the cumulative work of a block, relative to the tip when the
+        chain was opened, or None if the block isn't known
+        """
+        work = self.work.get(block_hash)
+        if work is not None:
+            return work
+
+        height = self.store.height_of(block_hash)
+        if height is None:
+            return None
+
+        # Main chain blocks above this one back to one with known work
+        above = 0
+        while True:
+            height += 1
+            block = self.block_at(height)
+            above += self.block_work
+            if block.hash in self.work:
+                work = self.work[block.hash] - above
+                self.work[block_hash] = work
+                return work
+
+    def _connect(self, block: 'Block'):
+        """Adds a block on top of the tip of the main chain"""
+        undo = self.tip.add_next(block)
+        if undo is not None:
+            self.undo[block.hash] = undo
+            if len(self.undo) > UNDO_DEPTH:
+                self.undo.popitem(last=False)
+
+        self.side_blocks.pop(block.hash, None)
+        self.parents.pop(block.hash, None)
+        self.tip = block
+        self.store.append(block)
+
+        if self._snapshot is not None and self._snapshot[0] == block.hash:
+            block.utxos = self._snapshot[1]
+            self._snapshot = None
+
+    def _reorg(self, new_tip: 'Block', disconnected: list, connected: list):
+        """Switches the main chain to the branch ending at `new_tip`"""
+        # Walk back to where the branch leaves the main chain
+        branch = []
+        block = new_tip
+        while self.store.height_of(block.hash) is None:
+            branch.append(block)
+            block = self.get(self.parents[block.hash])
+        fork_height = self.store.height_of(block.hash)
+
+        # Roll the UTXO index back to the fork point, newest block first
+        utxos, self.tip.utxos = self.tip.utxos, None
+        for height in range(self.height, fork_height, -1):
+            old = self.block_at(height)
+            # Known once the block is off the main chain
+            self.work_of(old.hash)
+            undo = self.undo.pop(old.hash, None)
+            if utxos is not None:
+                if undo is None:
+                    # Too deep to undo. Rebuilt when next needed.
+                    utxos = None
+                else:
+                    utxos.undo_block(undo)
+            self.side_blocks[old.hash] = old
+            self.parents[old.hash] = self.block_at(height - 1).hash
+            disconnected.append(old)
+
+        self.store.truncate(fork_height + 1)
+        self.tip = self.store.block_at(fork_height)
+        self.tip.utxos = utxos
+
+        for block in reversed(branch):
+            self._connect(block)
+            connected.append(block)
+
+    def find_transactions(self, hashes: Iterable[str],
+                          depth: int = 100) -> Dict[str, 'Transaction']:
+        """
+        Looks for transactions in the `depth` blocks nearest the tip, where
+        transactions of a recent solution are found
+
+        :return: {hash: Transaction} of the transactions found
+        """
+        wanted = set(hashes)
+        found = {}
+        for height in range(self.height, max(self.height - depth, -1), -1):
+            if not wanted:
+                break
+            for transaction in self.block_at(height).transactions:
+                if transaction.hash in wanted:
+                    wanted.discard(transaction.hash)
+                    found[transaction.hash] = transaction
+        return found
+
+    def use_snapshot(self, info: 'SnapshotInfo', utxos: UTXOSet):
+        """
+        Takes the UTXO index as of a snapshot's block rather than replaying
+        the chain up to it. Blocks above it are applied on top. If the block
+        isn't in the main chain yet, e.g. before a sync, the index is taken
+        once it's connected.
+        """
+        height = self.store.height_of(info.block_hash)
+        if height is None:
+            self._snapshot = (info.block_hash, utxos)
+            return
+        if height != info.height:
+            raise SnapshotError('Snapshot block {} is at height {}, not {}'
+                                .format(info.block_hash, height, info.height))
+
+        for block in self.iter_range(height + 1):
+            utxos.apply_block(block)
+        self.tip.utxos = utxos
+
+    def chain_utxos(self) -> UTXOSet:
+        """
+        Returns the UTXO index of the chain. It's built by replaying every
+        block the first time it's needed, then moves forward with the tip.
+        """
+        if self.tip.utxos is None:
+            self.tip.utxos = UTXOSet.from_blocks(self)
+        return self.tip.utxos
+
+    def value_for_address(self, address: str):
+        return self.chain_utxos().balance(address)
+
+    def total_value(self, addresses: List[str]):
+        return self.chain_utxos().total_value(addresses)
@@ -0,0 +1,277 @@
+"""
+Command line for running a node
+
+    python -m lambdacoin run --listen 127.0.0.1:8333 --peer b@10.0.0.2:8333
+    python -m lambdacoin mine --blocks 10 --processes 4
+    python -m lambdacoin bench ingest memory
+    python -m lambdacoin profile --sample mine --blocks 10
+
+`run` starts a node that receives and relays over TCP. `mine` does the same
+and also mines in the background. Both print a JSON summary of the node when
+they stop, after `--duration` seconds, after `--blocks` blocks for `mine`, or
+on Ctrl-C.
+
+`bench` runs the workloads in `lambdacoin.bench`, taking the same arguments.
+`profile` runs any other command under cProfile, or under the sampling
+profiler with `--sample`, and writes a report of the hottest functions to
+stderr.
+
+Peers are given as HOST:PORT, or NAME@HOST:PORT where NAME is the peer's
+node name. Only named peers are sent replies and synced from.
+
+`--regtest-target N` runs a local test network whose blocks need N leading
+"0"s instead of the consensus target. Every node of the test network has to
+be given the same N, and it can't join the real network.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+from typing import List, Optional, Tuple
+
+from lambdacoin.broadcast import TCPBroadcastNode, TCPBroadcastServer
+import lambdacoin.bench
+from lambdacoin.chain import Blockchain
+import lambdacoin.constants as constants
+from lambdacoin.core import Block, Client
+from lambdacoin.keys import KeyStore
+from lambdacoin.mining import Miner, REFRESH_INTERVAL, ROUND_SIZE
+from lambdacoin.profiling import REPORT_TOP, SAMPLE_INTERVAL, profile_call
+from lambdacoin.storage import BlockStore
+from lambdacoin.utils import configure_logging
+
+logger = logging.getLogger('lambdacoin')
+
+# Subdirectories of --data-dir
+BLOCKS_DIR = 'blocks'
+KEYS_DIR = 'keys'
+
+
+def parse_address(value: str) -> Tuple[str, int]:
+    """Parses HOST:PORT"""
+    host, sep, port = value.rpartition(':')
+    if not sep or not port.isdigit():
+        raise argparse.ArgumentTypeError(
+            'Expected HOST:PORT, got {!r}'.format(value))
+    return host or '127.0.0.1', int(port)
+
+
+def parse_peer(value: str) -> Tuple[Optional[str], str, int]:
+    """Parses [NAME@]HOST:PORT"""
+    name, sep, address = value.rpartition('@')
+    return (name if sep else None,) + parse_address(address)
+
+
+def make_client(args) -> Client:
+    """Builds the node's client from the `run` and `mine` options"""
+    store = None
+    key = None
+    if args.data_dir:
+        store = BlockStore(os.path.join(args.data_dir, BLOCKS_DIR))
+        if args.name:
+            key = KeyStore(os.path.join(args.data_dir, KEYS_DIR)) \
+                .get_or_create(args.name)
+    target = constants.BLOCK_TARGET if args.regtest_target is None \
+        else args.regtest_target
+    blockchain = Blockchain(Block.genesis(), store=store, target=target)
+
+    formats = [args.wire_format] + [f for f in (constants.FORMAT_BINARY,
+                                                constants.FORMAT_JSON)
+                                    if f != args.wire_format]
+    return Client(name=args.name, blockchain=blockchain, key=key,
+                  addresses=[args.address] if args.address else None,
+                  miner=Miner(processes=getattr(args, 'processes', 1)),
+                  wire_formats=formats, relay_mode=args.relay_mode)
+
+
+async def serve(client: Client, args, scheduler=None):
+    """
+    Runs a node until `args.duration` is up or, with a scheduler,
+    `args.blocks` blocks have been mined. Runs forever if neither is set.
+    """
+    loop = asyncio.get_running_loop()
+    server = None
+    if args.listen:
+        server = TCPBroadcastServer(client, *args.listen,
+                                    loop=loop).start()
+        logger.info('Client %s listening on %s:%d', client.name,
+                    *server.address)
+
+    for name, host, port in args.peer:
+        client.register_broadcast_node(TCPBroadcastNode(host, port,
+                                                        peer_id=name))
+    if args.sync:
+        client.sync()
+
+    tasks = [asyncio.ensure_future(client.receive_loop())]
+    if scheduler is not None:
+        tasks.append(asyncio.ensure_future(
+            scheduler.run(getattr(args, 'blocks', None))))
+
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=args.duration,
+                                     return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            # Raises whatever stopped the task, if it didn't just finish
+            task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if server is not None:
+            server.close()
+        for node in client.broadcast_nodes:
+            node.close()
+        await asyncio.gather(*(node.wait_closed()
+                               for node in client.broadcast_nodes))
+
+
+def summary(client: Client, scheduler=None, metrics: bool = False) -> dict:
+    doc = {
+        'name': client.node_id,
+        'height': client.blockchain.height,
+        'tip': client.blockchain.tip.hash,
+        'mempool': len(client.mempool),
+        'duplicates': client.duplicates,
+    }
+    if scheduler is not None:
+        doc['mining'] = scheduler.stats()
+    if metrics:
+        doc['metrics'] = client.metrics.snapshot()
+    return doc
+
+
+def _run_node(args, mine: bool) -> int:
+    configure_logging(args.log_level)
+    client = make_client(args)
+    scheduler = None
+    if mine:
+        scheduler = client.schedule_mining(
+            round_size=args.round_size,
+            refresh_interval=args.refresh_interval)
+
+    try:
+        asyncio.run(serve(client, args, scheduler))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if args.data_dir:
+            client.blockchain.store.close()
+
+    json.dump(summary(client, scheduler, args.metrics), sys.stdout,
+              indent=2, sort_keys=True)
+    print()
+    return 0
+
+
+def run_command(args) -> int:
+    return _run_node(args, mine=False)
+
+
+def mine_command(args) -> int:
+    return _run_node(args, mine=True)
+
+
+def bench_command(args) -> int:
+    return lambdacoin.bench.main(args.args)
+
+
+def profile_command(args) -> int:
+    if not args.command or args.command[0] == 'profile':
+        raise SystemExit('profile needs a run, mine or bench command')
+    return profile_call(lambda: main(args.command), sample=args.sample,
+                        interval=args.interval, top=args.top,
+                        output=args.output)
+
+
+def _add_node_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--name', help='Node name. Random by default.')
+    parser.add_argument('--listen', type=parse_address, metavar='HOST:PORT',
+                        help='Address to accept TCP connections on')
+    parser.add_argument('--peer', type=parse_peer, action='append',
+                        default=[], metavar='[NAME@]HOST:PORT',
+                        help='Node to relay to. Can be repeated.')
+    parser.add_argument('--sync', action='store_true',
+                        help='Download the chain from the first named peer')
+    parser.add_argument('--wire-format', default=constants.FORMAT_BINARY,
+                        choices=[constants.FORMAT_BINARY,
+                                 constants.FORMAT_JSON],
+                        help='Preferred wire format')
+    parser.add_argument('--relay-mode', default=constants.RELAY_FLOOD,
+                        choices=[constants.RELAY_FLOOD,
+                                 constants.RELAY_INVENTORY])
+    parser.add_argument('--data-dir',
+                        help='Directory to keep blocks, and the key of a '
+                             'named node, in. Kept in memory by default.')
+    parser.add_argument('--address', help='Address to receive rewards at')
+    parser.add_argument('--duration', type=float,
+                        help='Seconds to run for. Runs until Ctrl-C by '
+                             'default.')
+    parser.add_argument('--metrics', action='store_true',
+                        help='Include every metric in the summary')
+    parser.add_argument('--regtest-target', type=int, metavar='N',
+                        help='Run on a local test network whose blocks need '
+                             'N leading "0"s. Peers must use the same N.')
+    parser.add_argument('--log-level', help='e.g. DEBUG. Defaults to '
+                                            '$LAMBDACOIN_LOG_LEVEL or INFO.')
+
+
+def make_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='python -m lambdacoin',
+                                     description='Run a lambdacoin node')
+    commands = parser.add_subparsers(dest='command_name', metavar='command')
+    commands.required = True
+
+    run = commands.add_parser('run', help='Run a node')
+    _add_node_arguments(run)
+    run.set_defaults(func=run_command)
+
+    mine = commands.add_parser('mine', help='Run a node that mines')
+    _add_node_arguments(mine)
+    mine.add_argument('--blocks', type=int,
+                      help='Stop after mining this many blocks')
+    mine.add_argument('--processes', type=int, default=1,
+                      help='Processes to hash with')
+    mine.add_argument('--round-size', type=int, default=ROUND_SIZE,
+                      help='Nonces tried between checks of the tip')
+    mine.add_argument('--refresh-interval', type=float,
+                      default=REFRESH_INTERVAL,
+                      help='Seconds between picking up new transactions')
+    mine.set_defaults(func=mine_command)
+
+    bench = commands.add_parser(
+        'bench', add_help=False,
+        help='Run benchmarks. Takes the arguments of '
+             'python -m lambdacoin.bench.')
+    bench.add_argument('args', nargs=argparse.REMAINDER)
+    bench.set_defaults(func=bench_command)
+
+    profile = commands.add_parser(
+        'profile', help='Run another command under a profiler')
+    profile.add_argument('--sample', action='store_true',
+                         help='Sample every thread\'s stack instead of '
+                              'tracing calls with cProfile')
+    profile.add_argument('--interval', type=float, default=SAMPLE_INTERVAL,
+                         help='Seconds between samples')
+    profile.add_argument('--top', type=int, default=REPORT_TOP,
+                         help='Functions to list')
+    profile.add_argument('--output',
+                         help='File to save the profile to: pstats data, '
+                              'or collapsed stacks with --sample')
+    profile.add_argument('command', nargs=argparse.REMAINDER,
+                         help='run, mine or bench, and its arguments')
+    profile.set_defaults(func=profile_command)
+    return parser
+
+
+def main(argv: List[str] = None) -> int:
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv[:1] == ['bench']:
+        # argparse won't leave options such as --help to a REMAINDER
+        return lambdacoin.bench.main(argv[1:])
+    args = make_parser().parse_args(argv)
+    return args.func(args)
@@ -3,9 +3,36 @@ VERSION = '0.1.0'
 # Reward given when a block is solved
 SOLUTION_REWARD = 1
 
+# Number of leading "0"s every block's solution needs. Blocks with a lower
+# target are rejected, and blocks with a higher one count no more work.
+BLOCK_TARGET = 1
+
+# Hash of the Genesis block every client starts from, see `Block.genesis`
+GENESIS_HASH = '0' * 40
+
 # Broadcast Types
 B_TYPE_TRANSACTION = 'transaction'
 B_TYPE_SOLUTION = 'solution'
+B_TYPE_INVENTORY = 'inventory'
+B_TYPE_GET_DATA = 'getdata'
+
+# Chain sync: requests for block headers or full blocks by height range, or
+# for transactions by hash, and the batched replies to them
+B_TYPE_GET_HEADERS = 'getheaders'
+B_TYPE_HEADERS = 'headers'
+B_TYPE_GET_BLOCKS = 'getblocks'
+B_TYPE_BLOCKS = 'blocks'
+B_TYPE_GET_TRANSACTIONS = 'gettransactions'
+B_TYPE_TRANSACTIONS = 'transactions'
+
+# Relay modes: send every message in full to every node, or announce hashes
+# and let nodes fetch what they don't have
+RELAY_FLOOD = 'flood'
+RELAY_INVENTORY = 'inventory'
+
+# Wire formats for broadcasts
+FORMAT_JSON = 'json'
+FORMAT_BINARY = 'binary'
 
 # Encoding to use for strings
 STRING_ENCODING = 'UTF-8'
\ No newline at end of file
@@ -2,10 +2,8 @@
 
 TODO:
 
-* Add utxos_for_address function
 * Allow sending money from a client so that money is deducted from the client's
   overall account, and change is sent back to the client.
-* Saving Blockchain to disk
 
 """
 
@@ -14,130 +12,335 @@ import sys
 sys.path.insert(0, os.path.abspath(
     os.path.join(os.path.dirname(__file__), '..')))
 
+import asyncio
+import itertools
 import json
 import logging
 import sys
-from typing import List, Optional
+import time
+from collections import OrderedDict
+from collections.abc import Mapping
+from typing import Iterable, List, Optional
 
 from Crypto.PublicKey import RSA
 from Crypto.Hash import SHA
 
-from lambdacoin.broadcast import LocalBroadcastNode
+from lambdacoin.broadcast import DEFAULT_QUEUE_SIZE, LocalBroadcastNode
+from lambdacoin.cache import LRUCache
+from lambdacoin.chain import Blockchain
 import lambdacoin.constants as constants
 from lambdacoin.exceptions import ParseMessageError, UnknownBroadcastType
+from lambdacoin.keys import generate_key
+from lambdacoin.mempool import Mempool
+from lambdacoin.merkle import MerkleTree
+from lambdacoin.metrics import Registry
+from lambdacoin.mining import Miner, MiningScheduler
+from lambdacoin.snapshot import HistoryVerifier, load_snapshot
 import lambdacoin.utils
-from lambdacoin.utils import pretty_hash, rando
+from lambdacoin.utils import (PrettyHash, compact_hash, configure_logging,
+                              expand_hash, pretty_hash, rando)
+from lambdacoin.utxo import UTXO, UTXOSet
+from lambdacoin.verify import SignatureVerifier, cache_key
+import lambdacoin.wire as wire
 
-logging.basicConfig(stream=sys.stdout, level='DEBUG')
 logger = logging.getLogger('lambdacoin')
 
+# Number of message IDs to remember when dropping duplicate broadcasts
+SEEN_CACHE_SIZE = 100000
+
+# Most items sent in one reply to a chain sync request
+MAX_HEADERS = 2000
+MAX_BLOCKS = 500
+MAX_TRANSACTIONS = 5000
+
+# Number of getblocks requests a syncing client keeps in flight
+SYNC_WINDOW = 4
+
+# Number of received solutions to hold while their transactions are fetched
+MAX_PENDING_SOLUTIONS = 100
+
+# Seconds to wait for an item asked for with getdata before asking another
+# node that announced it
+REQUEST_TIMEOUT = 5.0
+
+# Most broadcasts taken through the ingestion pipeline at once, see
+# `Client.receive_broadcasts`
+INGEST_BATCH_SIZE = 1000
+
+# Stages of the ingestion pipeline, in order
+STAGE_CHECK = 'check'  # Duplicates and malformed transactions
+STAGE_VERIFY = 'verify'  # Signatures
+STAGE_INPUTS = 'inputs'  # Missing or already spent inputs
+STAGE_MEMPOOL = 'mempool'
+STAGE_RELAY = 'relay'
+INGEST_STAGES = (STAGE_CHECK, STAGE_VERIFY, STAGE_INPUTS, STAGE_MEMPOOL,
+                 STAGE_RELAY)
+
+# Number of blocks below the tip that a sync asks headers for, so a peer on a
+# different fork can be followed back to where it branched off
+SYNC_REORG_WINDOW = 100
+
+# Busy senders reuse the same key for many transactions, so parsed and
+# exported public keys are kept rather than redone for every message
+public_key_cache = LRUCache(4096)  # {exported key: public key}
+exported_key_cache = LRUCache(4096)  # {(n, e): exported key}
+# One public key object per sender, shared by all of their transactions
+interned_key_cache = LRUCache(4096)  # {(n, e): public key}
+
+# JSON of signed transactions, which don't change once signed
+transaction_json_cache = LRUCache(65536)  # {cache_key(): JSON str}
+
+
+def import_public_key(exported) -> 'RSA._RSAobj':
+    """Parses an exported public key, reusing keys that were seen before"""
+    public_key = public_key_cache.get(exported)
+    if public_key is None:
+        try:
+            public_key = intern_public_key(RSA.importKey(exported))
+        except ValueError:
+            raise ParseMessageError
+        public_key_cache.put(exported, public_key)
+    return public_key
+
+
+def intern_public_key(public_key) -> 'RSA._RSAobj':
+    """
+    Returns the key object already used for the same key, if there is one,
+    so transactions from one sender don't each hold a copy
+    """
+    key = (public_key.n, public_key.e)
+    interned = interned_key_cache.get(key)
+    if interned is None:
+        interned_key_cache.put(key, public_key)
+        return public_key
+    return interned
+
+
+def export_public_key(public_key) -> str:
+    """Exports a public key as a PEM string, reusing earlier exports"""
+    key = (public_key.n, public_key.e)
+    exported = exported_key_cache.get(key)
+    if exported is None:
+        exported = public_key.exportKey().decode(constants.STRING_ENCODING)
+        exported_key_cache.put(key, exported)
+    return exported
+
+
+def cache_stats() -> dict:
+    """Returns the size and hit/miss counts of each cache"""
+    return {
+        'public_keys': public_key_cache.stats(),
+        'exported_keys': exported_key_cache.stats(),
+        'interned_keys': interned_key_cache.stats(),
+        'transaction_json': transaction_json_cache.stats(),
+    }
+
 
 class Block(object):
+    # Chains and mempools hold many blocks and transactions, so neither has a
+    # __dict__, and hashes are kept as digest bytes (see `compact_hash`)
+    __slots__ = ('_hash', 'transactions', '_transaction_hashes',
+                 'gen_transaction', 'target', 'solution', 'version',
+                 '_prev_hash', 'prev_block', 'next_block', 'utxos',
+                 '_merkle_tree', '_midstate')
+
     def __init__(self, hash=None, transactions=None, gen_transaction=None,
                  target=None, prev_block=None, next_block=None, solution=None,
-                 version=None):
+                 version=None, prev_hash=None):
+        """
+        :param prev_hash: Hash of the block this one builds on. The puzzle
+            commits to it, so a solution only counts on top of that block.
+            Blocks without one are added on top of whatever the tip is, so
+            only locally built blocks may leave it out.
+        """
         self.hash = hash or lambdacoin.utils.generate_hash()
         self.transactions = transactions or []
+        self._transaction_hashes = {t.digest for t in self.transactions}
         self.gen_transaction = gen_transaction
-        self.target = 1 if target is None else target
+        self.target = constants.BLOCK_TARGET if target is None else target
         self.solution = solution
-        self.version = version or constants.VERSION
+        self.version = sys.intern(version or constants.VERSION)
+        self.prev_hash = prev_hash
 
         self.prev_block = prev_block
         self.next_block = next_block
 
-        # Puzzle is a combination of all of the transaction's hashes together
-        self.puzzle = self._updated_puzzle()
+        # UTXO index for the chain ending at this block. Only the tip of a
+        # chain holds one, and it is handed forward by `add_next`
+        self.utxos = None
+
+        # Merkle tree of the transaction hashes, built on first use and then
+        # extended as transactions are added
+        self._merkle_tree = None
+        # Hash state of the puzzle, computed on first use and reused for
+        # every nonce
+        self._midstate = None
+
+    @staticmethod
+    def genesis() -> 'Block':
+        """Returns the Genesis block shared by every client"""
+        return Block(hash=constants.GENESIS_HASH)
+
+    @property
+    def hash(self) -> str:
+        return expand_hash(self._hash)
+
+    @hash.setter
+    def hash(self, value: str):
+        self._hash = compact_hash(value)
+
+    @property
+    def prev_hash(self) -> Optional[str]:
+        return expand_hash(self._prev_hash)
+
+    @prev_hash.setter
+    def prev_hash(self, value: Optional[str]):
+        self._prev_hash = compact_hash(value)
+
+    @property
+    def merkle_tree(self) -> MerkleTree:
+        if self._merkle_tree is None:
+            self._merkle_tree = MerkleTree(
+                t.digest for t in self.transactions)
+        return self._merkle_tree
+
+    @property
+    def puzzle(self) -> str:
+        """
+        Hash of the previous block followed by the Merkle root of the block's
+        transaction hashes
+        """
+        return (self.prev_hash or '') + self.merkle_tree.root
+
+    def midstate(self):
+        """
+        Returns the SHA state after hashing the puzzle. Copy it before
+        updating it with a nonce.
+        """
+        if self._midstate is None:
+            self._midstate = SHA.new(
+                self.puzzle.encode(constants.STRING_ENCODING))
+        return self._midstate
 
-    def add_next(self, next_block: 'Block'):
+    def add_next(self, next_block: 'Block') -> Optional[list]:
+        """
+        Links a block on top of this one. Returns the undo record of applying
+        it to the UTXO index, if this block held the index.
+        """
         self.next_block = next_block
         next_block.prev_block = self
 
+        if self.utxos is not None:
+            next_block.utxos, self.utxos = self.utxos, None
+            return next_block.utxos.apply_block(next_block)
+        return None
+
     def add_transaction(self, transaction: 'Transaction'):
         if not self.has_transaction(transaction):
             self.transactions.append(transaction)
-            self.puzzle = self._updated_puzzle()
+            self._transaction_hashes.add(transaction.digest)
+
+            # Only the path to the new leaf is rehashed
+            if self._merkle_tree is not None:
+                self._merkle_tree.append(transaction.digest)
+            self._midstate = None
 
     def has_transaction(self, transaction: 'Transaction') -> bool:
-        return transaction.hash in [t.hash for t in self.transactions]
+        return transaction.digest in self._transaction_hashes
+
+    def merkle_proof(self, transaction_hash: str) -> Optional[List[list]]:
+        """
+        Returns a proof that a transaction is in this block, to check against
+        the block's header with `lambdacoin.merkle.verify_proof`, or None if
+        it isn't in the block
+        """
+        return self.merkle_tree.proof(transaction_hash)
 
     def verify(self, nonce: str = None) -> bool:
         """
-        Generates a hash based on the transaction text, given an nonce, and
-        checks whether the first `target` characters of the generated hash 
-        are "0"s
+        Checks whether a nonce solves this block's puzzle, the previous block
+        hash followed by the Merkle root of the transaction hashes. A copy of
+        the cached `midstate` is updated with the nonce, so the puzzle isn't
+        rehashed for every nonce tried, and the digest has to meet the target
+        as `lambdacoin.utils.meets_target` checks it.
+
+        The higher the target, the more leading "0"s the hex digest needs,
+        and the less likely a nonce is to verify.
 
-        The higher the target value, the more 0s required, and the more
-        unlikely it is to verify. 
+        :param nonce: Defaults to the block's solution
         """
         nonce = nonce or self.solution
 
-        text = self.puzzle + nonce
-        h = SHA.new(text.encode('utf-8')).hexdigest()
-        return h[:self.target] == '0' * self.target
+        h = self.midstate().copy()
+        h.update(nonce.encode(constants.STRING_ENCODING))
+        return lambdacoin.utils.meets_target(h.digest(), self.target)
 
-    def block_in_past(self, block_hash: str) -> bool:
+    @staticmethod
+    def verify_header(header: dict) -> bool:
         """
-        Returns whether the given block hash is the hash of any previous blocks
+        Checks the solution in a block header from `header`, without the
+        block's transactions. Together with `lambdacoin.merkle.verify_proof`
+        this shows a transaction was confirmed.
         """
-        current_block = self
-        while current_block is not None:
-            if block_hash == current_block.hash:
-                return True
-            current_block = current_block.prev_block
-
-        return False
+        if header.get('solution') is None:
+            return False
 
-    def utxos_for_address(self, address: str) -> List['Transaction']:
-        """Gets all Unspent Transaction Outputs(UTXOs) for a given address"""
+        target = header.get('target')
+        puzzle = (header.get('prev_hash') or '') + header['merkle_root']
+        h = SHA.new((puzzle + header['solution']).encode(
+            constants.STRING_ENCODING))
+        return lambdacoin.utils.meets_target(
+            h.digest(), constants.BLOCK_TARGET if target is None else target)
 
-        # TODO: THIS FUNCTION DOES NOT WORK AT ALL YET. NEED TO WRITE IT FROM SCRATCH.
-        utxos = []
+    def chain(self) -> List['Block']:
+        """
+        Returns every block from the Genesis block up to this one, following
+        `prev_block`. Blocks kept by a `lambdacoin.storage.BlockStore` aren't
+        linked.
+        """
+        blocks = []
 
         current_block = self
-        # Loop through blockchain until we hit the Genesis block
         while current_block is not None:
-            if current_block.gen_transaction is not None:
-
-                value += current_block.gen_transaction.value_for_address(
-                    address)
-
-            for transaction in current_block.transactions:
-                value += transaction.value_for_address(address)
-
+            blocks.append(current_block)
             current_block = current_block.prev_block
 
-        return value
-
+        blocks.reverse()
+        return blocks
 
-    def value_for_address(self, address: str):
+    def chain_utxos(self) -> UTXOSet:
         """
-        Returns the value an address owns in this blockchain
+        Returns the UTXO index of the chain ending at this block
 
-        Note: this function is NOT recursive. It just loops.
+        The index is built by replaying the chain the first time it's needed
+        and then kept up to date by `add_next`. Blocks that are no longer the
+        tip get a fresh index built for them on every call.
         """
-        value = 0
+        if self.utxos is not None:
+            return self.utxos
 
-        current_block = self
-        # Loop through blockchain until we hit the Genesis block
-        while current_block is not None:
-            if current_block.gen_transaction is not None:
-                value += current_block.gen_transaction.value_for_address(
-                    address)
-
-            for transaction in current_block.transactions:
-                value += transaction.value_for_address(address)
+        utxos = UTXOSet.from_blocks(self.chain())
+        if self.next_block is None:
+            self.utxos = utxos
+        return utxos
 
-            current_block = current_block.prev_block
+    def utxos_for_address(self, address: str) -> List[UTXO]:
+        """Gets all Unspent Transaction Outputs(UTXOs) for a given address"""
+        return self.chain_utxos().utxos_for_address(address)
 
-        return value
+    def value_for_address(self, address: str):
+        """Returns the value an address owns in this blockchain"""
+        return self.chain_utxos().balance(address)
 
-    def _updated_puzzle(self) -> str:
-        """
-        Returns a new puzzle that is a string of all of this block's
-        transaction hashes appended together.
-        """
-        return ''.join([t.hash for t in self.transactions])
+    def header(self) -> dict:
+        """Returns the fields of `to_dict` that identify the block"""
+        return {
+            'hash': self.hash,
+            'prev_hash': self.prev_hash,
+            'target': self.target,
+            'solution': self.solution,
+            'merkle_root': self.merkle_tree.root,
+        }
 
     def to_dict(self):
         gen_transaction = None
@@ -147,6 +350,8 @@ class Block(object):
         doc = {
             'version': self.version,  # lambdacoin protocol version
             'hash': self.hash,
+            'prev_hash': self.prev_hash,
+            'target': self.target,
             'solution': self.solution,
             'gen_transaction': gen_transaction,
             'transactions': [t.hash for t in self.transactions],
@@ -155,18 +360,36 @@ class Block(object):
         return doc
 
     @staticmethod
-    def from_dict(doc, given_transactions: List['Transaction']):
+    def from_dict(doc, given_transactions,
+                  required_target: Optional[int] = constants.BLOCK_TARGET):
         """
         Attempts to convert a block doc into a Block object by matching
         the transaction hashes with a list of given transactions
 
         :param doc: dict to convert to Block
-        :param given_transactions: Transactions waiting to be confirmed
+        :param given_transactions: Transactions waiting to be confirmed,
+            either as a list or as a dict of {hash: Transaction}
+        :param required_target: Least target the block may claim. None skips
+            the check, e.g. for blocks read back from this client's own store.
+        :raises ParseMessageError: If the block's target isn't an int, or is
+            below `required_target`
         """
-        given_transaction_hashes = {t.hash: t for t in given_transactions}
+        if isinstance(given_transactions, dict):
+            given_transaction_hashes = given_transactions
+        else:
+            given_transaction_hashes = {t.hash: t for t in given_transactions}
 
         version = doc.get('version')
         hash = doc.get('hash')
+        prev_hash = doc.get('prev_hash')
+        target = doc.get('target')
+        if target is None:
+            target = constants.BLOCK_TARGET
+        elif target.__class__ is not int:
+            raise ParseMessageError('Block target must be an int')
+        if required_target is not None and target < required_target:
+            raise ParseMessageError('Block target {} is below {}'.format(
+                target, required_target))
         solution = doc.get('solution')
         gen_transaction_doc = doc.get('gen_transaction')
         transaction_hashes = doc.get('transactions')
@@ -183,27 +406,139 @@ class Block(object):
                     t_match = given_transaction_hashes[t_hash]
                     transactions.append(t_match)
 
-        return Block(version=version, hash=hash, solution=solution,
-                     transactions=transactions,
-                     gen_transaction=gen_transaction)
+        return Block(version=version, hash=hash, target=target,
+                     solution=solution, transactions=transactions,
+                     gen_transaction=gen_transaction, prev_hash=prev_hash)
+
+
+def _pack_inputs(inputs: List[dict]) -> tuple:
+    """Flattens inputs to (hash, n, hash, n, ...)"""
+    data = []
+    try:
+        for tx_input in inputs:
+            data += (compact_hash(tx_input.get('hash')), tx_input.get('n'))
+    except (AttributeError, TypeError):
+        raise ParseMessageError('Transaction inputs must be dicts')
+    return tuple(data)
+
+
+def _pack_outputs(outputs: dict) -> tuple:
+    """Flattens outputs to (address, value, address, value, ...)"""
+    if outputs.__class__ is not dict and not isinstance(outputs, Mapping):
+        raise ParseMessageError('Transaction outputs must be a mapping')
+    data = []
+    for address, value in outputs.items():
+        data += (compact_hash(address), value)
+    return tuple(data)
+
+
+class Outputs(Mapping):
+    """
+    Read-only {address: value} view of a transaction's outputs, which are
+    kept as a flat tuple of (address, value, address, value, ...)
+    """
+
+    __slots__ = ('_data',)
+
+    def __init__(self, data: tuple):
+        self._data = data
+
+    def __getitem__(self, address: str):
+        key = compact_hash(address)
+        data = self._data
+        for i in range(0, len(data), 2):
+            if data[i] == key:
+                return data[i + 1]
+        raise KeyError(address)
+
+    def __iter__(self):
+        return (expand_hash(address) for address in self._data[::2])
+
+    def __len__(self) -> int:
+        return len(self._data) // 2
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def items(self) -> list:
+        data = self._data
+        return list(zip(map(expand_hash, data[::2]), data[1::2]))
+
+    def values(self) -> tuple:
+        return self._data[1::2]
 
 
 class Transaction(object):
+    __slots__ = ('_hash', '_inputs', '_outputs', 'version', 'sig',
+                 'public_key')
+
     def __init__(self, inputs=None, outputs=None, hash=None, version=None,
                  sig=None, public_key=None):
-        self.inputs = inputs or []
-        self.outputs = outputs or {}  # {address: value}
-        self.hash = hash or lambdacoin.utils.generate_hash()
-        self.version = version or constants.VERSION
-
-        self.sig = sig  # Str of signature
+        """
+        :raises ParseMessageError: If `inputs` isn't a list of dicts or
+            `outputs` isn't a mapping
+        """
+        # Set directly rather than through the properties, as this is on the
+        # path of every received transaction
+        self._inputs = _pack_inputs(inputs) if inputs else ()
+        self._outputs = _pack_outputs(outputs) if outputs else ()
+        self._hash = compact_hash(hash or lambdacoin.utils.generate_hash())
+        self.version = sys.intern(version or constants.VERSION)
+
+        # Signature of the hash. Signing gives a tuple and JSON a list, which
+        # is kept as a tuple too.
+        self.sig = tuple(sig) if isinstance(sig, list) else sig
         self.public_key = public_key  # Pycrypto publickey object
 
+    @property
+    def hash(self) -> str:
+        return expand_hash(self._hash)
+
+    @hash.setter
+    def hash(self, value: str):
+        self._hash = compact_hash(value)
+
+    @property
+    def digest(self):
+        """
+        The hash as it's kept in memory: 20 bytes if it's a hex digest,
+        otherwise the hash itself. Cheaper than `hash` for lookups.
+        """
+        return self._hash
+
+    @property
+    def inputs(self) -> List[dict]:
+        """
+        Each input is {'hash': hash of input transaction,
+                       'n': index in list of outputs of that transaction}
+        """
+        return [{'hash': tx_hash, 'n': n} for tx_hash, n in self.outpoints]
+
+    @property
+    def outpoints(self) -> List[tuple]:
+        """(hash, n) of each output the inputs spend"""
+        data = self._inputs
+        if not data:
+            return []
+        return list(zip(map(expand_hash, data[::2]), data[1::2]))
+
+    @inputs.setter
+    def inputs(self, inputs: List[dict]):
+        self._inputs = _pack_inputs(inputs)
+
+    @property
+    def outputs(self) -> Outputs:
+        return Outputs(self._outputs)
+
+    @outputs.setter
+    def outputs(self, outputs: dict):
+        self._outputs = _pack_outputs(outputs)
+
     def sign(self, key):
         """Adds signature to this Transaction"""
 
         # Public key of sender
-        self.public_key = key.publickey()
+        self.public_key = intern_public_key(key.publickey())
 
         # Signature of sender
         self.sig = key.sign(
@@ -219,38 +554,71 @@ class Transaction(object):
         else:
             return False
 
+    def is_well_formed(self) -> bool:
+        """
+        Cheap structural checks, done before anything as slow as verifying
+        the signature
+        """
+        if not isinstance(self._hash, (bytes, str)):
+            return False
+
+        # Inputs are (hash, n) pairs, outputs (address, value) pairs
+        inputs = self._inputs
+        for i in range(0, len(inputs), 2):
+            n = inputs[i + 1]
+            if not isinstance(inputs[i], (bytes, str)) or \
+                    not isinstance(n, int) or n < 0:
+                return False
+
+        for value in self._outputs[1::2]:
+            if isinstance(value, bool) or \
+                    not isinstance(value, (int, float)) or value < 0:
+                return False
+        return True
+
     def value_for_address(self, address: str):
         """Returns the value an address owns in this transaction"""
         value = 0
 
-        for out_address, out_value in self.outputs.items():
-            if address == out_address:
-                value += out_value
+        address = compact_hash(address)
+        data = self._outputs
+        for i in range(0, len(data), 2):
+            if address == data[i]:
+                value += data[i + 1]
 
         return value
 
+    def size(self) -> int:
+        """Returns the size in bytes of this Transaction as JSON"""
+        return len(self.to_json().encode(constants.STRING_ENCODING))
+
+    def to_json(self) -> str:
+        """Returns this Transaction as JSON, cached once it's signed"""
+        if self.sig is None:
+            return json.dumps(self.to_dict())
+
+        key = cache_key(self)
+        data = transaction_json_cache.get(key)
+        if data is None:
+            data = json.dumps(self.to_dict())
+            transaction_json_cache.put(key, data)
+        return data
+
     def to_dict(self):
         public_key = None
         if self.public_key is not None:
             # Export public key as a string
-            public_key = self.public_key.exportKey().decode(
-                lambdacoin.constants.STRING_ENCODING)
+            public_key = export_public_key(self.public_key)
 
+        outputs = self._outputs
         doc = {
             'version': self.version,  # lambdacoin protocol version
             'hash': self.hash,
             'public_key': public_key,
             'sig': self.sig,
-            'size': 123,
-            'inputs': [
-                {
-                    # Hash of input transaction
-                    'hash': 'abc',
-                    # n is 'vout' Index in list of outputs from input transaction
-                    'n': 0,
-                }
-            ],
-            'outputs': self.outputs,
+            'inputs': self.inputs,
+            'outputs': dict(zip(map(expand_hash, outputs[::2]),
+                                outputs[1::2])),
         }
 
         return doc
@@ -265,10 +633,7 @@ class Transaction(object):
         outputs = doc.get('outputs')
 
         if public_key is not None:
-            try:
-                public_key = RSA.importKey(public_key)
-            except ValueError:
-                raise ParseMessageError
+            public_key = import_public_key(public_key)
 
         return Transaction(
             inputs, outputs, hash, version, sig, public_key)
@@ -276,17 +641,225 @@ class Transaction(object):
 
 class Client(object):
     def __init__(self, name=None, addresses=None, blockchain=None,
-                 broadcast_nodes=None):
+                 broadcast_nodes=None, miner=None, mempool=None,
+                 verifier=None, wire_formats=None,
+                 inbox_size=DEFAULT_QUEUE_SIZE,
+                 relay_mode=constants.RELAY_FLOOD,
+                 seen_cache_size=SEEN_CACHE_SIZE,
+                 request_timeout=REQUEST_TIMEOUT, key=None,
+                 key_factory=None, metrics=None):
+        """
+        :param key: RSA key to sign transactions with, e.g. from a
+            `lambdacoin.keys.KeyStore`
+        :param key_factory: Called for a key the first time one is needed, if
+            none was given. Defaults to generating one. Pass
+            `KeyPool.get` to take pre-generated keys.
+        :param metrics: `lambdacoin.metrics.Registry` to record into. Each
+            client gets its own by default.
+        :param request_timeout: Seconds to wait for an item asked for with
+            getdata, see `retry_requests`
+        """
         self.name = name
-        self.key = RSA.generate(1024)
+        # Identifies this client to peers, e.g. so they know where to send
+        # getdata requests
+        self.node_id = name or lambdacoin.utils.generate_hash()
+        # Generating a key is slow, so it's put off until the first signature
+        self._key = key
+        self.key_factory = key_factory or generate_key
         self.addresses = addresses or [self.generate_address()]
-        self.blockchain = blockchain
 
-        self.broadcast_nodes = broadcast_nodes or []
+        # Accepts a Blockchain, or a Block to start a Blockchain from
+        if blockchain is None:
+            blockchain = Block.genesis()
+        if not isinstance(blockchain, Blockchain):
+            blockchain = Blockchain(blockchain)
+        self.blockchain = blockchain
+        self.blockchain.on_update = self._chain_updated
+
+        # Wire formats this client accepts, most preferred first
+        self.wire_formats = tuple(wire_formats or (
+            constants.FORMAT_BINARY, constants.FORMAT_JSON))
+
+        self.broadcast_nodes = []
+        for broadcast_node in broadcast_nodes or []:
+            self.register_broadcast_node(broadcast_node)
+
+        # Whether new transactions and solutions are sent in full or announced
+        self.relay_mode = relay_mode
+
+        # IDs of messages received or sent, checked before decoding anything
+        self.seen = LRUCache(seen_cache_size)
+        self.duplicates = 0
+
+        # Items asked for with getdata and not received yet, oldest request
+        # first, {hash: InventoryRequest}
+        self.requested = OrderedDict()
+        self.max_requested = seen_cache_size
+        self.request_timeout = request_timeout
+
+        # Numbers chain sync requests so replies can be matched to them
+        self._request_ids = itertools.count(1)
+        # Download in progress, see `sync`
+        self.sync_state = None
+        # Solutions waiting for transactions this client didn't have,
+        # {block hash: (doc, data, missing hashes)}
+        self.pending_solutions = OrderedDict()
+
+        # Single process by default. Pass Miner(processes=n) to mine on n cores
+        self.miner = miner or Miner()
+        # Background mining, see `schedule_mining`
+        self.scheduler = None
+
+        # Checks and remembers the signatures of inbound transactions
+        self.verifier = verifier or SignatureVerifier()
+
+        # Transactions waiting to be confirmed
+        self.mempool = Mempool() if mempool is None else mempool
+
+        # Current block being worked on, built from the mempool
+        self.current_block = None
+        self.start_next_block()
+
+        # Broadcasts delivered by asyncio broadcast nodes, see `receive_loop`
+        self.inbox_size = inbox_size
+        self._inbox = None
+
+        # Checks a loaded snapshot against the chain, see `load_snapshot`
+        self.history_verifier = None
+
+        self.metrics = Registry() if metrics is None else metrics
+        self._register_metrics()
+
+    def _register_metrics(self):
+        metrics = self.metrics
+        self._received = metrics.counter(
+            'broadcasts_received_total', 'Broadcasts processed, by type',
+            ['type'])
+        self._receive_seconds = metrics.histogram(
+            'receive_seconds', 'Time to process a broadcast, by type',
+            ['type'])
+        self._duplicates = metrics.counter(
+            'broadcasts_duplicate_total',
+            'Broadcasts dropped as already seen')
+        self._signature_seconds = metrics.histogram(
+            'signature_verify_seconds',
+            'Time to check a transaction signature')
+        self._signatures_invalid = metrics.counter(
+            'signatures_invalid_total', 'Transactions with a bad signature')
+        self._solution_seconds = metrics.histogram(
+            'solution_verify_seconds', 'Time to check a block solution')
+        self._solutions_invalid = metrics.counter(
+            'solutions_invalid_total', 'Blocks with a wrong solution')
+        self._hashes = metrics.counter(
+            'hashes_total', 'Nonces tried while mining')
+        self._hashrate = metrics.gauge(
+            'hashrate', 'Nonces per second in the last mining run')
+        self._blocks_mined = metrics.counter(
+            'blocks_mined_total', 'Blocks this client found a solution for')
+        metrics.gauge('mempool_transactions',
+                      'Transactions in the mempool').set_function(
+            lambda: len(self.mempool))
+        metrics.gauge('mempool_bytes',
+                      'Size of the transactions in the mempool').set_function(
+            lambda: self.mempool.bytes)
+        metrics.gauge('chain_height', 'Height of the tip').set_function(
+            lambda: self.blockchain.height)
+
+        # {broadcast type: (counter, histogram)}, to skip label lookups
+        self._receive_metrics = {}
+
+        passed = metrics.counter(
+            'ingest_passed_total',
+            'Transactions through each ingestion stage', ['stage'])
+        dropped = metrics.counter(
+            'ingest_dropped_total',
+            'Transactions dropped at each ingestion stage', ['stage'])
+        seconds = metrics.histogram(
+            'ingest_stage_seconds',
+            'Time spent in each ingestion stage per batch', ['stage'])
+        # {stage: (passed, dropped, seconds)}
+        self._ingest_metrics = {
+            stage: (passed.labels(stage=stage), dropped.labels(stage=stage),
+                    seconds.labels(stage=stage))
+            for stage in INGEST_STAGES}
+
+    @property
+    def key(self) -> 'RSA._RSAobj':
+        if self._key is None:
+            self._key = self.key_factory()
+        return self._key
+
+    @property
+    def inbox(self) -> asyncio.Queue:
+        # Created on first use so it belongs to the running loop
+        if self._inbox is None:
+            self._inbox = asyncio.Queue(self.inbox_size)
+        return self._inbox
+
+    async def receive_loop(self):
+        """
+        Receives broadcasts from the inbox until cancelled. While the inbox is
+        empty, the history below a loaded snapshot is verified.
+        """
+        inbox = self.inbox
+        while True:
+            if inbox.empty() and self.verify_history() is None and \
+                    self.history_verifier.next_height < len(self.blockchain):
+                # Let other tasks run between batches
+                await asyncio.sleep(0)
+                continue
+
+            data = await inbox.get()
+            try:
+                self.receive_broadcast(data)
+            except Exception:
+                logger.exception('Client %s could not process a broadcast',
+                                 self.name)
+            finally:
+                inbox.task_done()
+
+    def load_snapshot(self, path: str, expected_digest: str = None) \
+            -> HistoryVerifier:
+        """
+        Starts from the balances in a snapshot written by
+        `lambdacoin.snapshot.export_snapshot`, instead of replaying the chain.
+        The chain up to the snapshot's block is still verified, a batch at a
+        time, by `verify_history`.
+        """
+        info, utxos = load_snapshot(path, expected_digest)
+        self.blockchain.use_snapshot(info, utxos)
+        self.history_verifier = HistoryVerifier(self.blockchain, info)
+        logger.info('Client %s loaded snapshot %s of %d outputs at block %s',
+                    self.name, PrettyHash(info.digest), info.count,
+                    PrettyHash(info.block_hash))
+        return self.history_verifier
+
+    def verify_history(self) -> Optional[bool]:
+        """
+        Checks the next batch of blocks below a loaded snapshot. Returns None
+        while that's still in progress, and whether the snapshot matched once
+        it's done or if there's no snapshot to check.
 
-        # Current block being worked on
-        # Includes transactions waiting to be confirmed
-        self.current_block = Block()
+        If it didn't match, the UTXO index is rebuilt from the chain.
+        """
+        verifier = self.history_verifier
+        if verifier is None:
+            return True
+
+        result = verifier.step()
+        if result is None:
+            return None
+
+        self.history_verifier = None
+        if result:
+            logger.info('Client %s verified snapshot %s', self.name,
+                        PrettyHash(verifier.info.digest))
+        else:
+            logger.error('Client %s found snapshot %s does not match the '
+                         'chain. Rebuilding balances from blocks.', self.name,
+                         PrettyHash(verifier.info.digest))
+            self.blockchain.tip.utxos = None
+        return result
 
     def generate_address(self) -> str:
         return lambdacoin.utils.generate_hash()
@@ -298,57 +871,230 @@ class Client(object):
         """
         if addresses is None:
             addresses = self.addresses
-        return sum([self.blockchain.value_for_address(addr)
-                    for addr in addresses])
-
-    def mine(self, block: 'Block', start=0, end=2000) -> Optional[str]:
-        for x in range(start, end):
-            if block.verify(str(x)):
-                return str(x)
+        return self.blockchain.total_value(addresses)
+
+    def mine(self, block: 'Block', start=0, end=2000,
+             stop=None) -> Optional[str]:
+        """:param stop: multiprocessing.Event that interrupts the search"""
+        solution = self.miner.mine(block.puzzle, block.target, start, end,
+                                   stop)
+        self._hashes.inc(self.miner.hashes)
+        self._hashrate.set(self.miner.hashrate)
+        return solution
 
     def mine_current_block(self, start=0, end=2000):
         solution = self.mine(self.current_block, start, end)
 
+        logger.debug('Client %s tried %d nonces at %.0f H/s', self.name,
+                     self.miner.hashes, self.miner.hashrate)
+
         if solution is not None:
-            logger.debug('Client {} found solution of {} for block {}'.format(
-                self.name, solution, pretty_hash(self.current_block.hash)))
+            self.submit_solution(self.current_block, solution)
+
+        return solution
 
-            # Create and broadcast the gen transaction
-            gen_transaction = Transaction(
-                outputs={self.addresses[0]: constants.SOLUTION_REWARD}
-            )
+    def schedule_mining(self, **kwargs) -> MiningScheduler:
+        """
+        Returns a scheduler that mines in the background while its `run` is
+        awaited, e.g. alongside `receive_loop`. Takes the arguments of
+        `MiningScheduler`.
+        """
+        self.scheduler = MiningScheduler(self, **kwargs)
+        return self.scheduler
 
-            # Broadcast the block with the solution
-            self.current_block.solution = solution
-            self.current_block.gen_transaction = gen_transaction
-            self.blockchain.add_next(self.current_block)
-            self.blockchain = self.current_block
-            self.broadcast_solution()
+    def block_template(self) -> 'Block':
+        """
+        Returns a copy of the current block to mine, which transactions
+        received later don't change
+        """
+        current = self.current_block
+        return Block(transactions=list(current.transactions),
+                     target=current.target, prev_hash=current.prev_hash)
+
+    def submit_solution(self, block: 'Block', solution: str):
+        """Adds a block this client solved to the chain and broadcasts it"""
+        logger.debug('Client %s found solution of %s for block %s',
+                     self.name, solution, PrettyHash(block.hash))
+        self._blocks_mined.inc()
+
+        # Create and broadcast the gen transaction
+        gen_transaction = Transaction(
+            outputs={self.addresses[0]: constants.SOLUTION_REWARD}
+        )
+
+        # Broadcast the block with the solution. Appending it starts the
+        # next block.
+        block.solution = solution
+        block.gen_transaction = gen_transaction
+        self.blockchain.append(block)
+        self.broadcast_solution(block)
+
+    def start_next_block(self):
+        """
+        Starts a new current block on top of the tip, from the transactions
+        still waiting in the mempool, at the chain's target
+        """
+        self.current_block = Block(transactions=list(self.mempool),
+                                   target=self.blockchain.target,
+                                   prev_hash=self.blockchain.tip.hash)
 
-        return solution
+    def _chain_updated(self, disconnected: List['Block'],
+                       connected: List['Block']):
+        """
+        Called when the main chain changes. Transactions of connected blocks
+        leave the mempool, along with pool transactions spending the same
+        outputs and their descendants. After a switch to another branch, those
+        of disconnected blocks go back into it and the whole pool is checked
+        against the new tip, dropping what no longer checks out.
+        """
+        confirmed = {t.hash for b in connected for t in b.transactions}
+        self.mempool.remove_many(confirmed)
+
+        conflicts = 0
+        for block in connected:
+            for transaction in block.transactions:
+                for outpoint in transaction.outpoints:
+                    spender = self.mempool.spender(outpoint)
+                    if spender is not None:
+                        conflicts += len(
+                            self.mempool.remove_with_descendants(spender))
+        if conflicts:
+            logger.debug('Client %s dropped %d transactions conflicting '
+                         'with new blocks', self.name, conflicts)
+
+        if disconnected:
+            # Oldest block first, so parents are checked before their
+            # spenders, then the pool in the order it was filled
+            entries = [(transaction, None, None)
+                       for block in reversed(disconnected)
+                       for transaction in block.transactions
+                       if transaction.hash not in confirmed and
+                       transaction.hash not in self.mempool and
+                       transaction.is_well_formed()]
+            for transaction in list(self.mempool):
+                self.mempool.remove(transaction.hash)
+                entries.append((transaction, None, None))
+            for transaction, _, _ in self._check_inputs(entries):
+                self.mempool.add(transaction)
+
+        if disconnected:
+            logger.info('Client %s switched to block %s, dropping %d blocks',
+                        self.name, PrettyHash(self.blockchain.tip.hash),
+                        len(disconnected))
+        self.start_next_block()
+        if self.scheduler is not None:
+            self.scheduler.restart()
 
     def register_broadcast_node(self, broadcast_node):
+        broadcast_node.negotiate(self.wire_formats)
         self.broadcast_nodes.append(broadcast_node)
 
     def broadcast_transaction(self, transaction: 'Transaction') -> list:
         """Signs a transaction and sends it to the network"""
         transaction.sign(self.key)
 
+        # Keep it to mine and to serve to nodes that ask for it
+        self.accept_transaction(transaction)
+
         doc = transaction.to_dict()
         doc = self.package_for_broadcast(constants.B_TYPE_TRANSACTION, doc)
-        data = json.dumps(doc)
 
-        return self.broadcast(data)
+        return self.relay(doc)
 
-    def broadcast_solution(self) -> list:
-        doc = self.current_block.to_dict()
+    def broadcast_solution(self, block: 'Block' = None) -> list:
+        """Sends a solved block, by default the current one, to the network"""
+        doc = (block or self.current_block).to_dict()
         doc = self.package_for_broadcast(constants.B_TYPE_SOLUTION, doc)
-        data = json.dumps(doc)
 
-        return self.broadcast(data)
+        return self.relay(doc)
+
+    def accept_transaction(self, transaction: 'Transaction',
+                           size: int = None) -> bool:
+        """
+        Adds a transaction to the mempool and the current block. Returns
+        False if it was already there or didn't fit.
+        """
+        evictions = self.mempool.evictions
+        if not self.mempool.add(transaction, size):
+            return False
+
+        if self.mempool.evictions != evictions:
+            # Some transactions were evicted to make room
+            self.start_next_block()
+        else:
+            self.current_block.add_transaction(transaction)
+        return True
+
+    def relay(self, doc: dict, data=None) -> list:
+        """
+        Passes a new transaction or solution on to every node, either in full
+        or, in inventory mode, as an announcement of its hash
+
+        :param data: doc as received, if it was received
+        """
+        if self.relay_mode == constants.RELAY_INVENTORY:
+            item = {'type': doc['type'], 'hash': doc['package']['hash']}
+            return self.announce([item])
+        elif data is not None:
+            return self.broadcast(data)
+        return self.broadcast_doc(doc)
+
+    def announce(self, items: List[dict]) -> list:
+        """
+        Sends an inventory of items to every node
+
+        :param items: [{'type': broadcast type, 'hash': hash}]
+        """
+        doc = self.package_for_broadcast(
+            constants.B_TYPE_INVENTORY, {'from': self.node_id, 'items': items})
+        return self.broadcast_doc(doc)
+
+    def peer(self, node_id: str):
+        """Returns the broadcast node leading to the given client"""
+        for node in self.broadcast_nodes:
+            if node.peer_id is not None and node.peer_id == node_id:
+                return node
+        return None
+
+    def send_to(self, node, doc: dict):
+        """Sends a broadcast dict to a single node"""
+        data = wire.encode(doc, node.wire_format)
+        self.seen.put(wire.message_id(data, doc), True)
+        return node.broadcast(data)
+
+    def broadcast_doc(self, doc: dict) -> list:
+        """Sends a broadcast dict to every node in its negotiated format"""
+        return self._send_to_nodes({}, doc)
+
+    def broadcast(self, data):
+        """
+        Sends an encoded broadcast to every node, re-encoding it for nodes
+        that negotiated a different wire format
+        """
+        return self._send_to_nodes({wire.format_of(data): data}, None)
+
+    def _send_to_nodes(self, encoded: dict, doc: Optional[dict]) -> list:
+        """
+        :param encoded: {wire format: data} already available. Filled in as
+            other formats are needed, so each format is encoded once.
+        :param doc: Decoded broadcast, if available
+        """
+        results = []
+        identified = False
+        for node in self.broadcast_nodes:
+            data = encoded.get(node.wire_format)
+            if data is None:
+                if doc is None:
+                    doc = wire.decode(next(iter(encoded.values())))
+                data = wire.encode(doc, node.wire_format)
+                encoded[node.wire_format] = data
+                if not identified:
+                    # Don't process our own message if it comes back around,
+                    # in any format
+                    self.seen.put(wire.message_id(data, doc), True)
+                    identified = True
+            results.append(node.broadcast(data))
 
-    def broadcast(self, data: str):
-        results = [node.broadcast(data) for node in self.broadcast_nodes]
         return results
 
     def package_for_broadcast(self, broadcast_type: str, data: dict) -> dict:
@@ -360,74 +1106,747 @@ class Client(object):
 
         return packaged
 
-    def receive_broadcast(self, data: str):
-        """Callback for when a broadcast is received from another node"""
+    def receive_broadcast(self, data):
+        """
+        Callback for when a broadcast is received from another node
+
+        :param data: Broadcast in any of the wire formats
+        """
+
+        started = time.perf_counter()
 
         # Parse broadcast
-        doc = json.loads(data)
+        doc = self._decode_new(data)
+        if doc is None:
+            return
+        self._dispatch(doc, data, started)
+
+    def receive_broadcasts(self, messages: Iterable,
+                           batch_size: int = INGEST_BATCH_SIZE) -> int:
+        """
+        Receives many broadcasts, e.g. a backlog replayed by a peer that
+        reconnected. Returns the number of new transactions accepted.
+
+        Messages are taken `batch_size` at a time. Transactions go through
+        the ingestion stages together: structural and duplicate checks, one
+        batched signature check, input checks, mempool insertion, and a single
+        relay of everything accepted. Other broadcasts are handled as they
+        come, after the transactions before them. Time and counts for each
+        stage are in the client's metrics.
+        """
+        messages = iter(messages)
+        received, _ = self._received_metrics(constants.B_TYPE_TRANSACTION)
+        accepted = 0
+        while True:
+            batch = list(itertools.islice(messages, batch_size))
+            if not batch:
+                return accepted
+
+            pending = []  # [(Transaction, doc, data)] not yet ingested
+            started = time.perf_counter()
+            dropped = 0
+            for data in batch:
+                try:
+                    doc = self._decode_new(data)
+                    if doc is None:
+                        dropped += 1
+                        continue
+                    if doc.get('type') != constants.B_TYPE_TRANSACTION:
+                        # Keeps the order transactions and blocks arrived in
+                        self._stage_done(STAGE_CHECK, started, 0, dropped)
+                        accepted += self._ingest_transactions(pending)
+                        pending, dropped = [], 0
+                        self._dispatch(doc, data)
+                        started = time.perf_counter()
+                        continue
+
+                    pending.append((Transaction.from_dict(doc['package']),
+                                    doc, data))
+                    received.inc()
+                except (ParseMessageError, UnknownBroadcastType, KeyError,
+                        TypeError, ValueError) as e:
+                    logger.warning('Client %s dropped a broadcast it could '
+                                   'not process: %r', self.name, e)
+                    dropped += 1
+
+            self._stage_done(STAGE_CHECK, started, 0, dropped)
+            accepted += self._ingest_transactions(pending)
+
+    def ingest_stats(self) -> dict:
+        """
+        Returns {stage: {'passed': count, 'dropped': count, 'seconds': total}}
+        for the ingestion stages
+        """
+        return {stage: {'passed': passed.value, 'dropped': dropped.value,
+                        'seconds': seconds.sum}
+                for stage, (passed, dropped, seconds)
+                in self._ingest_metrics.items()}
+
+    def _decode_new(self, data) -> Optional[dict]:
+        """
+        Decodes a message, or returns None if it was received or sent before.
+        Binary messages are checked before they're decoded. JSON ones are
+        identified by their content, so they're decoded first.
+        """
+        doc = None
+        if wire.format_of(data) != constants.FORMAT_BINARY:
+            doc = wire.decode(data)
+        if not self._first_sighting(data, doc):
+            return None
+        return wire.decode(data) if doc is None else doc
+
+    def _first_sighting(self, data, doc: dict = None) -> bool:
+        """
+        Returns whether a message is new, remembering it
+
+        :param doc: The decoded message, if it already is
+        """
+        message_id = wire.message_id(data, doc)
+        if message_id in self.seen:
+            self.duplicates += 1
+            self._duplicates.inc()
+            return False
+        self.seen.put(message_id, True)
+        return True
+
+    def _dispatch(self, doc: dict, data, started: float = None):
+        """Hands a decoded broadcast to the handler for its type"""
+        if started is None:
+            started = time.perf_counter()
 
         b_type = doc.get('type')
-        if b_type == 'transaction':
-            transaction_doc = doc.get('package')
-            transaction = Transaction.from_dict(transaction_doc)
+        if b_type == constants.B_TYPE_TRANSACTION:
+            self._receive_transaction(doc, data)
+        elif b_type == constants.B_TYPE_SOLUTION:
+            self._receive_solution(doc, data)
+        elif b_type == constants.B_TYPE_INVENTORY:
+            self._receive_inventory(doc)
+        elif b_type == constants.B_TYPE_GET_DATA:
+            self._receive_get_data(doc)
+        elif b_type in self._sync_handlers:
+            getattr(self, self._sync_handlers[b_type])(doc.get('package'))
+        else:
+            # b_type is unrecognized by the client
+            raise UnknownBroadcastType
+
+        received, seconds = self._received_metrics(b_type)
+        received.inc()
+        seconds.observe(time.perf_counter() - started)
+
+    def _received_metrics(self, b_type: str) -> tuple:
+        """Returns the received counter and time histogram for a type"""
+        received = self._receive_metrics.get(b_type)
+        if received is None:
+            received = (self._received.labels(type=b_type),
+                        self._receive_seconds.labels(type=b_type))
+            self._receive_metrics[b_type] = received
+        return received
+
+    def verify_signatures(self, transactions: List['Transaction']) \
+            -> List[bool]:
+        """Checks the signatures of transactions, recording the time taken"""
+        if not transactions:
+            return []
+
+        started = time.perf_counter()
+        if len(transactions) == 1:
+            results = [self.verifier.verify(transactions[0])]
+        else:
+            results = self.verifier.verify_many(transactions)
 
-            logger.debug('Client {} received transaction {}'.format(
-                self.name, pretty_hash(transaction.hash)))
+        each = (time.perf_counter() - started) / len(transactions)
+        for _ in transactions:
+            self._signature_seconds.observe(each)
+        self._signatures_invalid.inc(results.count(False))
+        return results
 
-            if not transaction.verify():
+    def check_header(self, block: 'Block') -> bool:
+        """
+        Checks what a block from the network commits to, before its solution
+        is: the block it builds on, and a target of at least the chain's
+        """
+        if block.prev_hash is None:
+            logger.warning('Client %s received block %s without a parent. '
+                           'Ignoring block.', self.name,
+                           PrettyHash(block.hash))
+            return False
+        if not self.blockchain.accepts_target(block):
+            logger.warning('Client %s received block %s with target %r, '
+                           'below %d. Ignoring block.', self.name,
+                           PrettyHash(block.hash), block.target,
+                           self.blockchain.target)
+            self._solutions_invalid.inc()
+            return False
+        return True
+
+    def verify_solution(self, block: 'Block') -> bool:
+        """Checks a block's solution, recording the time taken"""
+        with self._solution_seconds.time():
+            verified = block.solution is not None and block.verify()
+        if not verified:
+            self._solutions_invalid.inc()
+        return verified
+
+    def _receive_transaction(self, doc: dict, data):
+        transaction = Transaction.from_dict(doc.get('package'))
+        logger.debug('Client %s received transaction %s', self.name,
+                     PrettyHash(transaction.hash))
+        self._ingest_transactions([(transaction, doc, data)])
+
+    def _ingest_transactions(self, received: list) -> int:
+        """
+        Takes received transactions through the ingestion stages. Returns
+        how many were accepted.
+
+        :param received: [(Transaction, broadcast doc, data as received)].
+            doc and data are None for transactions that arrived in a batch.
+        """
+        if not received:
+            return 0
+        return self._admit_transactions(self._check_transactions(received))
+
+    def _check_transactions(self, received: list) -> list:
+        """
+        The check and verify stages. Returns the entries of `received` that
+        are new, well formed and correctly signed.
+        """
+        started = time.perf_counter()
+        entries = OrderedDict()  # {hash: entry}
+        for entry in received:
+            transaction = entry[0]
+            transaction_hash = transaction.hash
+            self.requested.pop(transaction_hash, None)
+            # Duplicates were verified when first seen
+            if transaction_hash not in entries and \
+                    transaction_hash not in self.mempool and \
+                    transaction.is_well_formed():
+                entries[transaction_hash] = entry
+        started = self._stage_done(STAGE_CHECK, started, len(entries),
+                                   len(received) - len(entries))
+
+        entries = list(entries.values())
+        verified = self.verify_signatures([e[0] for e in entries])
+        for entry, ok in zip(entries, verified):
+            if not ok:
                 logger.warning(
-                    'Client {} could not verify the sig of transaction {}. '
-                    'Ignoring transaction.'.format(
-                        self.name, pretty_hash(transaction.hash)))
-                return
+                    'Client %s could not verify the sig of transaction %s. '
+                    'Ignoring transaction.', self.name,
+                    PrettyHash(entry[0].hash))
+        kept = [e for e, ok in zip(entries, verified) if ok]
+        self._stage_done(STAGE_VERIFY, started, len(kept),
+                         len(entries) - len(kept))
+        return kept
+
+    def _admit_transactions(self, entries: list) -> int:
+        """
+        The inputs, mempool and relay stages, for entries that passed
+        `_check_transactions`. Returns how many were accepted.
+        """
+        started = time.perf_counter()
+        kept = self._check_inputs(entries)
+        started = self._stage_done(STAGE_INPUTS, started, len(kept),
+                                   len(entries) - len(kept))
 
-            # Propagate and save the transaction if it's new
-            if not self.current_block.has_transaction(transaction):
-                logger.debug('Client {} broadcasting transaction {}'.format(
-                    self.name, pretty_hash(transaction.hash)))
-                self.current_block.add_transaction(transaction)
-                self.broadcast(data)
-
-        elif b_type == 'solution':
-            solution_doc = doc.get('package')
-            solution = Block.from_dict(
-                solution_doc, self.current_block.transactions)
-
-            logger.debug('Client {} received solution for block {}'.format(
-                self.name, pretty_hash(solution.hash)))
-
-            # Check if solution is correct
-            if not self.blockchain.block_in_past(solution.hash):
-                verified = solution.verify()
-                if verified:
-                    logger.debug(
-                        'Client {} verified solution {} for block {}'.format(
-                            self.name, solution.solution,
-                            pretty_hash(solution.hash)))
-                    logger.debug(
-                        'Client {} broadcasting solution {} for block {}'.format(
-                            self.name, solution.solution,
-                            pretty_hash(solution.hash)))
-
-                    self.blockchain.add_next(solution)
-                    self.blockchain = solution
-
-                    self.broadcast(data)
+        accepted = [e for e in kept if self.accept_transaction(
+            e[0], None if e[2] is None else len(e[2]))]
+        started = self._stage_done(STAGE_MEMPOOL, started, len(accepted),
+                                   len(kept) - len(accepted))
+
+        self._relay_transactions(accepted)
+        self._stage_done(STAGE_RELAY, started, len(accepted), 0)
+        return len(accepted)
+
+    def _check_inputs(self, entries: list) -> list:
+        """
+        Drops transactions spending outputs that don't exist or are already
+        spent, by the chain, the mempool or an earlier transaction in
+        `entries`
+        """
+        utxos = None
+        spent = set()
+        parents = {}  # {hash: Transaction} kept so far
+        kept = []
+        for entry in entries:
+            transaction = entry[0]
+            outpoints = transaction.outpoints
+            valid = len(set(outpoints)) == len(outpoints)
+
+            for outpoint in outpoints if valid else ():
+                if outpoint in spent or \
+                        self.mempool.spender(outpoint) is not None:
+                    valid = False
+                    break
+
+                # Outputs of unconfirmed transactions can be spent too
+                parent = parents.get(outpoint[0]) or \
+                    self.mempool.get(outpoint[0])
+                if parent is not None:
+                    valid = outpoint[1] < len(parent.outputs)
                 else:
-                    logger.warning(
-                        'Client {} could not verify solution {} for block {}. '
-                        'Ignoring solution'.format(
-                            self.name, solution.solution,
-                            pretty_hash(solution.hash)))
+                    if utxos is None:
+                        utxos = self.blockchain.chain_utxos()
+                    valid = outpoint in utxos
+                if not valid:
+                    break
+
+            if valid:
+                spent.update(outpoints)
+                parents[transaction.hash] = transaction
+                kept.append(entry)
+            else:
+                logger.debug('Client %s dropped transaction %s with a spent '
+                             'or unknown input', self.name,
+                             PrettyHash(transaction.hash))
+        return kept
+
+    def _relay_transactions(self, entries: list):
+        """
+        Relays accepted transactions. One is passed on as it was received.
+        More are announced in one inventory, or sent in one transactions
+        broadcast.
+        """
+        if not entries:
+            return
+
+        transaction, doc, data = entries[0]
+        if len(entries) == 1 and doc is not None:
+            logger.debug('Client %s broadcasting transaction %s', self.name,
+                         PrettyHash(transaction.hash))
+            self.relay(doc, data)
+        elif self.relay_mode == constants.RELAY_INVENTORY:
+            self.announce([{'type': constants.B_TYPE_TRANSACTION,
+                            'hash': e[0].hash} for e in entries])
+        else:
+            # Received transactions are passed on as their docs arrived
+            self.broadcast_doc(self.package_for_broadcast(
+                constants.B_TYPE_TRANSACTIONS, {
+                    'from': self.node_id,
+                    'transactions': [e[0].to_dict() if e[1] is None
+                                     else e[1]['package'] for e in entries],
+                }))
+
+    def _stage_done(self, stage: str, started: float, passed: int,
+                    dropped: int) -> float:
+        """Records a stage of the ingestion pipeline. Returns the time now."""
+        now = time.perf_counter()
+        passed_counter, dropped_counter, seconds = self._ingest_metrics[stage]
+        passed_counter.inc(passed)
+        dropped_counter.inc(dropped)
+        seconds.observe(now - started)
+        return now
+
+    def _receive_solution(self, doc: dict, data):
+        solution_doc = doc.get('package')
+        self.requested.pop(solution_doc.get('hash'), None)
+        if solution_doc.get('hash') in self.blockchain:
+            return
+
+        # The block can only be checked once every transaction is here
+        missing = [h for h in solution_doc.get('transactions') or []
+                   if h not in self.mempool]
+        if missing:
+            logger.debug('Client %s fetching %d transactions for block %s',
+                         self.name, len(missing),
+                         PrettyHash(solution_doc['hash']))
+            self.pending_solutions[solution_doc['hash']] = (
+                doc, data, missing)
+            if len(self.pending_solutions) > MAX_PENDING_SOLUTIONS:
+                self.pending_solutions.popitem(last=False)
+            self.request_transactions(missing)
+            return
+
+        solution = self._block_from_dict(solution_doc,
+                                         self.mempool.transactions)
+        if solution is not None:
+            self._accept_solution(solution, doc, data)
 
+    def _block_from_dict(self, doc: dict, given) -> Optional['Block']:
+        """
+        Builds a block received from the network, or returns None if it
+        doesn't meet this client's chain target
+        """
+        try:
+            return Block.from_dict(doc, given, self.blockchain.target)
+        except ParseMessageError as e:
+            logger.warning('Client %s received block %s it could not parse: '
+                           '%s. Ignoring block.', self.name,
+                           PrettyHash(str(doc.get('hash'))), e)
+            self._solutions_invalid.inc()
+            return None
+
+    def _accept_solution(self, solution: 'Block', doc: dict, data):
+        logger.debug('Client %s received solution for block %s', self.name,
+                     PrettyHash(solution.hash))
+
+        # Check if solution is correct
+        if solution.hash not in self.blockchain:
+            verified = self.check_header(solution) and \
+                self.verify_solution(solution)
+            if verified:
+                logger.debug('Client %s verified solution %s for block %s',
+                             self.name, solution.solution,
+                             PrettyHash(solution.hash))
+                logger.debug('Client %s broadcasting solution %s for block %s',
+                             self.name, solution.solution,
+                             PrettyHash(solution.hash))
+
+                if not self.blockchain.append(solution) and \
+                        solution.hash in self.blockchain.orphans:
+                    # Built on blocks this client hasn't seen. Fetch them.
+                    logger.debug('Client %s missing the parent of block %s',
+                                 self.name, PrettyHash(solution.hash))
+                    if self.sync_state is None:
+                        self.sync()
+
+                self.relay(doc, data)
+            else:
+                logger.warning(
+                    'Client %s could not verify solution %s for block %s. '
+                    'Ignoring solution', self.name, solution.solution,
+                    PrettyHash(solution.hash))
+
+    def has_item(self, item: dict) -> bool:
+        """Returns whether this client has an item from an inventory"""
+        if item['type'] == constants.B_TYPE_TRANSACTION:
+            return item['hash'] in self.mempool
+        elif item['type'] == constants.B_TYPE_SOLUTION:
+            return item['hash'] in self.blockchain
+        return False
+
+    def _receive_inventory(self, doc: dict):
+        """Asks the announcing node for the items this client doesn't have"""
+        package = doc.get('package')
+        node_id = package.get('from')
+        node = self.peer(node_id)
+        if node is None:
+            return
+
+        now = time.monotonic()
+        wanted = []
+        for item in package.get('items') or []:
+            if self.has_item(item):
+                continue
+
+            request = self.requested.get(item['hash'])
+            if request is None:
+                self._add_request(InventoryRequest(item, node_id, now))
+                wanted.append(item)
+            elif node_id != request.node_id and \
+                    node_id not in request.announcers:
+                # Asked for from another node. This one is kept in case that
+                # node doesn't deliver.
+                request.announcers.append(node_id)
+
+        if wanted:
+            self._send_get_data(node, wanted)
+        self.retry_requests(now)
+
+    def retry_requests(self, now: float = None) -> int:
+        """
+        Asks again for the items that didn't arrive within `request_timeout`,
+        each from the next node that announced it. Items no other node
+        announced are forgotten, so they're asked for afresh when announced
+        again. Returns the number of items asked for again.
+
+        Called as inventories arrive. Clients that may go quiet call it
+        periodically too.
+        """
+        if now is None:
+            now = time.monotonic()
+
+        retries = OrderedDict()  # {node: [item]}
+        while self.requested:
+            item_hash, request = next(iter(self.requested.items()))
+            if now - request.sent < self.request_timeout:
+                break
+            del self.requested[item_hash]
+
+            while request.announcers:
+                node_id = request.announcers.pop(0)
+                node = self.peer(node_id)
+                if node is not None:
+                    logger.debug('Client %s asking %s for %s after %s did '
+                                 'not send it', self.name, node_id,
+                                 PrettyHash(item_hash), request.node_id)
+                    request.node_id = node_id
+                    request.sent = now
+                    self.requested[item_hash] = request
+                    retries.setdefault(node, []).append(request.item)
+                    break
+
+        for node, items in retries.items():
+            self._send_get_data(node, items)
+        return sum(len(items) for items in retries.values())
+
+    def _add_request(self, request: 'InventoryRequest'):
+        self.requested[request.item['hash']] = request
+        if len(self.requested) > self.max_requested:
+            self.requested.popitem(last=False)
+
+    def _send_get_data(self, node, items: list):
+        """Asks a node for items, forgetting the requests if sending fails"""
+        sent = self.send_to(node, self.package_for_broadcast(
+            constants.B_TYPE_GET_DATA, {'from': self.node_id, 'items': items}))
+        if sent is False:
+            for item in items:
+                self.requested.pop(item['hash'], None)
+
+    def _receive_get_data(self, doc: dict):
+        """Sends the requested items that this client has to the requester"""
+        package = doc.get('package')
+        node = self.peer(package.get('from'))
+        if node is None:
+            return
+
+        for item in package.get('items') or []:
+            if item['type'] == constants.B_TYPE_TRANSACTION:
+                found = self.mempool.get(item['hash'])
+            elif item['type'] == constants.B_TYPE_SOLUTION:
+                found = self.blockchain.get(item['hash'])
+            else:
+                found = None
+
+            if found is not None:
+                self.send_to(node, self.package_for_broadcast(
+                    item['type'], found.to_dict()))
+
+    # Broadcast types of the chain sync protocol and their handlers, which
+    # are given the package of the broadcast
+    _sync_handlers = {
+        constants.B_TYPE_GET_HEADERS: '_receive_get_headers',
+        constants.B_TYPE_HEADERS: '_receive_headers',
+        constants.B_TYPE_GET_BLOCKS: '_receive_get_blocks',
+        constants.B_TYPE_BLOCKS: '_receive_blocks',
+        constants.B_TYPE_GET_TRANSACTIONS: '_receive_get_transactions',
+        constants.B_TYPE_TRANSACTIONS: '_receive_transactions',
+    }
+
+    def sync(self, node_id: str = None, batch_size: int = MAX_BLOCKS,
+             window: int = SYNC_WINDOW) -> bool:
+        """
+        Downloads the blocks a peer has above this client's tip
+
+        The peer's height comes from a getheaders request. Blocks are then
+        requested in ranges of `batch_size`, with up to `window` requests in
+        flight, and appended in height order as they arrive. Returns False if
+        there's no peer to sync from.
+
+        :param node_id: Peer to sync from. Defaults to the first one.
+        """
+        if node_id is None:
+            node = next((n for n in self.broadcast_nodes
+                         if n.peer_id is not None), None)
         else:
-            # b_type is unrecognized by the client
-            raise UnknownBroadcastType
+            node = self.peer(node_id)
+        if node is None:
+            return False
+
+        # Headers from a little below the tip, in case the peer's chain has
+        # forked from this one
+        start = max(0, self.blockchain.height + 1 - SYNC_REORG_WINDOW)
+        self.sync_state = SyncState(node, min(batch_size, MAX_BLOCKS), window)
+        self._send_request(
+            node, constants.B_TYPE_GET_HEADERS,
+            {'start': start, 'count': MAX_HEADERS})
+        return True
+
+    def request_transactions(self, hashes: List[str]):
+        """Asks every node for the transactions with the given hashes"""
+        for start in range(0, len(hashes), MAX_TRANSACTIONS):
+            self.broadcast_doc(self.package_for_broadcast(
+                constants.B_TYPE_GET_TRANSACTIONS, {
+                    'from': self.node_id,
+                    'request': next(self._request_ids),
+                    'hashes': hashes[start:start + MAX_TRANSACTIONS],
+                }))
+
+    def _send_request(self, node, b_type: str, package: dict,
+                      request: int = None) -> int:
+        """Sends a sync request to a node. Returns its request number."""
+        if request is None:
+            request = next(self._request_ids)
+        package = dict(package, request=request)
+        package['from'] = self.node_id
+        self.send_to(node, self.package_for_broadcast(b_type, package))
+        return request
+
+    def _reply(self, package: dict, b_type: str, reply: dict):
+        """Sends a reply to the node a sync request came from"""
+        node = self.peer(package.get('from'))
+        if node is not None:
+            reply = dict(reply, request=package.get('request'))
+            reply['from'] = self.node_id
+            self.send_to(node, self.package_for_broadcast(b_type, reply))
+
+    def _receive_get_headers(self, package: dict):
+        start = package['start']
+        count = min(package['count'], MAX_HEADERS)
+        self._reply(package, constants.B_TYPE_HEADERS, {
+            'start': start,
+            'height': self.blockchain.height,
+            'headers': [b.header() for b in
+                        self.blockchain.iter_range(start, start + count)],
+        })
+
+    def _receive_get_blocks(self, package: dict):
+        start = package['start']
+        count = min(package['count'], MAX_BLOCKS)
+        blocks = list(self.blockchain.iter_range(start, start + count))
+
+        transactions = OrderedDict()
+        for block in blocks:
+            for transaction in block.transactions:
+                transactions[transaction.hash] = transaction
+
+        self._reply(package, constants.B_TYPE_BLOCKS, {
+            'start': start,
+            'blocks': [b.to_dict() for b in blocks],
+            'transactions': [t.to_dict() for t in transactions.values()],
+        })
+
+    def _receive_get_transactions(self, package: dict):
+        hashes = (package.get('hashes') or [])[:MAX_TRANSACTIONS]
+        found = {h: self.mempool.get(h) for h in hashes if h in self.mempool}
+        found.update(self.blockchain.find_transactions(
+            h for h in hashes if h not in found))
+        if found:
+            self._reply(package, constants.B_TYPE_TRANSACTIONS, {
+                'transactions': [t.to_dict() for t in found.values()],
+            })
+
+    def _receive_transactions(self, package: dict):
+        """
+        Handles replies to gettransactions, and batches of transactions
+        relayed by `receive_broadcasts`
+        """
+        entries = self._check_transactions([
+            (Transaction.from_dict(t), None, None)
+            for t in package.get('transactions') or []])
+        fetched = {e[0].hash: e[0] for e in entries}
+
+        # Solutions that now have every transaction
+        for block_hash, (doc, data, missing) in list(
+                self.pending_solutions.items()):
+            if all(h in fetched or h in self.mempool for h in missing):
+                del self.pending_solutions[block_hash]
+                given = dict(self.mempool.transactions)
+                given.update(fetched)
+                solution = self._block_from_dict(doc['package'], given)
+                if solution is not None:
+                    self._accept_solution(solution, doc, data)
+
+        # The rest are kept to mine, unless a block already confirmed them
+        confirmed = self.blockchain.find_transactions(fetched)
+        self._admit_transactions(
+            [e for e in entries if e[0].hash not in confirmed])
+
+    def _receive_headers(self, package: dict):
+        state = self.sync_state
+        if state is None or package.get('from') != state.node.peer_id:
+            return
+
+        # Skip blocks this client already has
+        start = package['start']
+        for header in package.get('headers') or []:
+            if header['hash'] not in self.blockchain:
+                break
+            start += 1
+
+        state.target = package['height']
+        state.next = state.applied = start
+        self._request_blocks(state)
+
+    def _request_blocks(self, state: 'SyncState'):
+        """Keeps the sync window full of getblocks requests"""
+        while self.sync_state is state and \
+                len(state.requests) < state.window and \
+                state.next <= state.target:
+            start = state.next
+            count = min(state.batch_size, state.target - start + 1)
+            state.next += count
+
+            # Recorded before sending, since a local node replies right away
+            request = next(self._request_ids)
+            state.requests[request] = start
+            self._send_request(state.node, constants.B_TYPE_GET_BLOCKS,
+                               {'start': start, 'count': count}, request)
+
+        if self.sync_state is state and not state.requests:
+            logger.debug('Client %s synced to height %d', self.name,
+                         self.blockchain.height)
+            self.sync_state = None
+
+    def _receive_blocks(self, package: dict):
+        state = self.sync_state
+        if state is None or package.get('request') not in state.requests:
+            return
+        del state.requests[package['request']]
+
+        # Every signature in the batch is checked at once
+        transactions = [Transaction.from_dict(t)
+                        for t in package.get('transactions') or []]
+        verified = self.verify_signatures(transactions)
+        given = {t.hash: t for t, ok in zip(transactions, verified) if ok}
+
+        for i, block_doc in enumerate(package.get('blocks') or []):
+            block = self._block_from_dict(block_doc, given)
+            if block is None or len(block.transactions) != \
+                    len(block_doc.get('transactions') or []) or \
+                    not self.check_header(block) or \
+                    not self.verify_solution(block):
+                logger.warning(
+                    'Client %s could not verify synced block %s. Stopping '
+                    'sync', self.name, PrettyHash(str(block_doc.get('hash'))))
+                self.sync_state = None
+                return
+            state.blocks[package['start'] + i] = block
+
+        # Add whatever now follows on from the blocks added so far. They may
+        # start a branch, which becomes the main chain once it has more work.
+        while state.applied in state.blocks:
+            self.blockchain.append(state.blocks.pop(state.applied))
+            state.applied += 1
+
+        self._request_blocks(state)
+
+
+class InventoryRequest(object):
+    """An item asked for with getdata and not received yet"""
+
+    __slots__ = ('item', 'node_id', 'sent', 'announcers')
+
+    def __init__(self, item: dict, node_id: str, sent: float):
+        self.item = item
+        # Node asked for the item, and the time.monotonic() it was asked at
+        self.node_id = node_id
+        self.sent = sent
+        # Other nodes that announced the item, in the order they did
+        self.announcers = []
+
+
+class SyncState(object):
+    """Progress of a client downloading blocks from a peer"""
+
+    def __init__(self, node, batch_size: int, window: int):
+        self.node = node
+        self.batch_size = batch_size
+        self.window = window
+
+        # Peer's tip height, the next height to request, and the next height
+        # to add to the chain
+        self.target = -1
+        self.next = 0
+        self.applied = 0
+
+        self.requests = {}  # {request number: start height} in flight
+        self.blocks = {}  # {height: Block} received out of order
 
 
 def main():
-    blockchain1 = Block()
-    blockchain2 = Block()
+    configure_logging()
+
+    blockchain1 = Block.genesis()
+    blockchain2 = Block.genesis()
 
     client1 = Client(name='client1', blockchain=blockchain1)
     broadcast_node_1 = LocalBroadcastNode(client1)
@@ -448,7 +1867,7 @@ def main():
 
     print('Block mined! Puzzle solution: {}'.format(solution))
     print('Gen transaction hash: {}'.format(
-        pretty_hash(client2.current_block.gen_transaction.hash)))
+        pretty_hash(client2.blockchain.tip.gen_transaction.hash)))
 
     print('Client1 has {} coins'.format(client1.total_value()))
     print('Client2 has {} coins'.format(client2.total_value()))
@@ -456,10 +1875,6 @@ def main():
     print('Client1 thinks Client2 has {} coins'.format(client1.total_value(client2.addresses)))
     print('Client2 thinks Client1 has {} coins'.format(client2.total_value(client1.addresses)))
 
-    import pdb
-
-    pdb.set_trace()
-
 
 if __name__ == '__main__':
     sys.exit(main())
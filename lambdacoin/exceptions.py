@@ -10,3 +10,13 @@ class UnknownBroadcastType(BroadcastError):
 # Message Parsing Exceptions
 class ParseMessageError(Exception):
     pass
+
+
+# Snapshot Exceptions
+class SnapshotError(Exception):
+    pass
+
+
+# Mining Exceptions
+class MiningError(Exception):
+    pass
@@ -0,0 +1,137 @@
+"""
+Sources of RSA keys for clients
+
+Generating a 1024 bit key takes tens to hundreds of milliseconds, so clients
+don't make one until they sign something. To skip generation altogether:
+
+* `KeyStore` keeps keys as PEM files in a directory, so a node keeps its key
+  across restarts
+* `KeyPool` generates keys on a background thread ahead of time, for tests
+  and simulations that start many clients
+"""
+
+import os
+import queue
+import threading
+import time
+from typing import List
+
+from Crypto.PublicKey import RSA
+
+KEY_SIZE = 1024
+
+KEY_FILE = '{}.pem'
+
+# Number of keys a KeyPool keeps ready
+DEFAULT_POOL_SIZE = 16
+
+
+def generate_key(bits: int = KEY_SIZE) -> 'RSA._RSAobj':
+    return RSA.generate(bits)
+
+
+class KeyStore(object):
+    def __init__(self, path: str):
+        """:param path: Directory to keep keys in. Created if missing."""
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+
+    def __contains__(self, name: str) -> bool:
+        return os.path.exists(self._key_path(name))
+
+    def names(self) -> List[str]:
+        """Returns the names of the stored keys"""
+        suffix = KEY_FILE.format('')
+        return sorted(f[:-len(suffix)] for f in os.listdir(self.path)
+                      if f.endswith(suffix))
+
+    def load(self, name: str) -> 'RSA._RSAobj':
+        """Loads a key. Raises KeyError if there's no key by that name."""
+        try:
+            with open(self._key_path(name), 'rb') as f:
+                return RSA.importKey(f.read())
+        except FileNotFoundError:
+            raise KeyError(name)
+
+    def save(self, name: str, key: 'RSA._RSAobj'):
+        """Writes a key, readable only by the current user"""
+        path = self._key_path(name)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(key.exportKey())
+
+    def get_or_create(self, name: str, bits: int = KEY_SIZE) \
+            -> 'RSA._RSAobj':
+        """Loads a key, generating and saving it first if it's missing"""
+        try:
+            return self.load(name)
+        except KeyError:
+            key = generate_key(bits)
+            self.save(name, key)
+            return key
+
+    def _key_path(self, name: str) -> str:
+        if not name or os.sep in name or name.startswith('.'):
+            raise ValueError('Invalid key name {!r}'.format(name))
+        return os.path.join(self.path, KEY_FILE.format(name))
+
+
+class KeyPool(object):
+    """
+    Keys generated in the background, ready to hand out
+
+    Pass `pool.get` as a client's `key_factory`. When the pool is empty,
+    `get` generates a key itself rather than waiting.
+    """
+
+    def __init__(self, size: int = DEFAULT_POOL_SIZE, bits: int = KEY_SIZE):
+        self.bits = bits
+        self.keys = queue.Queue(size)
+        self.generated = 0
+        self.misses = 0
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._fill, name='key-pool', daemon=True)
+        self._thread.start()
+
+    def __len__(self):
+        return self.keys.qsize()
+
+    def get(self) -> 'RSA._RSAobj':
+        try:
+            return self.keys.get_nowait()
+        except queue.Empty:
+            self.misses += 1
+            return generate_key(self.bits)
+
+    def wait(self, count: int = None, timeout: float = None) -> bool:
+        """
+        Waits until `count` keys, by default a full pool, are ready. Returns
+        False if that took longer than `timeout` seconds.
+        """
+        if count is None:
+            count = self.keys.maxsize
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while len(self) < count:
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            self._stop.wait(0.01)
+        return True
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _fill(self):
+        key = None
+        while not self._stop.is_set():
+            if key is None:
+                key = generate_key(self.bits)
+                self.generated += 1
+            try:
+                self.keys.put(key, timeout=0.1)
+                key = None
+            except queue.Full:
+                pass
@@ -0,0 +1,167 @@
+"""
+Pool of transactions waiting to be confirmed
+
+Transactions are kept in the order they arrived so block templates can be
+built from them. The pool can be limited by number of transactions and by
+their total size in bytes. When a limit would be exceeded, the eviction policy
+decides whether the oldest transactions make room or the new one is turned
+away.
+
+The pool also indexes the outputs its transactions spend, so a transaction
+trying to spend one of them again can be spotted without a scan, and the
+transactions spending a pool transaction's outputs can be found with it.
+Those descendants are evicted along with their ancestor, since they can't be
+mined without it.
+"""
+
+from collections import OrderedDict
+from typing import Iterable, Iterator, Optional
+
+# Eviction policies
+EVICT_OLDEST = 'oldest'
+REJECT_NEW = 'reject'
+
+
+class Mempool(object):
+    def __init__(self, max_count: int = None, max_bytes: int = None,
+                 eviction: str = EVICT_OLDEST):
+        if eviction not in (EVICT_OLDEST, REJECT_NEW):
+            raise ValueError('Unknown eviction policy {}'.format(eviction))
+
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.eviction = eviction
+
+        self.transactions = OrderedDict()  # {hash: Transaction}
+        self.sizes = {}  # {hash: size in bytes}
+        self.bytes = 0
+        self.spends = {}  # {(hash, n) spent: hash of the spending transaction}
+
+        # Number of transactions evicted to make room for new ones
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.transactions)
+
+    def __contains__(self, transaction_hash: str) -> bool:
+        return transaction_hash in self.transactions
+
+    def __iter__(self) -> Iterator['Transaction']:
+        return iter(self.transactions.values())
+
+    def get(self, transaction_hash: str) -> Optional['Transaction']:
+        return self.transactions.get(transaction_hash)
+
+    def spender(self, outpoint) -> Optional[str]:
+        """Returns the hash of the transaction spending an output, if any"""
+        return self.spends.get(outpoint)
+
+    def add(self, transaction: 'Transaction', size: int = None) -> bool:
+        """
+        Adds a transaction to the pool
+
+        Returns False if the transaction was already in the pool or there was
+        no room for it.
+
+        :param size: Size of the transaction in bytes. Computed from the
+            transaction if not given.
+        """
+        transaction_hash = transaction.hash
+        if transaction_hash in self.transactions:
+            return False
+
+        if size is None:
+            size = transaction.size()
+
+        if not self._make_room(transaction, size):
+            return False
+
+        self.transactions[transaction_hash] = transaction
+        self.sizes[transaction_hash] = size
+        self.bytes += size
+        for outpoint in transaction.outpoints:
+            self.spends[outpoint] = transaction_hash
+        return True
+
+    def remove(self, transaction_hash: str) -> Optional['Transaction']:
+        transaction = self.transactions.pop(transaction_hash, None)
+        if transaction is not None:
+            self.bytes -= self.sizes.pop(transaction_hash)
+            for outpoint in transaction.outpoints:
+                if self.spends.get(outpoint) == transaction_hash:
+                    del self.spends[outpoint]
+        return transaction
+
+    def children(self, transaction: 'Transaction') -> list:
+        """Returns the hashes of the pool transactions spending its outputs"""
+        transaction_hash = transaction.hash
+        spenders = (self.spends.get((transaction_hash, n))
+                    for n in range(len(transaction.outputs)))
+        return [h for h in spenders if h is not None]
+
+    def remove_with_descendants(self, transaction_hash: str) -> list:
+        """
+        Removes a transaction and every pool transaction spending its outputs,
+        directly or further down. Returns the removed transactions.
+        """
+        removed = []
+        stack = [transaction_hash]
+        while stack:
+            transaction = self.remove(stack.pop())
+            if transaction is not None:
+                removed.append(transaction)
+                stack.extend(self.children(transaction))
+        return removed
+
+    def ancestors(self, transaction: 'Transaction') -> set:
+        """Returns the hashes of the pool transactions it spends from"""
+        found = set()
+        stack = [transaction]
+        while stack:
+            for parent_hash, _ in stack.pop().outpoints:
+                parent = self.transactions.get(parent_hash)
+                if parent is not None and parent_hash not in found:
+                    found.add(parent_hash)
+                    stack.append(parent)
+        return found
+
+    def remove_many(self, transaction_hashes: Iterable[str]) -> int:
+        """
+        Removes every given transaction that is in the pool, e.g. once a block
+        containing them has been accepted. Returns how many were removed.
+        """
+        removed = 0
+        for transaction_hash in transaction_hashes:
+            if self.remove(transaction_hash) is not None:
+                removed += 1
+        return removed
+
+    def _fits(self, extra_count: int, extra_bytes: int) -> bool:
+        if self.max_count is not None and \
+                len(self.transactions) + extra_count > self.max_count:
+            return False
+        if self.max_bytes is not None and \
+                self.bytes + extra_bytes > self.max_bytes:
+            return False
+        return True
+
+    def _make_room(self, transaction: 'Transaction', size: int) -> bool:
+        if self._fits(1, size):
+            return True
+
+        # A transaction that could never fit doesn't get to empty the pool
+        if self.eviction == REJECT_NEW or \
+                (self.max_count is not None and self.max_count < 1) or \
+                (self.max_bytes is not None and size > self.max_bytes):
+            return False
+
+        # The new transaction's own ancestors stay, or it couldn't be mined
+        keep = self.ancestors(transaction)
+        while not self._fits(1, size):
+            oldest_hash = next(
+                (h for h in self.transactions if h not in keep), None)
+            if oldest_hash is None:
+                return False
+            self.evictions += len(self.remove_with_descendants(oldest_hash))
+
+        return True
@@ -0,0 +1,153 @@
+"""
+Merkle trees over block transactions
+
+A block's proof-of-work puzzle is the root of a Merkle tree of its
+transaction hashes, so the puzzle stays the same size however many
+transactions the block holds. Each transaction can be shown to be in a block
+with a proof of O(log n) hashes, checked against the root alone.
+
+Leaves and interior nodes are hashed with different prefixes, so a leaf
+can't be passed off as an interior node. A node without a sibling is carried
+up to the next level unchanged rather than paired with a copy of itself, so
+two different lists of transactions can't give the same root.
+"""
+
+import hashlib
+from typing import Iterable, List, Optional
+
+import lambdacoin.constants as constants
+
+LEAF_PREFIX = b'\x00'
+NODE_PREFIX = b'\x01'
+
+# Sides of a sibling in a proof step
+LEFT = 'L'
+RIGHT = 'R'
+
+# Root of a tree without leaves
+EMPTY_ROOT = hashlib.sha1(b'').hexdigest()
+
+
+def leaf_hash(transaction_hash: str) -> bytes:
+    return hashlib.sha1(LEAF_PREFIX + _digest(transaction_hash)).digest()
+
+
+def node_hash(left: bytes, right: bytes) -> bytes:
+    return hashlib.sha1(NODE_PREFIX + left + right).digest()
+
+
+def _digest(transaction_hash) -> bytes:
+    """
+    Transaction hashes are hex digests, or already the digest bytes. Anything
+    else is used as text.
+    """
+    if isinstance(transaction_hash, bytes):
+        return transaction_hash
+    if len(transaction_hash) == 40:
+        try:
+            return bytes.fromhex(transaction_hash)
+        except ValueError:
+            pass
+    return transaction_hash.encode(constants.STRING_ENCODING)
+
+
+class MerkleTree(object):
+    def __init__(self, transaction_hashes: Iterable[str] = ()):
+        # Node hashes of each level, leaves first. The last level holds the
+        # root once there are any leaves.
+        self.levels = [[]]
+        # {leaf hash: leaf index}, only built once a proof is asked for. Most
+        # trees are only needed for their root.
+        self._positions = None
+
+        for transaction_hash in transaction_hashes:
+            self.append(transaction_hash)
+
+    def __len__(self):
+        return len(self.levels[0])
+
+    def __contains__(self, transaction_hash: str) -> bool:
+        return leaf_hash(transaction_hash) in self.positions
+
+    @property
+    def positions(self) -> dict:
+        if self._positions is None:
+            self._positions = {
+                leaf: index for index, leaf in enumerate(self.levels[0])}
+        return self._positions
+
+    @property
+    def root(self) -> str:
+        """Hex root of the tree"""
+        if not self.levels[0]:
+            return EMPTY_ROOT
+        return self.levels[-1][0].hex()
+
+    def append(self, transaction_hash: str):
+        """
+        Adds a leaf, updating the nodes above it. Only the rightmost path
+        changes, so this takes O(log n) hashes.
+        """
+        leaf = leaf_hash(transaction_hash)
+        if self._positions is not None:
+            self._positions[leaf] = len(self.levels[0])
+        self.levels[0].append(leaf)
+
+        index = len(self.levels[0]) - 1
+        level = 0
+        while len(self.levels[level]) > 1:
+            nodes = self.levels[level]
+            parent = index // 2
+            left = 2 * parent
+            if left + 1 < len(nodes):
+                value = node_hash(nodes[left], nodes[left + 1])
+            else:
+                value = nodes[left]
+
+            if level + 1 == len(self.levels):
+                self.levels.append([])
+            above = self.levels[level + 1]
+            if parent < len(above):
+                above[parent] = value
+            else:
+                above.append(value)
+
+            index = parent
+            level += 1
+
+    def proof(self, transaction_hash: str) -> Optional[List[list]]:
+        """
+        Returns the proof that a transaction is in the tree, as a list of
+        [side, sibling hash in hex] from the leaf up, or None if it isn't in
+        the tree
+        """
+        index = self.positions.get(leaf_hash(transaction_hash))
+        if index is None:
+            return None
+
+        steps = []
+        for nodes in self.levels[:-1]:
+            sibling = index ^ 1
+            if sibling < len(nodes):
+                side = LEFT if sibling < index else RIGHT
+                steps.append([side, nodes[sibling].hex()])
+            index //= 2
+        return steps
+
+
+def verify_proof(transaction_hash: str, proof: List[list], root: str) -> bool:
+    """Returns whether a proof from `MerkleTree.proof` leads to `root`"""
+    value = leaf_hash(transaction_hash)
+    try:
+        for side, sibling in proof:
+            sibling = bytes.fromhex(sibling)
+            if side == LEFT:
+                value = node_hash(sibling, value)
+            elif side == RIGHT:
+                value = node_hash(value, sibling)
+            else:
+                return False
+    except (TypeError, ValueError):
+        return False
+
+    return value.hex() == root
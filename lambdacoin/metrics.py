@@ -0,0 +1,268 @@
+"""
+Counters, gauges and latency histograms for a node
+
+Each `Client` records into its own `Registry`, available as
+`client.metrics`. `Registry.snapshot` returns every value as a dict, and
+`Registry.to_prometheus` renders them in the Prometheus text exposition
+format.
+
+Metrics can have labels, e.g. the broadcast type of received messages:
+
+    received = registry.counter('broadcasts_received_total',
+                                'Broadcasts received', ['type'])
+    received.labels(type='transaction').inc()
+
+    with registry.histogram('verify_seconds', 'Verification time').time():
+        ...
+"""
+
+import bisect
+import math
+import time
+from typing import Callable, Dict, Iterable, List, Tuple
+
+# Upper bounds in seconds of the buckets of latency histograms
+DEFAULT_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01,
+                   0.05, 0.1, 0.5, 1.0, 5.0)
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+
+class _Timer(object):
+    """Context manager observing the seconds spent in its block"""
+
+    def __init__(self, histogram: 'Histogram'):
+        self.histogram = histogram
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started)
+
+
+class _Metric(object):
+    kind = None
+
+    def __init__(self, name: str, description: str,
+                 labels: Iterable[str] = ()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(labels)
+        self._children = {}  # {label values: metric}
+
+    def labels(self, **values) -> '_Metric':
+        """Returns the metric for the given label values"""
+        key = tuple(str(values[name]) for name in self.label_names)
+        child = self._children.get(key)
+        if child is None:
+            child = self._new_child()
+            self._children[key] = child
+        return child
+
+    def _new_child(self) -> '_Metric':
+        return type(self)(self.name, self.description)
+
+    def samples(self) -> List[Tuple[Dict[str, str], '_Metric']]:
+        """Returns (labels, metric) for this metric and each labelled one"""
+        if not self.label_names:
+            return [({}, self)]
+        return [(dict(zip(self.label_names, key)), child)
+                for key, child in sorted(self._children.items())]
+
+
+class Counter(_Metric):
+    kind = COUNTER
+
+    def __init__(self, name: str, description: str,
+                 labels: Iterable[str] = ()):
+        super().__init__(name, description, labels)
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge(_Metric):
+    kind = GAUGE
+
+    def __init__(self, name: str, description: str,
+                 labels: Iterable[str] = ()):
+        super().__init__(name, description, labels)
+        self._value = 0
+        self._function = None
+
+    @property
+    def value(self) -> float:
+        if self._function is not None:
+            return self._function()
+        return self._value
+
+    def set(self, value: float):
+        self._value = value
+
+    def inc(self, amount: float = 1):
+        self._value += amount
+
+    def dec(self, amount: float = 1):
+        self._value -= amount
+
+    def set_function(self, function: Callable[[], float]):
+        """Reads the value from `function` whenever it's needed"""
+        self._function = function
+
+    def snapshot(self):
+        return self.value
+
+
+class Histogram(_Metric):
+    kind = HISTOGRAM
+
+    def __init__(self, name: str, description: str,
+                 labels: Iterable[str] = (),
+                 buckets: Iterable[float] = DEFAULT_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets))
+        # Observations in each bucket, and above the last one
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def _new_child(self) -> 'Histogram':
+        return Histogram(self.name, self.description, buckets=self.buckets)
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def time(self) -> _Timer:
+        """Returns a context manager that observes the time it's open"""
+        return _Timer(self)
+
+    def quantile(self, q: float) -> float:
+        """
+        Estimates a quantile as the upper bound of the bucket it falls in.
+        Returns infinity if it's above every bucket and NaN if there are no
+        observations.
+        """
+        if not self.count:
+            return math.nan
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return math.inf
+
+    def snapshot(self) -> dict:
+        def finite(value):
+            return value if math.isfinite(value) else None
+
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'buckets': {repr(b): c for b, c in zip(self.buckets, self.counts)},
+            'p50': finite(self.quantile(0.5)),
+            'p99': finite(self.quantile(0.99)),
+        }
+
+
+class Registry(object):
+    def __init__(self, prefix: str = 'lambdacoin_'):
+        """:param prefix: Added to the name of every metric"""
+        self.prefix = prefix
+        self.metrics = {}  # {name: metric}
+
+    def counter(self, name: str, description: str,
+                labels: Iterable[str] = ()) -> Counter:
+        return self._get(Counter, name, description, labels)
+
+    def gauge(self, name: str, description: str,
+              labels: Iterable[str] = ()) -> Gauge:
+        return self._get(Gauge, name, description, labels)
+
+    def histogram(self, name: str, description: str,
+                  labels: Iterable[str] = (),
+                  buckets: Iterable[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._get(Histogram, name, description, labels,
+                         buckets=buckets)
+
+    def _get(self, metric_class, name: str, description: str,
+             labels: Iterable[str], **kwargs) -> _Metric:
+        """Returns the metric by this name, creating it on first use"""
+        name = self.prefix + name
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = metric_class(name, description, labels, **kwargs)
+            self.metrics[name] = metric
+        elif not isinstance(metric, metric_class):
+            raise ValueError('{} is already a {}'.format(name, metric.kind))
+        return metric
+
+    def snapshot(self) -> dict:
+        """
+        Returns {name: value} for unlabelled metrics, and
+        {name: {label values joined by ',': value}} for labelled ones
+        """
+        snapshot = {}
+        for name, metric in sorted(self.metrics.items()):
+            if not metric.label_names:
+                snapshot[name] = metric.snapshot()
+            else:
+                snapshot[name] = {
+                    ','.join(labels.values()): child.snapshot()
+                    for labels, child in metric.samples()}
+        return snapshot
+
+    def to_prometheus(self) -> str:
+        """Returns every metric in the Prometheus text format"""
+        lines = []
+        for name, metric in sorted(self.metrics.items()):
+            lines.append('# HELP {} {}'.format(name, metric.description))
+            lines.append('# TYPE {} {}'.format(name, metric.kind))
+
+            for labels, child in metric.samples():
+                if metric.kind != HISTOGRAM:
+                    lines.append(_sample(name, labels, child.value))
+                    continue
+
+                cumulative = 0
+                for bound, count in zip(child.buckets, child.counts):
+                    cumulative += count
+                    lines.append(_sample(name + '_bucket',
+                                         dict(labels, le=repr(bound)),
+                                         cumulative))
+                lines.append(_sample(name + '_bucket',
+                                     dict(labels, le='+Inf'), child.count))
+                lines.append(_sample(name + '_sum', labels, child.sum))
+                lines.append(_sample(name + '_count', labels, child.count))
+
+        return '\n'.join(lines) + '\n'
+
+
+def _sample(name: str, labels: Dict[str, str], value: float) -> str:
+    if labels:
+        name += '{{{}}}'.format(','.join(
+            '{}="{}"'.format(k, _escape(v)) for k, v in labels.items()))
+    return '{} {}'.format(name, _format_value(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _format_value(value: float) -> str:
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(value)
@@ -0,0 +1,321 @@
+"""
+Proof of work search over a block's puzzle
+
+A `Miner` walks a range of nonces looking for one whose hash satisfies the
+block's target. With more than one process the range is dealt out in chunks to
+worker processes, and every worker stops as soon as any of them finds a
+solution.
+
+A `MiningScheduler` keeps a client mining in the background, in rounds of
+nonces, moving to the new tip whenever it changes.
+"""
+
+import asyncio
+import multiprocessing
+import queue
+import time
+from typing import Optional, Tuple
+
+from Crypto.Hash import SHA
+
+import lambdacoin.constants as constants
+from lambdacoin.exceptions import MiningError
+from lambdacoin.utils import DIGEST_SIZE, meets_target
+
+# Number of nonces a worker tries between checks for a found solution
+CHUNK_SIZE = 1000
+
+# Seconds to wait for a worker's result before checking the workers are alive
+WORKER_POLL_INTERVAL = 0.5
+
+# Nonces tried per round by a `MiningScheduler`
+ROUND_SIZE = 100000
+
+# Seconds a `MiningScheduler` mines a block before picking up transactions
+# that arrived since
+REFRESH_INTERVAL = 5.0
+
+# Outcomes of a mining round
+ROUND_SOLVED = 'solved'
+ROUND_SEARCHED = 'searched'  # Nothing found, the next round goes on
+ROUND_STALE = 'stale'  # The tip changed during the round
+
+
+def search(puzzle: str, target: int, start: int, end: int,
+           stop=None) -> Tuple[Optional[str], int]:
+    """
+    Tries every nonce in [start, end) against the puzzle
+
+    Returns the first nonce that satisfies `target` (or None) along with the
+    number of hashes that were computed. If `stop` is given, the search gives
+    up as soon as it is set.
+
+    The puzzle is hashed once and that state is copied for every nonce, so the
+    cost per nonce doesn't depend on the size of the puzzle.
+    """
+    if target > 2 * DIGEST_SIZE:
+        return None, 0
+
+    midstate = SHA.new(puzzle.encode(constants.STRING_ENCODING))
+    meets = meets_target  # Local name, looked up faster in the loop
+    hashes = 0
+
+    for x in range(start, end):
+        if stop is not None and hashes % CHUNK_SIZE == 0 and stop.is_set():
+            break
+
+        hashes += 1
+        h = midstate.copy()
+        h.update(b'%d' % x)
+        if meets(h.digest(), target):
+            return str(x), hashes
+
+    return None, hashes
+
+
+def _worker(puzzle, target, start, end, offset, step, chunk_size, stop,
+            results):
+    """
+    Searches every `step`th chunk of the nonce range, beginning at `offset`
+
+    Puts a single (solution, hashes) tuple on `results` when done.
+    """
+    hashes = 0
+
+    for chunk_start in range(start + offset, end, step):
+        if stop.is_set():
+            break
+
+        chunk_end = min(chunk_start + chunk_size, end)
+        solution, chunk_hashes = search(
+            puzzle, target, chunk_start, chunk_end, stop)
+        hashes += chunk_hashes
+
+        if solution is not None:
+            stop.set()
+            results.put((solution, hashes))
+            return
+
+    results.put((None, hashes))
+
+
+class Miner(object):
+    """
+    Searches for proof of work solutions using one or more processes
+
+    After every call to `mine`, `hashes` and `elapsed` hold the totals across
+    all workers for that run.
+    """
+
+    def __init__(self, processes: int = 1, chunk_size: int = CHUNK_SIZE):
+        self.processes = max(1, processes)
+        self.chunk_size = chunk_size
+
+        self.hashes = 0
+        self.elapsed = 0.0
+
+    @property
+    def hashrate(self) -> float:
+        """Hashes per second over the last run"""
+        if self.elapsed <= 0:
+            return 0.0
+        return self.hashes / self.elapsed
+
+    def mine(self, puzzle: str, target: int, start: int = 0,
+             end: int = 2000, stop=None) -> Optional[str]:
+        """
+        :param stop: multiprocessing.Event that interrupts the search when
+            set, e.g. from another thread
+        """
+        started = time.perf_counter()
+
+        if self.processes == 1 or end - start <= self.chunk_size:
+            solution, self.hashes = search(puzzle, target, start, end, stop)
+        else:
+            solution, self.hashes = self._mine_parallel(
+                puzzle, target, start, end, stop)
+
+        self.elapsed = time.perf_counter() - started
+        return solution
+
+    def _mine_parallel(self, puzzle, target, start, end, stop=None):
+        if stop is None:
+            stop = multiprocessing.Event()
+        results = multiprocessing.Queue()
+        step = self.chunk_size * self.processes
+
+        workers = [
+            multiprocessing.Process(
+                target=_worker,
+                args=(puzzle, target, start, end, i * self.chunk_size, step,
+                      self.chunk_size, stop, results),
+                daemon=True)
+            for i in range(self.processes)
+        ]
+        for worker in workers:
+            worker.start()
+
+        # Every worker reports exactly once, whether or not it found anything,
+        # unless it dies first
+        solution = None
+        hashes = 0
+        reported = 0
+        while reported < len(workers):
+            try:
+                worker_solution, worker_hashes = results.get(
+                    timeout=WORKER_POLL_INTERVAL)
+            except queue.Empty:
+                dead = [w for w in workers if w.exitcode not in (None, 0)]
+                if dead:
+                    stop.set()
+                    for worker in workers:
+                        worker.terminate()
+                        worker.join()
+                    raise MiningError('Mining process {} exited with {}'
+                                      .format(dead[0].pid, dead[0].exitcode))
+                continue
+
+            reported += 1
+            hashes += worker_hashes
+            if solution is None and worker_solution is not None:
+                solution = worker_solution
+
+        for worker in workers:
+            worker.join()
+
+        return solution, hashes
+
+
+class MiningScheduler(object):
+    """
+    Mines a client's blocks in the background, following its tip
+
+        scheduler = client.schedule_mining()
+        await asyncio.gather(client.receive_loop(), scheduler.run())
+
+    The search runs on an executor a round of `round_size` nonces at a time,
+    so broadcasts keep being received in between. Each round tries the next
+    nonces of a block template, a copy of the client's current block that
+    later transactions don't change. Nonces are unbounded decimal strs, so
+    the search never runs out on a template.
+
+    A new tip interrupts the round in flight, and its hashes are counted as
+    stale. Every `refresh_interval` seconds the template is replaced if the
+    mempool has changed the current block, starting its nonces over.
+    """
+
+    def __init__(self, client: 'Client', round_size: int = ROUND_SIZE,
+                 refresh_interval: float = REFRESH_INTERVAL, executor=None):
+        """
+        :param executor: concurrent.futures executor to run rounds on.
+            Defaults to the event loop's. Mining itself uses `client.miner`.
+        """
+        self.client = client
+        self.round_size = round_size
+        self.refresh_interval = refresh_interval
+        self.executor = executor
+
+        self.template = None  # Block being mined
+        self.template_started = 0.0
+        self.next_nonce = 0
+        self._stop = None  # Interrupts the round in flight
+
+        self.rounds = 0
+        self.hashes = 0
+        self.seconds = 0.0  # Spent hashing
+        self.stale_rounds = 0
+        self.stale_hashes = 0
+        self.refreshes = 0
+        self.blocks = 0
+
+        rounds = client.metrics.counter(
+            'mining_rounds_total', 'Mining rounds, by outcome', ['outcome'])
+        self._rounds = {outcome: rounds.labels(outcome=outcome)
+                        for outcome in (ROUND_SOLVED, ROUND_SEARCHED,
+                                        ROUND_STALE)}
+        self._stale_hashes = client.metrics.counter(
+            'mining_stale_hashes_total',
+            'Nonces tried on blocks the tip moved past')
+
+    @property
+    def hashrate(self) -> float:
+        """Hashes per second over every round so far"""
+        if self.seconds <= 0:
+            return 0.0
+        return self.hashes / self.seconds
+
+    def stats(self) -> dict:
+        return {
+            'rounds': self.rounds,
+            'hashes': self.hashes,
+            'hashrate': self.hashrate,
+            'stale_rounds': self.stale_rounds,
+            'stale_hashes': self.stale_hashes,
+            'refreshes': self.refreshes,
+            'blocks': self.blocks,
+        }
+
+    def restart(self):
+        """
+        Drops the template, interrupting the round in flight. The client
+        calls this when its tip changes.
+        """
+        self.template = None
+        if self._stop is not None:
+            self._stop.set()
+
+    async def run(self, blocks: int = None):
+        """Mines until cancelled or, if given, `blocks` blocks are mined"""
+        loop = asyncio.get_running_loop()
+        while blocks is None or self.blocks < blocks:
+            template = self._current_template()
+            start = self.next_nonce
+            self.next_nonce += self.round_size
+
+            self._stop = stop = multiprocessing.Event()
+            try:
+                solution = await loop.run_in_executor(
+                    self.executor, self.client.mine, template, start,
+                    start + self.round_size, stop)
+            except asyncio.CancelledError:
+                stop.set()
+                raise
+            finally:
+                self._stop = None
+
+            self._finish_round(template, solution)
+
+    def _current_template(self) -> 'Block':
+        client = self.client
+        now = time.monotonic()
+        if self.template is not None and \
+                now - self.template_started >= self.refresh_interval and \
+                client.current_block.puzzle != self.template.puzzle:
+            self.template = None
+            self.refreshes += 1
+
+        if self.template is None:
+            self.template = client.block_template()
+            self.template_started = now
+            self.next_nonce = 0
+        return self.template
+
+    def _finish_round(self, template: 'Block', solution: Optional[str]):
+        miner = self.client.miner
+        self.rounds += 1
+        self.hashes += miner.hashes
+        self.seconds += miner.elapsed
+
+        if template is not self.template:
+            outcome = ROUND_STALE
+            self.stale_rounds += 1
+            self.stale_hashes += miner.hashes
+            self._stale_hashes.inc(miner.hashes)
+        elif solution is not None:
+            outcome = ROUND_SOLVED
+            self.blocks += 1
+            self.template = None
+            self.client.submit_solution(template, solution)
+        else:
+            outcome = ROUND_SEARCHED
+        self._rounds[outcome].inc()
@@ -0,0 +1,153 @@
+"""
+Profiling a node
+
+`profile_call` runs a function under cProfile or under `Sampler`, and
+writes a report of the hottest functions.
+
+cProfile traces every call in the thread it was started in. That's exact
+but slows small functions down far more than large ones. `Sampler` instead
+looks at the stack of every thread at a fixed interval. Its overhead doesn't
+depend on the number of calls, so the proportions stay close to an unprofiled
+run, and it sees work done on other threads, such as background mining.
+
+Sampled time includes time spent waiting. A thread blocked in a select or a
+lock shows up under the function that waits.
+"""
+
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+from collections import Counter
+from typing import Callable, TextIO
+
+# Seconds between samples
+SAMPLE_INTERVAL = 0.001
+
+# Functions listed in a report
+REPORT_TOP = 25
+
+
+def _label(key: tuple) -> str:
+    filename, line, name = key
+    return '{}:{}({})'.format(os.path.basename(filename), line, name)
+
+
+class Sampler(object):
+    """
+    Samples the stacks of every other thread while running
+
+        with Sampler() as sampler:
+            ...
+        print(sampler.report())
+    """
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        self.interval = interval
+
+        self.samples = 0  # Thread stacks looked at
+        self.own = Counter()  # {(file, line, function): samples on top}
+        self.total = Counter()  # {(file, line, function): samples on stack}
+        self.stacks = Counter()  # {stack from the outermost frame: samples}
+
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_id:
+                    self._sample(frame)
+
+    def _sample(self, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append((code.co_filename, code.co_firstlineno,
+                          code.co_name))
+            frame = frame.f_back
+
+        self.samples += 1
+        self.own[stack[0]] += 1
+        # Recursive functions count once per sample
+        self.total.update(set(stack))
+        stack.reverse()
+        self.stacks[tuple(stack)] += 1
+
+    def report(self, top: int = REPORT_TOP) -> str:
+        """
+        Lists the functions seen most often on top of a stack, with the
+        share of samples they were on top and anywhere on the stack
+        """
+        lines = ['{} samples every {:g}s'.format(self.samples, self.interval),
+                 '{:>7} {:>7}  {}'.format('own%', 'total%', 'function')]
+        for key, count in self.own.most_common(top):
+            lines.append('{:>7.1%} {:>7.1%}  {}'.format(
+                count / self.samples, self.total[key] / self.samples,
+                _label(key)))
+        return '\n'.join(lines)
+
+    def write_collapsed(self, path: str):
+        """
+        Writes the stacks as "outer;inner count" lines, the input of
+        flamegraph.pl and speedscope
+        """
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write('{} {}\n'.format(
+                    ';'.join(_label(key) for key in stack), count))
+
+
+def profile_call(func: Callable, sample: bool = False,
+                 interval: float = SAMPLE_INTERVAL, top: int = REPORT_TOP,
+                 output: str = None, stream: TextIO = None):
+    """
+    Calls `func` under a profiler and writes a report of the hottest
+    functions to `stream`, stderr by default. Returns what `func` returns.
+
+    :param sample: Whether to use `Sampler` rather than cProfile
+    :param output: File to save the full profile to: pstats data for
+        cProfile, collapsed stacks for the sampler
+    """
+    stream = stream or sys.stderr
+    if sample:
+        sampler = Sampler(interval)
+        try:
+            with sampler:
+                return func()
+        finally:
+            stream.write(sampler.report(top) + '\n')
+            if output:
+                sampler.write_collapsed(output)
+
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func)
+    finally:
+        report = io.StringIO()
+        stats = pstats.Stats(profiler, stream=report)
+        stats.strip_dirs().sort_stats('tottime').print_stats(top)
+        stream.write(report.getvalue())
+        if output:
+            profiler.dump_stats(output)
@@ -0,0 +1,375 @@
+"""
+Deterministic network simulation
+
+`Simulation` connects many `Client`s on a topology of links with simulated
+latency and runs transaction and mining workloads against them. Nothing
+sleeps: messages are delivered in order of a simulated clock, and every
+random choice comes from one seeded `random.Random`, so a run with the same
+seed and parameters gives the same timings. Addresses and transaction hashes
+are drawn from it too, so the same seed gives the same IDs.
+
+Run with `python -m lambdacoin.simulation --nodes 200 --topology random`.
+The report covers:
+
+* Propagation latency of transactions and blocks, as percentiles over every
+  node's first arrival, and of the time for an item to reach every node
+* Duplicate deliveries, i.e. messages a client dropped as already seen
+* Forks and orphans. A fork is a height at which more than one block was
+  mined. Every block after the first at such a height is counted as an
+  orphan, since only one of them can stay in the chain.
+"""
+
+import argparse
+import heapq
+import json
+import logging
+import random
+import sys
+from typing import Callable, List, Tuple
+
+from lambdacoin.broadcast import BroadcastNode
+import lambdacoin.constants as constants
+from lambdacoin.core import Client, Transaction
+import lambdacoin.wire as wire
+
+TOPOLOGY_RING = 'ring'
+TOPOLOGY_STAR = 'star'
+TOPOLOGY_RANDOM = 'random'
+
+# Seconds of one-way link latency, drawn uniformly for each link
+DEFAULT_LATENCY = (0.02, 0.2)
+
+# Average number of links per node in a random graph
+DEFAULT_DEGREE = 4
+
+PERCENTILES = (50, 90, 99)
+
+
+def ring(nodes: int, rng: random.Random = None) -> List[Tuple[int, int]]:
+    """Links each node to the next, and the last back to the first"""
+    if nodes < 2:
+        return []
+    if nodes == 2:
+        return [(0, 1)]
+    return [(i, (i + 1) % nodes) for i in range(nodes)]
+
+
+def star(nodes: int, rng: random.Random = None) -> List[Tuple[int, int]]:
+    """Links every node to node 0"""
+    return [(0, i) for i in range(1, nodes)]
+
+
+def random_graph(nodes: int, rng: random.Random,
+                 degree: int = DEFAULT_DEGREE) -> List[Tuple[int, int]]:
+    """
+    Links nodes at random with about `degree` links per node. A random
+    spanning tree comes first so the graph is always connected.
+    """
+    edges = set()
+    for i in range(1, nodes):
+        edges.add((rng.randrange(i), i))
+
+    wanted = min(nodes * degree // 2, nodes * (nodes - 1) // 2)
+    while len(edges) < wanted:
+        a, b = rng.randrange(nodes), rng.randrange(nodes)
+        if a != b:
+            edges.add((min(a, b), max(a, b)))
+
+    return sorted(edges)
+
+
+TOPOLOGIES = {
+    TOPOLOGY_RING: ring,
+    TOPOLOGY_STAR: star,
+    TOPOLOGY_RANDOM: random_graph,
+}
+
+
+def percentiles(values: List[float]) -> dict:
+    """Returns nearest-rank percentiles and the maximum of `values`"""
+    if not values:
+        return {}
+
+    ordered = sorted(values)
+    summary = {}
+    for p in PERCENTILES:
+        rank = max(0, -(-p * len(ordered) // 100) - 1)
+        summary['p{}'.format(p)] = ordered[rank]
+    summary['max'] = ordered[-1]
+    return summary
+
+
+class SimulatedLink(BroadcastNode):
+    """One direction of a link, delivering after a simulated delay"""
+
+    def __init__(self, simulation: 'Simulation', source: int, target: int,
+                 latency: float):
+        self.simulation = simulation
+        self.source = source
+        self.target = target
+        self.latency = latency
+
+    @property
+    def client(self) -> Client:
+        return self.simulation.clients[self.target]
+
+    @property
+    def peer_id(self):
+        return self.client.node_id
+
+    def formats(self) -> tuple:
+        return self.client.wire_formats
+
+    def broadcast(self, data):
+        delay = self.latency
+        if self.simulation.jitter:
+            delay += self.simulation.rng.uniform(
+                0, self.latency * self.simulation.jitter)
+        self.simulation.schedule(delay, self.simulation.deliver,
+                                 self.target, data)
+
+
+class Simulation(object):
+    def __init__(self, nodes: int = 100, topology: str = TOPOLOGY_RANDOM,
+                 seed: int = 0, latency: Tuple[float, float] = DEFAULT_LATENCY,
+                 jitter: float = 0.0, degree: int = DEFAULT_DEGREE,
+                 relay_mode: str = constants.RELAY_FLOOD,
+                 client_factory: Callable[..., Client] = Client):
+        """
+        :param topology: One of TOPOLOGIES
+        :param latency: Range of one-way link latencies in seconds
+        :param jitter: Extra random delay on each message, as a fraction of
+            its link's latency
+        :param degree: Links per node in a random graph
+        :param client_factory: Called with `name`, `addresses` and
+            `relay_mode` to create each client
+        """
+        self.rng = random.Random(seed)
+        self.jitter = jitter
+        self.now = 0.0
+        self._events = []  # heap of (time, sequence, callback, args)
+        self._sequence = 0
+
+        self.clients = [
+            client_factory(name='node{}'.format(i),
+                           addresses=[self.random_hash()],
+                           relay_mode=relay_mode)
+            for i in range(nodes)]
+
+        if topology == TOPOLOGY_RANDOM:
+            self.edges = random_graph(nodes, self.rng, degree)
+        else:
+            self.edges = TOPOLOGIES[topology](nodes, self.rng)
+
+        for a, b in self.edges:
+            link_latency = self.rng.uniform(*latency)
+            self.clients[a].register_broadcast_node(
+                SimulatedLink(self, a, b, link_latency))
+            self.clients[b].register_broadcast_node(
+                SimulatedLink(self, b, a, link_latency))
+
+        self.deliveries = 0
+        self.failures = 0
+
+        # {item hash: (broadcast type, origin node, time created)}
+        self.items = {}
+        # {item hash: {node: seconds until it had the item}}
+        self.arrivals = {}
+
+        # {height: [hashes of blocks mined at that height]}
+        self.mined = {}
+
+    def random_hash(self) -> str:
+        """A hash like `generate_hash` gives, from the seeded generator"""
+        return '{:040x}'.format(self.rng.getrandbits(160))
+
+    def schedule(self, delay: float, callback, *args):
+        """Calls `callback(*args)` after `delay` simulated seconds"""
+        self._sequence += 1
+        heapq.heappush(self._events,
+                       (self.now + delay, self._sequence, callback, args))
+
+    def run(self, until: float = None) -> int:
+        """
+        Processes events in time order until none are left, or until the
+        clock would pass `until`. Returns the number of events processed.
+        """
+        processed = 0
+        while self._events:
+            if until is not None and self._events[0][0] > until:
+                self.now = until
+                break
+
+            self.now, _, callback, args = heapq.heappop(self._events)
+            callback(*args)
+            processed += 1
+        return processed
+
+    def deliver(self, node: int, data):
+        client = self.clients[node]
+        duplicates = client.duplicates
+        # Solutions can be accepted later, once their transactions arrive
+        pending = list(client.pending_solutions)
+        self.deliveries += 1
+
+        try:
+            client.receive_broadcast(data)
+        except Exception:
+            self.failures += 1
+            return
+
+        for block_hash in pending:
+            self._arrived(node, constants.B_TYPE_SOLUTION, block_hash)
+
+        if client.duplicates != duplicates:
+            return
+
+        doc = wire.decode(data)
+        if doc.get('type') in (constants.B_TYPE_TRANSACTION,
+                               constants.B_TYPE_SOLUTION):
+            self._arrived(node, doc['type'], doc['package']['hash'])
+
+    def _arrived(self, node: int, b_type: str, item_hash: str):
+        item = self.items.get(item_hash)
+        if item is None or item[1] == node:
+            return
+
+        # Only the first arrival at each node counts
+        arrivals = self.arrivals[item_hash]
+        if node not in arrivals and self.clients[node].has_item(
+                {'type': b_type, 'hash': item_hash}):
+            arrivals[node] = self.now - item[2]
+
+    def send_transaction(self, node: int = None) -> Transaction:
+        """Sends a transaction from a node, chosen at random if not given"""
+        if node is None:
+            node = self.rng.randrange(len(self.clients))
+        recipient = self.clients[self.rng.randrange(len(self.clients))]
+
+        transaction = Transaction(outputs={recipient.addresses[0]: 1},
+                                  hash=self.random_hash())
+        self._created(transaction.hash, constants.B_TYPE_TRANSACTION, node)
+        self.clients[node].broadcast_transaction(transaction)
+        return transaction
+
+    def mine_block(self, node: int = None):
+        """
+        Has a node, chosen at random if not given, mine its current block.
+        Returns the block, or None if no solution was found.
+        """
+        if node is None:
+            node = self.rng.randrange(len(self.clients))
+        client = self.clients[node]
+        block = client.current_block
+
+        # Recorded first so the arrival of the broadcast isn't missed
+        self._created(block.hash, constants.B_TYPE_SOLUTION, node)
+        if client.mine_current_block() is None:
+            del self.items[block.hash]
+            del self.arrivals[block.hash]
+            return None
+
+        self.mined.setdefault(client.blockchain.height, []).append(block.hash)
+        return block
+
+    def _created(self, item_hash: str, b_type: str, node: int):
+        self.items[item_hash] = (b_type, node, self.now)
+        self.arrivals[item_hash] = {}
+
+    def add_workload(self, transactions: int = 0, blocks: int = 0,
+                     transaction_interval: float = 0.1,
+                     block_interval: float = 10.0):
+        """
+        Schedules transactions and blocks from random nodes, at exponentially
+        distributed intervals with the given means in seconds
+        """
+        at = self.now
+        for _ in range(transactions):
+            at += self.rng.expovariate(1 / transaction_interval)
+            self.schedule(at - self.now, self.send_transaction)
+
+        at = self.now
+        for _ in range(blocks):
+            at += self.rng.expovariate(1 / block_interval)
+            self.schedule(at - self.now, self.mine_block)
+
+    def report(self) -> dict:
+        others = len(self.clients) - 1
+
+        def item_report(b_type: str) -> dict:
+            hashes = [h for h, item in self.items.items() if item[0] == b_type]
+            latencies = [t for h in hashes for t in self.arrivals[h].values()]
+            complete = [max(self.arrivals[h].values()) for h in hashes
+                        if len(self.arrivals[h]) == others and others]
+            return {
+                'count': len(hashes),
+                'fully_propagated': len(complete),
+                'latency': percentiles(latencies),
+                'full_propagation': percentiles(complete),
+            }
+
+        blocks = sum(len(hashes) for hashes in self.mined.values())
+        forks = sum(1 for hashes in self.mined.values() if len(hashes) > 1)
+        orphans = sum(len(hashes) - 1 for hashes in self.mined.values())
+
+        return {
+            'nodes': len(self.clients),
+            'links': len(self.edges),
+            'time': self.now,
+            'deliveries': self.deliveries,
+            'duplicates': sum(c.duplicates for c in self.clients),
+            'failures': self.failures,
+            'transactions': item_report(constants.B_TYPE_TRANSACTION),
+            'blocks': item_report(constants.B_TYPE_SOLUTION),
+            'forks': forks,
+            'orphans': orphans,
+            'fork_rate': forks / len(self.mined) if self.mined else 0.0,
+            'orphan_rate': orphans / blocks if blocks else 0.0,
+            'tips': len({c.blockchain.tip.hash for c in self.clients}),
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m lambdacoin.simulation',
+        description='Simulate a network of clients')
+    parser.add_argument('--nodes', type=int, default=100)
+    parser.add_argument('--topology', choices=sorted(TOPOLOGIES),
+                        default=TOPOLOGY_RANDOM)
+    parser.add_argument('--degree', type=int, default=DEFAULT_DEGREE)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--min-latency', type=float,
+                        default=DEFAULT_LATENCY[0])
+    parser.add_argument('--max-latency', type=float,
+                        default=DEFAULT_LATENCY[1])
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--relay-mode', default=constants.RELAY_FLOOD,
+                        choices=[constants.RELAY_FLOOD,
+                                 constants.RELAY_INVENTORY])
+    parser.add_argument('--transactions', type=int, default=100)
+    parser.add_argument('--transaction-interval', type=float, default=0.1)
+    parser.add_argument('--blocks', type=int, default=10)
+    parser.add_argument('--block-interval', type=float, default=10.0)
+    args = parser.parse_args(argv)
+
+    # Per-message logging from hundreds of clients isn't useful here. Blocks
+    # that can't be verified show up in the report as not fully propagated.
+    logging.getLogger('lambdacoin').setLevel(logging.ERROR)
+
+    simulation = Simulation(
+        nodes=args.nodes, topology=args.topology, seed=args.seed,
+        latency=(args.min_latency, args.max_latency), jitter=args.jitter,
+        degree=args.degree, relay_mode=args.relay_mode)
+    simulation.add_workload(
+        transactions=args.transactions, blocks=args.blocks,
+        transaction_interval=args.transaction_interval,
+        block_interval=args.block_interval)
+    simulation.run()
+
+    json.dump(simulation.report(), sys.stdout, indent=2, sort_keys=True)
+    print()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
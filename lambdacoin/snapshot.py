@@ -0,0 +1,309 @@
+"""
+Snapshots of the UTXO index
+
+A snapshot holds every unspent output as of one block, so a node can learn
+balances without replaying the chain up to that block. The file is written and
+read one output at a time, so neither side needs the whole snapshot in memory
+as bytes:
+
+    header: magic (4 bytes) | format version (4) | block hash | height (4) |
+            number of outputs (8)
+    output: transaction hash | n (4) | address | value type (1) | value (8)
+    trailer: SHA-1 digest of everything before it (20)
+
+Hashes and addresses are 20 raw digest bytes when they're lowercase hex SHA
+digests, and length-prefixed text otherwise. Outputs are sorted by
+(transaction hash, n), so the same UTXO set at the same block always gives the
+same digest, which identifies the snapshot.
+
+A node starting from a snapshot has balances as soon as the snapshot block is
+in its chain. `HistoryVerifier` then replays the blocks below it a batch at a
+time, between other work, to check the snapshot against them.
+"""
+
+import hashlib
+import os
+import struct
+from collections import namedtuple
+from typing import BinaryIO, Callable, Iterator, Optional, Tuple
+
+import lambdacoin.constants as constants
+from lambdacoin.exceptions import SnapshotError
+from lambdacoin.utils import compact_hash
+from lambdacoin.utxo import UTXO, UTXOSet
+
+MAGIC = b'LCSN'
+VERSION = 1
+
+U8 = struct.Struct('>B')
+U32 = struct.Struct('>I')
+HEADER = struct.Struct('>4sI')
+COUNTS = struct.Struct('>IQ')  # Height, number of outputs
+I64 = struct.Struct('>q')
+F64 = struct.Struct('>d')
+
+# Tags for hash-like strings
+HASH_DIGEST = 0
+HASH_TEXT = 1
+
+# Tags for output values
+VALUE_INT = 0
+VALUE_FLOAT = 1
+
+DIGEST_SIZE = 20
+
+# Blocks replayed per `HistoryVerifier.step`
+VERIFY_BATCH = 100
+
+SnapshotInfo = namedtuple('SnapshotInfo',
+                          ['block_hash', 'height', 'count', 'digest'])
+
+
+class _HashingWriter(object):
+    """Writes to a file while hashing everything written"""
+
+    def __init__(self, f: BinaryIO):
+        self.f = f
+        self.sha = hashlib.sha1()
+
+    def write(self, data: bytes):
+        self.f.write(data)
+        self.sha.update(data)
+
+
+class _HashingReader(object):
+    """Reads exact lengths from a file while hashing everything read"""
+
+    def __init__(self, f: BinaryIO):
+        self.f = f
+        self.sha = hashlib.sha1()
+
+    def read(self, length: int) -> bytes:
+        data = self.f.read(length)
+        if len(data) != length:
+            raise SnapshotError('Snapshot is truncated')
+        self.sha.update(data)
+        return data
+
+    def unpack(self, fmt: struct.Struct) -> tuple:
+        return fmt.unpack(self.read(fmt.size))
+
+
+def _pack_hash(value: str) -> bytes:
+    digest = compact_hash(value)
+    if isinstance(digest, bytes):
+        return U8.pack(HASH_DIGEST) + digest
+
+    data = value.encode(constants.STRING_ENCODING)
+    return U8.pack(HASH_TEXT) + U32.pack(len(data)) + data
+
+
+def _read_hash(reader: _HashingReader) -> str:
+    tag, = reader.unpack(U8)
+    if tag == HASH_DIGEST:
+        return reader.read(DIGEST_SIZE).hex()
+    length, = reader.unpack(U32)
+    return reader.read(length).decode(constants.STRING_ENCODING)
+
+
+def _pack_utxo(utxo: UTXO) -> bytes:
+    if isinstance(utxo.value, int):
+        value = U8.pack(VALUE_INT) + I64.pack(utxo.value)
+    else:
+        value = U8.pack(VALUE_FLOAT) + F64.pack(utxo.value)
+    return b''.join((_pack_hash(utxo.hash), U32.pack(utxo.n),
+                     _pack_hash(utxo.address), value))
+
+
+def _read_utxo(reader: _HashingReader) -> UTXO:
+    transaction_hash = _read_hash(reader)
+    n, = reader.unpack(U32)
+    address = _read_hash(reader)
+    tag, = reader.unpack(U8)
+    value, = reader.unpack(I64 if tag == VALUE_INT else F64)
+    return UTXO(transaction_hash, n, address, value)
+
+
+def _write(write: Callable[[bytes], None], utxos: UTXOSet, block_hash: str,
+           height: int):
+    """Passes everything but the trailer of a snapshot to `write`"""
+    write(HEADER.pack(MAGIC, VERSION))
+    write(_pack_hash(block_hash))
+    write(COUNTS.pack(height, len(utxos)))
+    outputs = utxos.outputs
+    for outpoint in sorted(outputs):
+        write(_pack_utxo(outputs[outpoint]))
+
+
+def snapshot_digest(utxos: UTXOSet, block_hash: str, height: int) -> str:
+    """Returns the digest a snapshot of `utxos` would have, in hex"""
+    sha = hashlib.sha1()
+    _write(sha.update, utxos, block_hash, height)
+    return sha.hexdigest()
+
+
+def write_snapshot(path: str, utxos: UTXOSet, block_hash: str,
+                   height: int) -> SnapshotInfo:
+    """
+    Writes a snapshot of `utxos` as of a block. The file only appears at
+    `path` once it's complete.
+    """
+    partial = path + '.partial'
+    with open(partial, 'wb') as f:
+        writer = _HashingWriter(f)
+        _write(writer.write, utxos, block_hash, height)
+        digest = writer.sha.digest()
+        f.write(digest)
+    os.replace(partial, path)
+
+    return SnapshotInfo(block_hash, height, len(utxos), digest.hex())
+
+
+def export_snapshot(blockchain: 'Blockchain', path: str,
+                    block_hash: str = None) -> SnapshotInfo:
+    """
+    Writes a snapshot of the chain's UTXOs as of a main chain block, by
+    default the tip. The tip's index is written as it is. Earlier blocks have
+    their index rebuilt by replaying the chain up to them.
+    """
+    if block_hash is None:
+        block_hash = blockchain.tip.hash
+
+    height = blockchain.height_of(block_hash)
+    if height is None:
+        raise SnapshotError(
+            'Block {} is not in the main chain'.format(block_hash))
+
+    if height == blockchain.height:
+        utxos = blockchain.chain_utxos()
+    else:
+        utxos = UTXOSet.from_blocks(blockchain.iter_range(0, height + 1))
+    return write_snapshot(path, utxos, block_hash, height)
+
+
+class SnapshotReader(object):
+    """
+    Reads a snapshot one output at a time
+
+        with SnapshotReader(path) as reader:
+            for utxo in reader:
+                ...
+
+    The digest is checked once the last output has been read, raising
+    SnapshotError if it doesn't match. Outputs read before that can't be
+    trusted until iteration finishes.
+    """
+
+    def __init__(self, path: str):
+        self.file = open(path, 'rb')
+        self._reader = _HashingReader(self.file)
+        try:
+            magic, version = self._reader.unpack(HEADER)
+            if magic != MAGIC or version != VERSION:
+                raise SnapshotError('{} is not a snapshot'.format(path))
+            self.block_hash = _read_hash(self._reader)
+            self.height, self.count = self._reader.unpack(COUNTS)
+        except Exception:
+            self.file.close()
+            raise
+
+        self.digest = None  # Hex digest, once verified
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __iter__(self) -> Iterator[UTXO]:
+        for _ in range(self.count):
+            yield _read_utxo(self._reader)
+
+        digest = self.file.read(DIGEST_SIZE + 1)
+        if digest != self._reader.sha.digest():
+            raise SnapshotError('Snapshot digest does not match its contents')
+        self.digest = digest.hex()
+
+    def info(self) -> SnapshotInfo:
+        return SnapshotInfo(self.block_hash, self.height, self.count,
+                            self.digest)
+
+    def close(self):
+        self.file.close()
+
+
+def load_snapshot(path: str, expected_digest: str = None) \
+        -> Tuple[SnapshotInfo, UTXOSet]:
+    """
+    Reads a snapshot into a UTXO index
+
+    :param expected_digest: Digest the snapshot must have, e.g. one published
+        by a trusted node
+    :raises SnapshotError: If the file is damaged or has another digest
+    """
+    utxos = UTXOSet()
+    with SnapshotReader(path) as reader:
+        for utxo in reader:
+            utxos.add(utxo)
+        info = reader.info()
+
+    if expected_digest is not None and info.digest != expected_digest:
+        raise SnapshotError('Snapshot digest {} is not {}'.format(
+            info.digest, expected_digest))
+    return info, utxos
+
+
+class HistoryVerifier(object):
+    """
+    Checks a loaded snapshot by replaying the chain up to its block, in
+    batches so a node can keep handling blocks in between
+
+        verifier = HistoryVerifier(blockchain, info)
+        while verifier.step() is None:
+            ...  # other work
+    """
+
+    def __init__(self, blockchain: 'Blockchain', info: SnapshotInfo,
+                 batch_size: int = VERIFY_BATCH):
+        self.blockchain = blockchain
+        self.info = info
+        self.batch_size = batch_size
+
+        self.utxos = UTXOSet()
+        self.next_height = 0
+        self.result = None  # type: Optional[bool]
+
+    def step(self) -> Optional[bool]:
+        """
+        Replays the next batch of blocks. Returns None until every block up to
+        the snapshot has been replayed, then whether the snapshot matched.
+        Blocks the chain doesn't have yet are waited for.
+        """
+        if self.result is not None:
+            return self.result
+
+        end = min(self.next_height + self.batch_size, self.info.height + 1,
+                  len(self.blockchain))
+        for block in self.blockchain.iter_range(self.next_height, end):
+            self.utxos.apply_block(block)
+        self.next_height = end
+
+        if self.next_height > self.info.height:
+            block = self.blockchain.block_at(self.info.height)
+            self.result = block is not None and \
+                block.hash == self.info.block_hash and \
+                snapshot_digest(self.utxos, self.info.block_hash,
+                                self.info.height) == self.info.digest
+            # Nothing else needs the replayed index
+            self.utxos = None
+        return self.result
+
+    def run(self) -> Optional[bool]:
+        """
+        Replays everything at once. Returns None if the chain doesn't reach
+        the snapshot's block yet.
+        """
+        while self.step() is None:
+            if self.next_height >= len(self.blockchain):
+                return None
+        return self.result
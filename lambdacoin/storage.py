@@ -0,0 +1,368 @@
+"""
+Append-only block storage on disk
+
+A `BlockStore` directory holds:
+
+* Segment files (blk00000.dat, blk00001.dat, ...) of length-prefixed JSON
+  records. Each record is one block along with the full documents of its
+  transactions. Records are only ever appended.
+* index.dat, a hash table of block hash -> record location and height. It is
+  memory-mapped and probed in place, so it is never read into memory as a
+  whole.
+* heights.dat, an array of record locations and index keys in height order,
+  also memory-mapped.
+
+When the chain switches to another fork, the blocks above the fork point are
+dropped from the index and heights.dat by `truncate`, which finds their index
+entries through the keys in heights.dat rather than decoding them. Their
+records stay in the segment files.
+
+Opening a store only maps these files, so a node can answer lookups right
+after a restart. Blocks are decoded from their segment when they're first
+accessed, and only the most recently used ones are kept. Blocks appended to the
+store are unlinked from their neighbours (`prev_block` and `next_block`), so
+the main chain isn't held in memory through the tip. `Block.chain` and
+`Block.chain_utxos` only see in-memory chains; use the `Blockchain` instead.
+"""
+
+import json
+import mmap
+import os
+import struct
+from typing import Optional
+
+from Crypto.Hash import SHA
+
+from lambdacoin.cache import LRUCache
+import lambdacoin.constants as constants
+import lambdacoin.core
+
+INDEX_FILE = 'index.dat'
+HEIGHTS_FILE = 'heights.dat'
+SEGMENT_FILE = 'blk{:05d}.dat'
+
+# Start a new segment file once the current one reaches this size
+SEGMENT_SIZE = 128 * 1024 * 1024
+
+# Number of decoded blocks to keep in memory
+BLOCK_CACHE_SIZE = 1024
+
+# Index header: magic, format version, number of slots, number of entries
+INDEX_HEADER = struct.Struct('>4sIII')
+INDEX_MAGIC = b'LCIX'
+# Covers heights.dat too, whose layout changes with it
+INDEX_VERSION = 2
+INDEX_INITIAL_SLOTS = 1024
+
+# Index slot: hash key, segment, offset, record length, height + 1. A height
+# of 0 marks an empty slot.
+INDEX_SLOT = struct.Struct('>20sIQII')
+
+# Entry in heights.dat: segment, offset and length of the record, then the
+# block's index key
+LOCATION = struct.Struct('>IQI20s')
+
+# Prefix holding the length of each record in a segment
+RECORD_LENGTH = struct.Struct('>I')
+
+
+def block_key(block_hash: str) -> bytes:
+    """
+    Returns the 20 byte index key for a block hash. Block hashes are usually
+    hex SHA digests. Anything else is hashed down to 20 bytes.
+    """
+    if len(block_hash) == 40:
+        try:
+            return bytes.fromhex(block_hash)
+        except ValueError:
+            pass
+    return SHA.new(block_hash.encode(constants.STRING_ENCODING)).digest()
+
+
+def encode_block(block: 'Block') -> bytes:
+    """Serializes a block together with its transactions as a JSON record"""
+    # Signed transactions have their JSON cached already
+    transactions = ', '.join(t.to_json() for t in block.transactions)
+    data = '{{"block": {}, "transactions": [{}]}}'.format(
+        json.dumps(block.to_dict()), transactions)
+    return data.encode(constants.STRING_ENCODING)
+
+
+def decode_block(data: bytes) -> 'Block':
+    doc = json.loads(data.decode(constants.STRING_ENCODING))
+    transactions = [lambdacoin.core.Transaction.from_dict(t)
+                    for t in doc['transactions']]
+    # Checked against the chain's target before they were stored
+    return lambdacoin.core.Block.from_dict(
+        doc['block'], {t.hash: t for t in transactions}, None)
+
+
+class _MappedFile(object):
+    """A file that is memory-mapped and can be grown"""
+
+    def __init__(self, path: str, initial: bytes):
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            with open(path, 'wb') as f:
+                f.write(initial)
+
+        self.path = path
+        self.file = open(path, 'r+b')
+        self.map = mmap.mmap(self.file.fileno(), 0)
+
+    def __len__(self):
+        return len(self.map)
+
+    def resize(self, size: int):
+        self.map.resize(size)
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
+        self.file.close()
+
+
+class BlockStore(object):
+    def __init__(self, path: str, segment_size: int = SEGMENT_SIZE,
+                 sync: bool = False):
+        """
+        :param path: Directory to keep the store in. Created if missing.
+        :param segment_size: Size at which to start a new segment file
+        :param sync: Whether to fsync each block as it's appended
+        """
+        os.makedirs(path, exist_ok=True)
+
+        self.path = path
+        self.segment_size = segment_size
+        self.sync = sync
+
+        self.index = _MappedFile(
+            os.path.join(path, INDEX_FILE),
+            self._empty_index(INDEX_INITIAL_SLOTS))
+        magic, version, self.slots, self.count = INDEX_HEADER.unpack_from(
+            self.index.map)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise ValueError('{} is not a block index'.format(
+                self.index.path))
+
+        # A block's location is written to heights.dat before it's counted in
+        # the index, so the index count is the number of complete blocks
+        self.heights = _MappedFile(
+            os.path.join(path, HEIGHTS_FILE), b'\0' * LOCATION.size)
+
+        self._segment_readers = {}  # {segment: file}
+        self._blocks = LRUCache(BLOCK_CACHE_SIZE)  # {height: Block}
+
+        if self.count:
+            segment, _, _ = self._location_at(self.count - 1)
+        else:
+            segment = 0
+        self._segment = segment
+        self._writer = open(self._segment_path(segment), 'ab')
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, block_hash: str) -> bool:
+        return self._find(block_key(block_hash)) is not None
+
+    def get(self, block_hash: str) -> Optional['Block']:
+        slot = self._find(block_key(block_hash))
+        if slot is None:
+            return None
+
+        _, segment, offset, length, height = INDEX_SLOT.unpack_from(
+            self.index.map, self._slot_offset(slot))
+        return self._cached_load(height - 1, segment, offset, length)
+
+    def height_of(self, block_hash: str) -> Optional[int]:
+        slot = self._find(block_key(block_hash))
+        if slot is None:
+            return None
+
+        _, _, _, _, height = INDEX_SLOT.unpack_from(
+            self.index.map, self._slot_offset(slot))
+        return height - 1
+
+    def block_at(self, height: int) -> Optional['Block']:
+        if not 0 <= height < self.count:
+            return None
+        return self._cached_load(height, *self._location_at(height))
+
+    def append(self, block: 'Block') -> int:
+        """Writes a block to the end of the store. Returns its height."""
+        data = encode_block(block)
+
+        if self._writer.tell() >= self.segment_size:
+            self._writer.close()
+            self._segment += 1
+            self._writer = open(self._segment_path(self._segment), 'ab')
+
+        offset = self._writer.tell()
+        self._writer.write(RECORD_LENGTH.pack(len(data)))
+        self._writer.write(data)
+        self._writer.flush()
+        if self.sync:
+            os.fsync(self._writer.fileno())
+
+        height = self.count
+        length = RECORD_LENGTH.size + len(data)
+
+        needed = (height + 1) * LOCATION.size
+        if len(self.heights) < needed:
+            self.heights.resize(max(needed, 2 * len(self.heights)))
+        key = block_key(block.hash)
+        LOCATION.pack_into(self.heights.map, height * LOCATION.size,
+                           self._segment, offset, length, key)
+
+        if (self.count + 1) * 2 > self.slots:
+            self._grow_index()
+        self._insert(key, self._segment, offset, length, height)
+
+        # Loaded again from disk when needed, rather than kept reachable
+        # through the blocks above it
+        if block.prev_block is not None:
+            block.prev_block.next_block = None
+            block.prev_block = None
+
+        self._blocks.put(height, block)
+        return height
+
+    def truncate(self, height: int):
+        """
+        Drops the blocks at `height` and above
+
+        Raises ValueError, leaving the blocks above it dropped, if one of them
+        is missing from the index.
+        """
+        for h in range(self.count - 1, height - 1, -1):
+            self._blocks.pop(h)
+            slot = self._find(self._key_at(h))
+            if slot is None:
+                raise ValueError('Block at height {} is missing from {}'
+                                 .format(h, self.index.path))
+            self._delete(slot)
+
+    def close(self):
+        self._writer.close()
+        for reader in self._segment_readers.values():
+            reader.close()
+        self._segment_readers = {}
+        self.index.close()
+        self.heights.close()
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.path, SEGMENT_FILE.format(segment))
+
+    def _location_at(self, height: int):
+        """Returns the segment, offset and length of a block's record"""
+        return LOCATION.unpack_from(self.heights.map,
+                                    height * LOCATION.size)[:3]
+
+    def _key_at(self, height: int) -> bytes:
+        return LOCATION.unpack_from(self.heights.map,
+                                    height * LOCATION.size)[3]
+
+    def _cached_load(self, height: int, segment: int, offset: int,
+                     length: int) -> 'Block':
+        block = self._blocks.get(height)
+        if block is None:
+            block = self._load(segment, offset, length)
+            self._blocks.put(height, block)
+        return block
+
+    def _load(self, segment: int, offset: int, length: int) -> 'Block':
+        reader = self._segment_readers.get(segment)
+        if reader is None:
+            reader = open(self._segment_path(segment), 'rb')
+            self._segment_readers[segment] = reader
+
+        reader.seek(offset + RECORD_LENGTH.size)
+        return decode_block(reader.read(length - RECORD_LENGTH.size))
+
+    @staticmethod
+    def _empty_index(slots: int) -> bytes:
+        return INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, slots, 0) + \
+            b'\0' * (slots * INDEX_SLOT.size)
+
+    @staticmethod
+    def _slot_offset(slot: int) -> int:
+        return INDEX_HEADER.size + slot * INDEX_SLOT.size
+
+    def _find(self, key: bytes) -> Optional[int]:
+        """Returns the slot holding `key`, or None"""
+        index_map = self.index.map
+        slot = int.from_bytes(key[:8], 'big') % self.slots
+        for _ in range(self.slots):
+            offset = self._slot_offset(slot)
+            if index_map[offset + INDEX_SLOT.size - 4:
+                         offset + INDEX_SLOT.size] == b'\0\0\0\0':
+                return None
+            if index_map[offset:offset + 20] == key:
+                return slot
+            slot = (slot + 1) % self.slots
+        return None
+
+    def _insert(self, key: bytes, segment: int, offset: int, length: int,
+                height: int):
+        index_map = self.index.map
+        slot = int.from_bytes(key[:8], 'big') % self.slots
+        while True:
+            slot_offset = self._slot_offset(slot)
+            _, _, _, _, used = INDEX_SLOT.unpack_from(index_map, slot_offset)
+            if not used:
+                break
+            slot = (slot + 1) % self.slots
+
+        INDEX_SLOT.pack_into(index_map, slot_offset, key, segment, offset,
+                             length, height + 1)
+        self.count += 1
+        INDEX_HEADER.pack_into(index_map, 0, INDEX_MAGIC, INDEX_VERSION,
+                               self.slots, self.count)
+
+    def _delete(self, slot: int):
+        """
+        Empties a slot. Later entries of the same probe run are shifted back
+        into the gap, so lookups don't stop short at it.
+        """
+        index_map = self.index.map
+        gap = slot
+        slot = (slot + 1) % self.slots
+        while True:
+            offset = self._slot_offset(slot)
+            entry = INDEX_SLOT.unpack_from(index_map, offset)
+            if not entry[4]:
+                break
+
+            # The entry can move back if the gap is between its home slot and
+            # where it is now
+            home = int.from_bytes(entry[0][:8], 'big') % self.slots
+            if (slot - home) % self.slots >= (slot - gap) % self.slots:
+                INDEX_SLOT.pack_into(index_map, self._slot_offset(gap),
+                                     *entry)
+                gap = slot
+            slot = (slot + 1) % self.slots
+
+        gap_offset = self._slot_offset(gap)
+        index_map[gap_offset:gap_offset + INDEX_SLOT.size] = \
+            b'\0' * INDEX_SLOT.size
+        self.count -= 1
+        INDEX_HEADER.pack_into(index_map, 0, INDEX_MAGIC, INDEX_VERSION,
+                               self.slots, self.count)
+
+    def _grow_index(self):
+        """Rehashes the index into a table twice the size"""
+        old_map = self.index.map
+        old_slots = self.slots
+        entries = []
+        for slot in range(old_slots):
+            entry = INDEX_SLOT.unpack_from(old_map, self._slot_offset(slot))
+            if entry[4]:
+                entries.append(entry)
+
+        self.slots = old_slots * 2
+        self.count = 0
+        self.index.resize(len(self._empty_index(self.slots)))
+        self.index.map[:] = self._empty_index(self.slots)
+
+        for key, segment, offset, length, height in entries:
+            self._insert(key, segment, offset, length, height - 1)
@@ -1,15 +1,78 @@
-from Crypto.Hash import SHA
+import hashlib
+import itertools
+import logging
+import os
+import struct
+import sys
+
 from Crypto.Random import random
 
-import lambdacoin.constants
+# Source of unique IDs for `generate_hash`: a random prefix for this process
+# and a counter. Reset in a forked child so it can't repeat the parent's IDs.
+_id_pid = None
+_id_prefix = b''
+_id_counter = itertools.count()
+_ID_COUNTER = struct.Struct('>Q')
+
+# Size in bytes of a SHA digest
+DIGEST_SIZE = 20
 
 
 def generate_hash() -> str:
-    """Generates a hash str"""
-    return SHA.new(
-        str(rando()).encode(
-        lambdacoin.constants.STRING_ENCODING)).\
-        hexdigest()
+    """
+    Generates a unique hash str, 40 hex digits like a SHA-1 digest
+
+    The random prefix makes collisions across processes and runs about as
+    likely as with random IDs, and the counter rules them out within a
+    process. Hashing the two keeps IDs uniformly distributed for code that
+    buckets them by their leading bytes.
+    """
+    global _id_pid, _id_prefix, _id_counter
+    if _id_pid != os.getpid():
+        _id_pid = os.getpid()
+        _id_prefix = os.urandom(16)
+        _id_counter = itertools.count()
+
+    return hashlib.sha1(
+        _id_prefix + _ID_COUNTER.pack(next(_id_counter))).hexdigest()
+
+
+def compact_hash(value):
+    """
+    Returns the 20 raw bytes of a lowercase hex SHA digest, the form hashes
+    and addresses are kept in memory. Anything else is returned unchanged.
+    """
+    if isinstance(value, str) and len(value) == 40:
+        try:
+            digest = bytes.fromhex(value)
+        except ValueError:
+            return value
+        if digest.hex() == value:
+            return digest
+    return value
+
+
+def expand_hash(value):
+    """Reverses `compact_hash`"""
+    if isinstance(value, bytes):
+        return value.hex()
+    return value
+
+
+def meets_target(digest: bytes, target: int) -> bool:
+    """
+    Returns whether the hex form of `digest` would begin with `target` "0"s,
+    without building the hex string
+    """
+    if target > len(digest) * 2:
+        return False
+
+    full, half = divmod(target, 2)
+    if digest[:full] != bytes(full):
+        return False
+
+    # An odd target also needs the high nibble of the next byte to be 0
+    return not half or digest[full] < 0x10
 
 
 def rando():
@@ -19,3 +82,44 @@ def rando():
 def pretty_hash(hash: str) -> str:
     trailings = len(hash) // 8  # // is integer division in Python 3
     return '{}...{}'.format(hash[:trailings], hash[len(hash)-trailings:])
+
+
+class PrettyHash(object):
+    """
+    Formats as `pretty_hash` of a hash, but only when it's formatted. Pass it
+    as a logging argument so disabled messages don't shorten the hash.
+    """
+    __slots__ = ('hash',)
+
+    def __init__(self, hash: str):
+        self.hash = hash
+
+    def __str__(self):
+        return pretty_hash(self.hash)
+
+
+# Environment variable read by `configure_logging` for the default level
+LOG_LEVEL_VARIABLE = 'LAMBDACOIN_LOG_LEVEL'
+
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+
+def configure_logging(level: str = None, stream=None,
+                      fmt: str = LOG_FORMAT) -> logging.Logger:
+    """
+    Sends lambdacoin's log messages to a stream, stdout by default
+
+    Importing lambdacoin doesn't configure logging, so applications embedding
+    it keep control. Scripts call this to see the messages.
+
+    :param level: Level name, defaulting to $LAMBDACOIN_LOG_LEVEL or INFO
+    """
+    level = level or os.environ.get(LOG_LEVEL_VARIABLE) or 'INFO'
+
+    logger = logging.getLogger('lambdacoin')
+    logger.setLevel(level.upper())
+    if not logger.handlers:
+        handler = logging.StreamHandler(stream or sys.stdout)
+        handler.setFormatter(logging.Formatter(fmt))
+        logger.addHandler(handler)
+    return logger
@@ -0,0 +1,118 @@
+"""
+Index of Unspent Transaction Outputs (UTXOs)
+
+An output is identified by the hash of the transaction that created it and its
+index `n` in that transaction's outputs. Applying a block adds the outputs of
+its transactions and removes any outputs they spend as inputs, keeping a
+running balance per address.
+
+Applying a block returns an undo record of what it changed, so the block can
+be rolled back when the chain switches to another fork.
+"""
+
+from collections import namedtuple
+from typing import Iterable, List, Optional
+
+UTXO = namedtuple('UTXO', ['hash', 'n', 'address', 'value'])
+
+# Undo records are lists of (whether the output was added or spent, UTXO), in
+# the order the changes were made
+ADDED = True
+SPENT = False
+
+
+class UTXOSet(object):
+    def __init__(self):
+        self.outputs = {}  # {(hash, n): UTXO}
+        self.by_address = {}  # {address: {(hash, n): UTXO}}
+        self.balances = {}  # {address: value}
+
+    @staticmethod
+    def from_blocks(blocks: Iterable['Block']) -> 'UTXOSet':
+        """Builds the set by applying each block in order, oldest first"""
+        utxos = UTXOSet()
+        for block in blocks:
+            utxos.apply_block(block)
+        return utxos
+
+    def __len__(self):
+        return len(self.outputs)
+
+    def __contains__(self, outpoint) -> bool:
+        return outpoint in self.outputs
+
+    def apply_block(self, block: 'Block') -> list:
+        """Applies a block's transactions. Returns their undo record."""
+        undo = []
+        if block.gen_transaction is not None:
+            self.apply_transaction(block.gen_transaction, undo)
+
+        for transaction in block.transactions:
+            self.apply_transaction(transaction, undo)
+        return undo
+
+    def undo_block(self, undo: list):
+        """Reverts `apply_block`, given the undo record it returned"""
+        for added, utxo in reversed(undo):
+            if added:
+                self.spend((utxo.hash, utxo.n))
+            else:
+                self.add(utxo)
+
+    def apply_transaction(self, transaction: 'Transaction',
+                          undo: list = None):
+        """:param undo: Undo record to add the changes to"""
+        for outpoint in transaction.outpoints:
+            utxo = self.spend(outpoint)
+            if utxo is not None and undo is not None:
+                undo.append((SPENT, utxo))
+
+        # Hex hash strs are built on access, so the outputs share one
+        transaction_hash = transaction.hash
+        for n, (address, value) in enumerate(transaction.outputs.items()):
+            utxo = UTXO(transaction_hash, n, address, value)
+            if self.add(utxo) and undo is not None:
+                undo.append((ADDED, utxo))
+
+    def add(self, utxo: UTXO) -> bool:
+        """Adds an output. Returns False if it was already in the set."""
+        outpoint = (utxo.hash, utxo.n)
+        if outpoint in self.outputs:
+            return False
+
+        self.outputs[outpoint] = utxo
+        self.by_address.setdefault(utxo.address, {})[outpoint] = utxo
+        self.balances[utxo.address] = (
+            self.balances.get(utxo.address, 0) + utxo.value)
+        return True
+
+    def spend(self, outpoint) -> Optional[UTXO]:
+        """
+        Removes an output from the set. Returns the spent output, or None if it
+        was not unspent.
+        """
+        utxo = self.outputs.pop(outpoint, None)
+        if utxo is None:
+            return None
+
+        address_utxos = self.by_address[utxo.address]
+        del address_utxos[outpoint]
+        if address_utxos:
+            self.balances[utxo.address] -= utxo.value
+        else:
+            # Drop empty addresses rather than keeping a zero balance around
+            del self.by_address[utxo.address]
+            del self.balances[utxo.address]
+
+        return utxo
+
+    def balance(self, address: str):
+        return self.balances.get(address, 0)
+
+    def total_value(self, addresses: Iterable[str]):
+        """Returns the combined balance of all of the given addresses"""
+        balances = self.balances
+        return sum(balances.get(address, 0) for address in addresses)
+
+    def utxos_for_address(self, address: str) -> List[UTXO]:
+        return list(self.by_address.get(address, {}).values())
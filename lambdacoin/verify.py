@@ -0,0 +1,134 @@
+"""
+Signature verification for inbound transactions
+
+`SignatureVerifier` checks a batch of transactions at once, and remembers the
+outcome for each (hash, signature, public key) so the same transaction is
+never verified twice.
+
+pycrypto's RSA holds the GIL while it verifies, so threads can't check
+signatures in parallel. With more than one worker, batches go to worker
+processes instead, as (hash, signature, public key numbers) tuples rather
+than transactions, which are cheaper to pickle.
+
+Clients verify inline by default. Whether the processes make up for
+pickling and sending each batch depends on the batch size and the machine,
+so check with `python -m lambdacoin.bench verify_workers` before raising
+`workers`.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, List, Optional
+
+from Crypto.PublicKey import RSA
+
+from lambdacoin.cache import LRUCache
+
+# Number of verification results to remember
+DEFAULT_CACHE_SIZE = 100000
+
+# Public keys rebuilt in a worker process, {(n, e): public key}
+_worker_keys = LRUCache(4096)
+
+
+def _verify_signature(item: tuple) -> bool:
+    """Checks a (hash as int, signature, (n, e)) tuple in a worker process"""
+    hash_int, sig, numbers = item
+    public_key = _worker_keys.get(numbers)
+    if public_key is None:
+        public_key = RSA.construct(numbers)
+        _worker_keys.put(numbers, public_key)
+    return public_key.verify(hash_int, sig)
+
+
+def _signature_item(transaction: 'Transaction') -> Optional[tuple]:
+    """Returns what `_verify_signature` needs, or None if it isn't signed"""
+    public_key = transaction.public_key
+    if public_key is None or transaction.sig is None:
+        return None
+    return (int(transaction.hash, 16), tuple(transaction.sig),
+            (public_key.n, public_key.e))
+
+
+def cache_key(transaction: 'Transaction') -> tuple:
+    """Returns the key that identifies a signed transaction in the cache"""
+    sig = transaction.sig
+    if sig is not None:
+        # Signatures are tuples when signed locally, lists after JSON
+        sig = tuple(sig)
+
+    public_key = transaction.public_key
+    if public_key is not None:
+        public_key = (public_key.n, public_key.e)
+
+    return transaction.digest, sig, public_key
+
+
+class SignatureVerifier(object):
+    def __init__(self, workers: int = 1, cache_size: int = DEFAULT_CACHE_SIZE,
+                 executor=None):
+        """
+        :param workers: Number of worker processes. With 1 worker,
+            transactions are verified inline.
+        :param cache_size: Number of results to remember. 0 disables the
+            cache.
+        :param executor: concurrent.futures executor to use instead of a
+            process pool
+        """
+        self.cache = LRUCache(cache_size) if cache_size else None
+
+        self.workers = max(1, workers)
+        if executor is None and workers > 1:
+            executor = ProcessPoolExecutor(max_workers=workers)
+        self.executor = executor
+
+    def verify(self, transaction: 'Transaction') -> bool:
+        return self.verify_many([transaction])[0]
+
+    def verify_many(self, transactions: Iterable['Transaction']) -> List[bool]:
+        """
+        Returns whether each transaction's signature is valid, in the order
+        given
+        """
+        transactions = list(transactions)
+        results = [None] * len(transactions)
+
+        # Group duplicates so each distinct signature is checked once
+        pending = {}  # {cache key: [indexes into transactions]}
+        for i, transaction in enumerate(transactions):
+            key = cache_key(transaction)
+            cached = self.cache.get(key) if self.cache is not None else None
+            if cached is not None:
+                results[i] = cached
+            else:
+                pending.setdefault(key, []).append(i)
+
+        if pending:
+            keys = list(pending)
+            to_verify = [transactions[pending[key][0]] for key in keys]
+
+            if self.executor is None or len(to_verify) == 1:
+                verified = [t.verify() for t in to_verify]
+            else:
+                verified = self._verify_remotely(to_verify)
+
+            for key, ok in zip(keys, verified):
+                if self.cache is not None:
+                    self.cache.put(key, ok)
+                for i in pending[key]:
+                    results[i] = ok
+
+        return results
+
+    def _verify_remotely(self, transactions: List['Transaction']) \
+            -> List[bool]:
+        items = [_signature_item(t) for t in transactions]
+        signed = [item for item in items if item is not None]
+        # Enough per task to outweigh sending it to a process
+        chunksize = max(1, len(signed) // (4 * self.workers))
+        results = iter(self.executor.map(_verify_signature, signed,
+                                         chunksize=chunksize))
+        return [item is not None and next(results) for item in items]
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
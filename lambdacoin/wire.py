@@ -0,0 +1,652 @@
+"""
+Wire formats for broadcasts
+
+Broadcasts are sent as JSON by default. Peers that both support it use a
+compact binary format instead. It carries hashes as raw digest bytes and
+public keys as DER, and every field is length-prefixed so a message can be
+parsed without scanning for delimiters.
+
+Binary message layout:
+
+    magic (2 bytes) | format version (1) | broadcast type (1) |
+    body length (4) | body
+
+Broadcast types without a binary layout of their own are sent with type code
+0 and their whole broadcast dict as a JSON body.
+
+`decode` turns either format back into the same broadcast dict that
+`Client.package_for_broadcast` builds, so the rest of the client doesn't need
+to know which format a message arrived in.
+"""
+
+import json
+import struct
+
+from Crypto.Hash import SHA
+from typing import Optional, Union
+
+from lambdacoin.cache import LRUCache
+import lambdacoin.constants as constants
+from lambdacoin.exceptions import ParseMessageError, UnknownBroadcastType
+
+MAGIC = b'LC'
+BINARY_VERSION = 3
+
+HEADER = struct.Struct('>2sBBI')
+
+# Broadcast type codes in the binary format
+TYPE_OTHER = 0
+TYPE_CODES = {
+    constants.B_TYPE_TRANSACTION: 1,
+    constants.B_TYPE_SOLUTION: 2,
+    constants.B_TYPE_INVENTORY: 3,
+    constants.B_TYPE_GET_DATA: 4,
+    constants.B_TYPE_GET_HEADERS: 5,
+    constants.B_TYPE_HEADERS: 6,
+    constants.B_TYPE_GET_BLOCKS: 7,
+    constants.B_TYPE_BLOCKS: 8,
+    constants.B_TYPE_GET_TRANSACTIONS: 9,
+    constants.B_TYPE_TRANSACTIONS: 10,
+}
+TYPE_NAMES = {code: name for name, code in TYPE_CODES.items()}
+
+# Tags for hash-like strings: 20 raw digest bytes, or anything else as text
+HASH_DIGEST = 0
+HASH_TEXT = 1
+
+# Block target meaning none was given
+NO_TARGET = 0xFFFF
+
+# Request number meaning none was given
+NO_REQUEST = 0xFFFFFFFF
+
+# Tags for output values
+VALUE_INT = 0
+VALUE_FLOAT = 1
+
+U8 = struct.Struct('>B')
+U16 = struct.Struct('>H')
+U32 = struct.Struct('>I')
+I64 = struct.Struct('>q')
+F64 = struct.Struct('>d')
+
+# DER exports of public keys, {(n, e): DER bytes}
+der_key_cache = LRUCache(4096)
+
+
+def format_of(data: Union[str, bytes]) -> str:
+    """Returns the wire format a received message is in"""
+    if isinstance(data, bytes) and data[:len(MAGIC)] == MAGIC:
+        return constants.FORMAT_BINARY
+    return constants.FORMAT_JSON
+
+
+def message_id(data: Union[str, bytes], doc: dict = None) -> bytes:
+    """
+    Returns a digest identifying a message, cheap enough to check before the
+    message is handled
+
+    Transactions and solutions, the broadcasts relayed in full, are
+    identified by fields that read the same in either wire format, so one
+    relayed once as JSON and once as binary is still a duplicate: the hash
+    and signature of a transaction, and the hash, parent, target, solution
+    and transaction hashes of a block. Binary messages are only read as far
+    as those fields, and no public key is imported. JSON messages are parsed,
+    or `doc` is used if they already were. Other messages, and ones that
+    can't be read, are identified by their bytes.
+    """
+    try:
+        if format_of(data) == constants.FORMAT_BINARY:
+            fields = _binary_identity(data)
+        else:
+            fields = _identity(json.loads(data) if doc is None else doc)
+    except (struct.error, IndexError, KeyError, TypeError, ValueError,
+            AttributeError):
+        fields = None
+
+    if fields is None:
+        if isinstance(data, str):
+            data = data.encode(constants.STRING_ENCODING)
+        return SHA.new(data).digest()
+    return SHA.new(json.dumps(fields).encode(
+        constants.STRING_ENCODING)).digest()
+
+
+def _identity(doc: dict) -> Optional[list]:
+    """The fields `message_id` identifies a decoded broadcast by"""
+    b_type = doc.get('type')
+    package = doc['package']
+    if b_type == constants.B_TYPE_TRANSACTION:
+        sig = package.get('sig')
+        return [b_type, package['hash'], None if sig is None else list(sig)]
+    elif b_type == constants.B_TYPE_SOLUTION:
+        return [b_type, package['hash'], package.get('prev_hash'),
+                package.get('target'), package.get('solution'),
+                list(package.get('transactions') or [])]
+    return None
+
+
+def _binary_identity(data: bytes) -> Optional[list]:
+    """`_identity` of a binary message, reading only as far as it needs"""
+    magic, version, type_code, length = HEADER.unpack_from(data)
+    if magic != MAGIC or version != BINARY_VERSION or \
+            len(data) != HEADER.size + length:
+        return None
+
+    b_type = TYPE_NAMES.get(type_code)
+    reader = _Reader(data, HEADER.size)
+    if b_type == constants.B_TYPE_TRANSACTION:
+        reader.text()
+        transaction_hash = reader.hash()
+        reader.optional()  # Public key
+        return [b_type, transaction_hash, reader.signature()]
+    elif b_type == constants.B_TYPE_SOLUTION:
+        reader.text()
+        block_hash = reader.hash()
+        prev_hash = reader.optional_hash()
+        target = reader.target()
+        solution = reader.optional()
+        reader.optional()  # Generation transaction
+        return [b_type, block_hash, prev_hash, target,
+                None if solution is None
+                else solution.decode(constants.STRING_ENCODING),
+                [reader.hash() for _ in range(reader.count())]]
+    return None
+
+
+def encode(doc: dict, wire_format: str) -> Union[str, bytes]:
+    """Encodes a broadcast dict in the given wire format"""
+    if wire_format == constants.FORMAT_JSON:
+        return json.dumps(_with_pem_keys(doc))
+    elif wire_format == constants.FORMAT_BINARY:
+        return encode_binary(doc)
+    raise ValueError('Unknown wire format {}'.format(wire_format))
+
+
+def decode(data: Union[str, bytes]) -> dict:
+    """Decodes a message in any wire format into a broadcast dict"""
+    if format_of(data) == constants.FORMAT_BINARY:
+        return decode_binary(data)
+
+    try:
+        return json.loads(data)
+    except ValueError:
+        raise ParseMessageError
+
+
+def encode_binary(doc: dict) -> bytes:
+    b_type = doc.get('type')
+    type_code = TYPE_CODES.get(b_type, TYPE_OTHER)
+
+    out = bytearray()
+    if type_code != TYPE_OTHER:
+        PACKERS[b_type](out, doc['package'])
+    else:
+        out += json.dumps(_with_pem_keys(doc)).encode(
+            constants.STRING_ENCODING)
+
+    return HEADER.pack(MAGIC, BINARY_VERSION, type_code,
+                       len(out)) + bytes(out)
+
+
+def decode_binary(data: bytes) -> dict:
+    try:
+        magic, version, type_code, length = HEADER.unpack_from(data)
+    except struct.error:
+        raise ParseMessageError
+
+    if magic != MAGIC or version != BINARY_VERSION or \
+            len(data) != HEADER.size + length:
+        raise ParseMessageError
+
+    if type_code == TYPE_OTHER:
+        try:
+            return json.loads(data[HEADER.size:].decode(
+                constants.STRING_ENCODING))
+        except ValueError:
+            raise ParseMessageError
+
+    b_type = TYPE_NAMES.get(type_code)
+    if b_type is None:
+        raise UnknownBroadcastType
+
+    reader = _Reader(data, HEADER.size)
+    try:
+        package = getattr(reader, READERS[b_type])()
+    except (struct.error, IndexError, KeyError, UnicodeDecodeError):
+        raise ParseMessageError
+
+    if reader.offset != len(data):
+        raise ParseMessageError
+
+    return {'type': b_type, 'package': package}
+
+
+def _with_pem_keys(doc: dict) -> dict:
+    """
+    Returns the broadcast dict with any DER public keys, as decoded from the
+    binary format, exported as PEM strings for JSON
+    """
+    # Imported here since core imports this module
+    from lambdacoin.core import export_public_key, import_public_key
+
+    def pem(transaction_doc):
+        if transaction_doc is None or \
+                not isinstance(transaction_doc.get('public_key'), bytes):
+            return transaction_doc
+        transaction_doc = dict(transaction_doc)
+        transaction_doc['public_key'] = export_public_key(
+            import_public_key(transaction_doc['public_key']))
+        return transaction_doc
+
+    def pem_block(block_doc):
+        block_doc = dict(block_doc)
+        block_doc['gen_transaction'] = pem(block_doc.get('gen_transaction'))
+        return block_doc
+
+    package = doc.get('package')
+    b_type = doc.get('type')
+    if b_type == constants.B_TYPE_TRANSACTION:
+        converted = pem(package)
+    elif b_type == constants.B_TYPE_SOLUTION:
+        converted = pem_block(package)
+    elif b_type in (constants.B_TYPE_BLOCKS, constants.B_TYPE_TRANSACTIONS):
+        converted = dict(package)
+        converted['transactions'] = [
+            pem(t) for t in package.get('transactions') or []]
+        if b_type == constants.B_TYPE_BLOCKS:
+            converted['blocks'] = [
+                pem_block(b) for b in package.get('blocks') or []]
+    else:
+        return doc
+
+    return dict(doc, package=converted)
+
+
+def _der_key(public_key):
+    """Converts an exported public key to DER, reusing earlier conversions"""
+    # Imported here since core imports this module
+    from lambdacoin.core import import_public_key
+
+    key = import_public_key(public_key)
+    cache_key = (key.n, key.e)
+    der = der_key_cache.get(cache_key)
+    if der is None:
+        der = key.exportKey('DER')
+        der_key_cache.put(cache_key, der)
+    return der
+
+
+def _pack_text(out: bytearray, text: str):
+    data = text.encode(constants.STRING_ENCODING)
+    out += U32.pack(len(data))
+    out += data
+
+
+def _pack_hash(out: bytearray, value: str):
+    if len(value) == 40:
+        try:
+            digest = bytes.fromhex(value)
+        except ValueError:
+            digest = None
+
+        # Only lowercase hex comes back out of the digest unchanged
+        if digest is not None and digest.hex() == value:
+            out += U8.pack(HASH_DIGEST)
+            out += digest
+            return
+
+    out += U8.pack(HASH_TEXT)
+    _pack_text(out, value)
+
+
+def _pack_optional(out: bytearray, value: bytes):
+    """Packs bytes, with None distinguished from empty"""
+    if value is None:
+        out += U8.pack(0)
+    else:
+        out += U8.pack(1)
+        out += U32.pack(len(value))
+        out += value
+
+
+def _pack_optional_hash(out: bytearray, value: str):
+    if value is None:
+        out += U8.pack(0)
+    else:
+        out += U8.pack(1)
+        _pack_hash(out, value)
+
+
+def _pack_transaction(out: bytearray, doc: dict):
+    _pack_text(out, doc.get('version') or constants.VERSION)
+    _pack_hash(out, doc['hash'])
+
+    public_key = doc.get('public_key')
+    _pack_optional(out, None if public_key is None else _der_key(public_key))
+
+    sig = doc.get('sig')
+    if sig is None:
+        out += U8.pack(0)
+    else:
+        out += U8.pack(1)
+        out += U8.pack(len(sig))
+        for number in sig:
+            number_bytes = number.to_bytes((number.bit_length() + 7) // 8,
+                                           'big')
+            out += U16.pack(len(number_bytes))
+            out += number_bytes
+
+    inputs = doc.get('inputs') or []
+    out += U32.pack(len(inputs))
+    for tx_input in inputs:
+        _pack_hash(out, tx_input['hash'])
+        out += U32.pack(tx_input['n'])
+
+    outputs = doc.get('outputs') or {}
+    out += U32.pack(len(outputs))
+    for address, value in outputs.items():
+        _pack_hash(out, address)
+        if isinstance(value, int):
+            out += U8.pack(VALUE_INT)
+            out += I64.pack(value)
+        else:
+            out += U8.pack(VALUE_FLOAT)
+            out += F64.pack(value)
+
+
+def _pack_block(out: bytearray, doc: dict):
+    _pack_text(out, doc.get('version') or constants.VERSION)
+    _pack_hash(out, doc['hash'])
+    _pack_optional_hash(out, doc.get('prev_hash'))
+    target = doc.get('target')
+    out += U16.pack(NO_TARGET if target is None else target)
+
+    solution = doc.get('solution')
+    _pack_optional(out, None if solution is None
+                   else solution.encode(constants.STRING_ENCODING))
+
+    gen_transaction = doc.get('gen_transaction')
+    if gen_transaction is None:
+        _pack_optional(out, None)
+    else:
+        gen_out = bytearray()
+        _pack_transaction(gen_out, gen_transaction)
+        _pack_optional(out, bytes(gen_out))
+
+    transactions = doc.get('transactions') or []
+    out += U32.pack(len(transactions))
+    for transaction_hash in transactions:
+        _pack_hash(out, transaction_hash)
+
+
+def _pack_inventory(out: bytearray, doc: dict):
+    """Packs the package of an inventory or getdata broadcast"""
+    _pack_text(out, doc.get('from') or '')
+
+    items = doc.get('items') or []
+    out += U32.pack(len(items))
+    for item in items:
+        out += U8.pack(TYPE_CODES[item['type']])
+        _pack_hash(out, item['hash'])
+
+
+def _pack_request(out: bytearray, doc: dict):
+    """Packs the sender and request number that start sync messages"""
+    _pack_text(out, doc.get('from') or '')
+    request = doc.get('request')
+    out += U32.pack(NO_REQUEST if request is None else request)
+
+
+def _pack_range(out: bytearray, doc: dict):
+    """Packs the package of a getheaders or getblocks broadcast"""
+    _pack_request(out, doc)
+    out += U32.pack(doc['start'])
+    out += U32.pack(doc['count'])
+
+
+def _pack_headers(out: bytearray, doc: dict):
+    _pack_request(out, doc)
+    out += U32.pack(doc['start'])
+    out += U32.pack(doc['height'])
+
+    headers = doc.get('headers') or []
+    out += U32.pack(len(headers))
+    for header in headers:
+        _pack_hash(out, header['hash'])
+        _pack_optional_hash(out, header.get('prev_hash'))
+        target = header.get('target')
+        out += U16.pack(NO_TARGET if target is None else target)
+        solution = header.get('solution')
+        _pack_optional(out, None if solution is None
+                       else solution.encode(constants.STRING_ENCODING))
+        _pack_hash(out, header['merkle_root'])
+
+
+def _pack_blocks(out: bytearray, doc: dict):
+    _pack_request(out, doc)
+    out += U32.pack(doc['start'])
+
+    blocks = doc.get('blocks') or []
+    out += U32.pack(len(blocks))
+    for block in blocks:
+        _pack_block(out, block)
+
+    _pack_transaction_list(out, doc.get('transactions') or [])
+
+
+def _pack_get_transactions(out: bytearray, doc: dict):
+    _pack_request(out, doc)
+
+    hashes = doc.get('hashes') or []
+    out += U32.pack(len(hashes))
+    for transaction_hash in hashes:
+        _pack_hash(out, transaction_hash)
+
+
+def _pack_transactions(out: bytearray, doc: dict):
+    _pack_request(out, doc)
+    _pack_transaction_list(out, doc.get('transactions') or [])
+
+
+def _pack_transaction_list(out: bytearray, transactions: list):
+    out += U32.pack(len(transactions))
+    for transaction in transactions:
+        _pack_transaction(out, transaction)
+
+
+PACKERS = {
+    constants.B_TYPE_TRANSACTION: _pack_transaction,
+    constants.B_TYPE_SOLUTION: _pack_block,
+    constants.B_TYPE_INVENTORY: _pack_inventory,
+    constants.B_TYPE_GET_DATA: _pack_inventory,
+    constants.B_TYPE_GET_HEADERS: _pack_range,
+    constants.B_TYPE_HEADERS: _pack_headers,
+    constants.B_TYPE_GET_BLOCKS: _pack_range,
+    constants.B_TYPE_BLOCKS: _pack_blocks,
+    constants.B_TYPE_GET_TRANSACTIONS: _pack_get_transactions,
+    constants.B_TYPE_TRANSACTIONS: _pack_transactions,
+}
+
+# Names of the _Reader methods that read each broadcast type
+READERS = {
+    constants.B_TYPE_TRANSACTION: 'transaction',
+    constants.B_TYPE_SOLUTION: 'block',
+    constants.B_TYPE_INVENTORY: 'inventory',
+    constants.B_TYPE_GET_DATA: 'inventory',
+    constants.B_TYPE_GET_HEADERS: 'range',
+    constants.B_TYPE_HEADERS: 'headers',
+    constants.B_TYPE_GET_BLOCKS: 'range',
+    constants.B_TYPE_BLOCKS: 'blocks',
+    constants.B_TYPE_GET_TRANSACTIONS: 'get_transactions',
+    constants.B_TYPE_TRANSACTIONS: 'transactions',
+}
+
+
+class _Reader(object):
+    def __init__(self, data: bytes, offset: int = 0):
+        self.data = data
+        self.offset = offset
+
+    def _unpack(self, fmt: struct.Struct):
+        value, = fmt.unpack_from(self.data, self.offset)
+        self.offset += fmt.size
+        return value
+
+    def _bytes(self, length: int) -> bytes:
+        end = self.offset + length
+        if end > len(self.data):
+            raise IndexError
+        value = self.data[self.offset:end]
+        self.offset = end
+        return value
+
+    def text(self) -> str:
+        return self._bytes(self._unpack(U32)).decode(
+            constants.STRING_ENCODING)
+
+    def hash(self) -> str:
+        tag = self._unpack(U8)
+        if tag == HASH_DIGEST:
+            return self._bytes(20).hex()
+        return self.text()
+
+    def optional_hash(self):
+        if not self._unpack(U8):
+            return None
+        return self.hash()
+
+    def optional(self):
+        if not self._unpack(U8):
+            return None
+        return self._bytes(self._unpack(U32))
+
+    def count(self) -> int:
+        return self._unpack(U32)
+
+    def target(self):
+        target = self._unpack(U16)
+        return None if target == NO_TARGET else target
+
+    def signature(self):
+        if not self._unpack(U8):
+            return None
+        return [int.from_bytes(self._bytes(self._unpack(U16)), 'big')
+                for _ in range(self._unpack(U8))]
+
+    def transaction(self) -> dict:
+        version = self.text()
+        transaction_hash = self.hash()
+        public_key = self.optional()
+        sig = self.signature()
+
+        inputs = []
+        for _ in range(self._unpack(U32)):
+            inputs.append({'hash': self.hash(), 'n': self._unpack(U32)})
+
+        outputs = {}
+        for _ in range(self._unpack(U32)):
+            address = self.hash()
+            if self._unpack(U8) == VALUE_INT:
+                outputs[address] = self._unpack(I64)
+            else:
+                outputs[address] = self._unpack(F64)
+
+        return {
+            'version': version,
+            'hash': transaction_hash,
+            'public_key': public_key,
+            'sig': sig,
+            'inputs': inputs,
+            'outputs': outputs,
+        }
+
+    def block(self) -> dict:
+        version = self.text()
+        block_hash = self.hash()
+        prev_hash = self.optional_hash()
+        target = self.target()
+
+        solution = self.optional()
+        if solution is not None:
+            solution = solution.decode(constants.STRING_ENCODING)
+
+        gen_transaction = self.optional()
+        if gen_transaction is not None:
+            gen_transaction = _Reader(gen_transaction).transaction()
+
+        transactions = [self.hash() for _ in range(self._unpack(U32))]
+
+        return {
+            'version': version,
+            'hash': block_hash,
+            'prev_hash': prev_hash,
+            'target': target,
+            'solution': solution,
+            'gen_transaction': gen_transaction,
+            'transactions': transactions,
+        }
+
+    def inventory(self) -> dict:
+        node_id = self.text() or None
+
+        items = []
+        for _ in range(self._unpack(U32)):
+            item_type = TYPE_NAMES[self._unpack(U8)]
+            items.append({'type': item_type, 'hash': self.hash()})
+
+        return {'from': node_id, 'items': items}
+
+    def _request(self):
+        """Reads the sender and request number that start sync messages"""
+        node_id = self.text() or None
+        request = self._unpack(U32)
+        return node_id, None if request == NO_REQUEST else request
+
+    def range(self) -> dict:
+        node_id, request = self._request()
+        return {'from': node_id, 'request': request,
+                'start': self._unpack(U32), 'count': self._unpack(U32)}
+
+    def headers(self) -> dict:
+        node_id, request = self._request()
+        start = self._unpack(U32)
+        height = self._unpack(U32)
+
+        headers = []
+        for _ in range(self._unpack(U32)):
+            block_hash = self.hash()
+            prev_hash = self.optional_hash()
+            target = self._unpack(U16)
+            solution = self.optional()
+            headers.append({
+                'hash': block_hash,
+                'prev_hash': prev_hash,
+                'target': None if target == NO_TARGET else target,
+                'solution': None if solution is None
+                else solution.decode(constants.STRING_ENCODING),
+                'merkle_root': self.hash(),
+            })
+
+        return {'from': node_id, 'request': request, 'start': start,
+                'height': height, 'headers': headers}
+
+    def blocks(self) -> dict:
+        node_id, request = self._request()
+        start = self._unpack(U32)
+        blocks = [self.block() for _ in range(self._unpack(U32))]
+        return {'from': node_id, 'request': request, 'start': start,
+                'blocks': blocks, 'transactions': self.transaction_list()}
+
+    def get_transactions(self) -> dict:
+        node_id, request = self._request()
+        hashes = [self.hash() for _ in range(self._unpack(U32))]
+        return {'from': node_id, 'request': request, 'hashes': hashes}
+
+    def transactions(self) -> dict:
+        node_id, request = self._request()
+        return {'from': node_id, 'request': request,
+                'transactions': self.transaction_list()}
+
+    def transaction_list(self) -> list:
+        return [self.transaction() for _ in range(self._unpack(U32))]
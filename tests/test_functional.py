@@ -1,18 +1,38 @@
 import os
 import json
+import shutil
 import sys
+import tempfile
+import time
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import asyncio
+import contextlib
+import io
 import unittest
+from unittest import mock
 
+from lambdacoin.broadcast import (
+    AsyncLocalBroadcastNode, TCPBroadcastNode, TCPBroadcastServer)
+from lambdacoin.chain import Blockchain
+from lambdacoin.cli import main
 from lambdacoin.core import Block, Transaction, Client, LocalBroadcastNode
-from lambdacoin.constants import SOLUTION_REWARD
+from lambdacoin.constants import (
+    B_TYPE_GET_BLOCKS, B_TYPE_GET_DATA, B_TYPE_GET_HEADERS,
+    B_TYPE_GET_TRANSACTIONS, B_TYPE_INVENTORY, B_TYPE_SOLUTION,
+    B_TYPE_TRANSACTION, B_TYPE_TRANSACTIONS, FORMAT_BINARY, FORMAT_JSON,
+    RELAY_FLOOD, RELAY_INVENTORY, SOLUTION_REWARD)
 from lambdacoin.exceptions import UnknownBroadcastType
+from lambdacoin.mining import Miner
+from lambdacoin.simulation import Simulation, TOPOLOGY_RING
+from lambdacoin.snapshot import export_snapshot
+from lambdacoin.utxo import UTXOSet
+import lambdacoin.wire as wire
 
 
 class FunctionalTests(unittest.TestCase):
     def setUp(self):
-        self.blockchain1 = Block()
-        self.blockchain2 = Block()
+        self.blockchain1 = Block.genesis()
+        self.blockchain2 = Block.genesis()
 
         self.client1 = Client(name='client1', blockchain=self.blockchain1)
         self.broadcast_node_1 = LocalBroadcastNode(self.client1)
@@ -45,10 +65,71 @@ class FunctionalTests(unittest.TestCase):
         self.assertEqual(expected_final_value, self.client2.total_value())
 
         # Assessment of each other's value
-        self.assertEqual(
-            expected_final_value, self.client1.total_value(self.client2.addresses))
+        self.assertEqual(expected_final_value,
+                         self.client1.total_value(self.client2.addresses))
         self.assertEqual(0, self.client2.total_value(self.client1.addresses))
 
+    def test_metrics(self):
+        """Tests that clients record what they receive and verify"""
+        transaction = Transaction(outputs={self.client2.addresses[0]: 1})
+        self.client1.broadcast_transaction(transaction)
+
+        snapshot = self.client2.metrics.snapshot()
+        self.assertEqual({B_TYPE_TRANSACTION: 1},
+                         snapshot['lambdacoin_broadcasts_received_total'])
+        self.assertEqual(1, snapshot['lambdacoin_mempool_transactions'])
+        self.assertEqual(
+            1, snapshot['lambdacoin_signature_verify_seconds']['count'])
+
+        self.client1.mine_current_block()
+        snapshot = self.client2.metrics.snapshot()
+        self.assertEqual(1, snapshot['lambdacoin_broadcasts_received_total'][
+            B_TYPE_SOLUTION])
+        self.assertEqual(
+            1, snapshot['lambdacoin_solution_verify_seconds']['count'])
+        self.assertEqual(0, snapshot['lambdacoin_mempool_transactions'])
+        self.assertEqual(1, snapshot['lambdacoin_chain_height'])
+        self.assertEqual(1, self.client1.metrics.snapshot()[
+            'lambdacoin_blocks_mined_total'])
+        self.assertIn('lambdacoin_hashes_total',
+                      self.client1.metrics.to_prometheus())
+
+    def test_mempool_cleared_by_solution(self):
+        """Tests that confirmed transactions leave every client's mempool"""
+        transaction = Transaction(outputs={self.client2.addresses[0]: 1})
+        self.client1.broadcast_transaction(transaction)
+
+        self.assertIn(transaction.hash, self.client1.mempool)
+        self.assertIn(transaction.hash, self.client2.mempool)
+
+        self.client2.mine_current_block()
+
+        for client in (self.client1, self.client2):
+            self.assertEqual(0, len(client.mempool))
+            self.assertEqual([], client.current_block.transactions)
+            self.assertEqual(1, client.blockchain.height)
+
+    def test_mixed_wire_formats(self):
+        """Tests relaying between clients that negotiated different formats
+
+        client1 <-binary-> client2 <-json-> client3
+        """
+        client3 = Client(name='client3', wire_formats=[FORMAT_JSON])
+        broadcast_node_3 = LocalBroadcastNode(client3)
+        self.client2.register_broadcast_node(broadcast_node_3)
+        client3.register_broadcast_node(LocalBroadcastNode(self.client2))
+        self.assertEqual(FORMAT_BINARY, self.broadcast_node_2.wire_format)
+        self.assertEqual(FORMAT_JSON, broadcast_node_3.wire_format)
+
+        transaction = Transaction(outputs={client3.addresses[0]: 3})
+        self.client1.broadcast_transaction(transaction)
+        self.assertIn(transaction.hash, client3.mempool)
+
+        self.client1.mine_current_block()
+        self.assertEqual(3, client3.total_value())
+        self.assertEqual(SOLUTION_REWARD,
+                         client3.total_value(self.client1.addresses))
+
     def test_unknown_broadcast_type(self):
         """Tests that an UnknownBroadcastType exception is raised if an
         unknown broadcast type is received"""
@@ -61,5 +142,709 @@ class FunctionalTests(unittest.TestCase):
         with self.assertRaises(UnknownBroadcastType):
             self.client1.broadcast(data)
 
+class CountingBroadcastNode(LocalBroadcastNode):
+    """Counts the broadcasts of each type that pass through it"""
+
+    def __init__(self, client, counts):
+        super().__init__(client)
+        self.counts = counts
+
+    def broadcast(self, data):
+        b_type = wire.decode(data)['type']
+        self.counts[b_type] = self.counts.get(b_type, 0) + 1
+        super().broadcast(data)
+
+
+class RelayTests(unittest.TestCase):
+    def make_network(self, size, relay_mode):
+        """Connects `size` clients to each other, counting broadcasts"""
+        counts = {}
+        clients = [Client(name='client{}'.format(i), relay_mode=relay_mode)
+                   for i in range(size)]
+        for client in clients:
+            for other in clients:
+                if other is not client:
+                    client.register_broadcast_node(
+                        CountingBroadcastNode(other, counts))
+        return clients, counts
+
+    def test_flood_duplicates_dropped(self):
+        """Tests that flooded duplicates are dropped before parsing"""
+        clients, counts = self.make_network(4, RELAY_FLOOD)
+        transaction = Transaction(outputs={'alice': 1})
+        clients[0].broadcast_transaction(transaction)
+
+        for client in clients:
+            self.assertIn(transaction.hash, client.mempool)
+
+        # Every node sends the full transaction to every other node
+        self.assertEqual(12, counts[B_TYPE_TRANSACTION])
+        self.assertEqual(12 - 3, sum(c.duplicates for c in clients))
+
+    def test_inventory_relay(self):
+        """Tests that each client fetches each body once in inventory mode"""
+        clients, counts = self.make_network(4, RELAY_INVENTORY)
+        transaction = Transaction(outputs={clients[3].addresses[0]: 2})
+        clients[0].broadcast_transaction(transaction)
+
+        for client in clients:
+            self.assertIn(transaction.hash, client.mempool)
+        self.assertEqual(3, counts[B_TYPE_TRANSACTION])
+        self.assertEqual(3, counts[B_TYPE_GET_DATA])
+
+        clients[1].mine_current_block()
+        for client in clients:
+            self.assertEqual(1, client.blockchain.height)
+            self.assertEqual(2, client.total_value(clients[3].addresses))
+        self.assertEqual(3, counts[B_TYPE_SOLUTION])
+
+    def test_inventory_retry(self):
+        """Tests asking another announcer when the first doesn't deliver"""
+        client = Client(name='client', relay_mode=RELAY_INVENTORY)
+        silent = Client(name='silent')
+        holder = Client(name='holder')
+        counts = {}
+        for peer in (silent, holder):
+            client.register_broadcast_node(CountingBroadcastNode(peer, counts))
+        holder.register_broadcast_node(LocalBroadcastNode(client))
+
+        transaction = Transaction(outputs={'alice': 1})
+        transaction.sign(holder.key)
+        holder.accept_transaction(transaction)
+        items = [{'type': B_TYPE_TRANSACTION, 'hash': transaction.hash}]
+
+        def announce(node_id):
+            client.receive_broadcast(wire.encode(client.package_for_broadcast(
+                B_TYPE_INVENTORY, {'from': node_id, 'items': items}),
+                FORMAT_JSON))
+
+        # The silent peer announced first, so it's asked and never replies
+        announce('silent')
+        announce('holder')
+        self.assertEqual(1, counts[B_TYPE_GET_DATA])
+        self.assertIn(transaction.hash, client.requested)
+
+        # Nothing to do until the request times out
+        self.assertEqual(0, client.retry_requests())
+        self.assertEqual(1, client.retry_requests(
+            time.monotonic() + client.request_timeout))
+        self.assertEqual(2, counts[B_TYPE_GET_DATA])
+        self.assertIn(transaction.hash, client.mempool)
+        self.assertNotIn(transaction.hash, client.requested)
+
+        # With no other announcer, an expired request is forgotten so the
+        # next announcement asks again
+        other = Transaction(outputs={'bob': 1})
+        items = [{'type': B_TYPE_TRANSACTION, 'hash': other.hash}]
+        announce('silent')
+        self.assertEqual(0, client.retry_requests(
+            time.monotonic() + client.request_timeout))
+        self.assertNotIn(other.hash, client.requested)
+        announce('holder')
+        self.assertEqual(4, counts[B_TYPE_GET_DATA])
+
+
+class IngestTests(unittest.TestCase):
+    def test_receive_broadcasts(self):
+        """Tests taking a backlog of transactions through the pipeline"""
+        counts = {}
+        client1, client2 = Client(name='client1'), Client(name='client2')
+        client1.register_broadcast_node(CountingBroadcastNode(client2, counts))
+
+        key = Client().key
+        funding = Transaction(outputs={'alice': 5})
+        funding.sign(key)
+        client1.accept_transaction(funding)
+        client2.accept_transaction(funding)
+        client1.mine_current_block()
+
+        def message(transaction, sign=True):
+            if sign:
+                transaction.sign(key)
+            return wire.encode(client1.package_for_broadcast(
+                B_TYPE_TRANSACTION, transaction.to_dict()), FORMAT_BINARY)
+
+        good = [Transaction(outputs={'bob': i}) for i in range(44)]
+        spend = Transaction(inputs=[{'hash': funding.hash, 'n': 0}],
+                            outputs={'bob': 5})
+        double_spend = Transaction(inputs=[{'hash': funding.hash, 'n': 0}],
+                                   outputs={'carol': 5})
+        unsigned = Transaction(outputs={'carol': 1})
+        messages = [message(t) for t in good[:20]]
+        messages += [messages[0], message(spend), message(double_spend),
+                     message(unsigned, sign=False),
+                     message(Transaction(outputs={'carol': -1})), b'junk']
+        messages += [message(t) for t in good[20:]]
+
+        self.assertEqual(45, client1.receive_broadcasts(messages,
+                                                        batch_size=10))
+        for transaction in good + [spend]:
+            self.assertIn(transaction.hash, client1.mempool)
+            self.assertIn(transaction.hash, client2.mempool)
+        self.assertNotIn(double_spend.hash, client1.mempool)
+
+        # One relay per batch of 10
+        self.assertEqual(5, counts[B_TYPE_TRANSACTIONS])
+        self.assertNotIn(B_TYPE_TRANSACTION, counts)
+
+        stats = client1.ingest_stats()
+        self.assertEqual({'passed': 47, 'dropped': 3},
+                         {k: stats['check'][k] for k in ('passed', 'dropped')})
+        self.assertEqual(1, stats['verify']['dropped'])
+        self.assertEqual(1, stats['inputs']['dropped'])
+        self.assertEqual(45, stats['relay']['passed'])
+
+
+class SyncTests(unittest.TestCase):
+    def connect(self, client1, client2, counts):
+        client1.register_broadcast_node(CountingBroadcastNode(client2, counts))
+        client2.register_broadcast_node(CountingBroadcastNode(client1, counts))
+
+    def test_sync_new_node(self):
+        """Tests that a new node downloads a chain in batches"""
+        miner = Client(name='miner')
+        for i in range(30):
+            miner.broadcast_transaction(Transaction(outputs={'alice': i}))
+            miner.mine_current_block()
+
+        counts = {}
+        client = Client(name='client')
+        self.connect(miner, client, counts)
+        self.assertTrue(client.sync(batch_size=8, window=2))
+
+        self.assertIsNone(client.sync_state)
+        self.assertEqual(30, client.blockchain.height)
+        self.assertEqual(miner.blockchain.tip.hash, client.blockchain.tip.hash)
+        self.assertEqual(sum(range(30)), client.total_value(['alice']))
+        self.assertEqual(30 * SOLUTION_REWARD,
+                         client.total_value(miner.addresses))
+        # 30 blocks in batches of 8
+        self.assertEqual(4, counts[B_TYPE_GET_BLOCKS])
+
+        # Nothing new to download
+        client.sync()
+        self.assertEqual(4, counts[B_TYPE_GET_BLOCKS])
+
+    def test_solution_with_missing_transactions(self):
+        """Tests that a solution waits for transactions it's missing"""
+        counts = {}
+        client1, client2 = Client(name='client1'), Client(name='client2')
+        self.connect(client1, client2, counts)
+
+        # Only client1 has the transaction
+        transaction = Transaction(outputs={client2.addresses[0]: 4})
+        transaction.sign(client1.key)
+        client1.accept_transaction(transaction)
+        client1.mine_current_block()
+
+        self.assertEqual(1, counts[B_TYPE_GET_TRANSACTIONS])
+        self.assertEqual(1, client2.blockchain.height)
+        self.assertEqual(4, client2.total_value())
+        self.assertEqual({}, dict(client2.pending_solutions))
+        self.assertNotIn(transaction.hash, client2.mempool)
+
+    def test_sync_from_snapshot(self):
+        """Tests a new node taking balances from a snapshot as it syncs"""
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        snapshot_path = os.path.join(path, 'utxos.snap')
+
+        miner = Client(name='miner')
+        for i in range(5):
+            miner.broadcast_transaction(Transaction(outputs={'alice': i}))
+            miner.mine_current_block()
+        export_snapshot(miner.blockchain, snapshot_path)
+        miner.broadcast_transaction(Transaction(outputs={'alice': 10}))
+        miner.mine_current_block()
+
+        client = Client(name='client')
+        verifier = client.load_snapshot(snapshot_path)
+        self.connect(miner, client, {})
+
+        # The chain doesn't reach the snapshot yet
+        self.assertIsNone(client.verify_history())
+
+        with mock.patch.object(UTXOSet, 'from_blocks') as from_blocks:
+            client.sync()
+            self.assertEqual(20, client.total_value(['alice']))
+            self.assertEqual(6 * SOLUTION_REWARD,
+                             client.total_value(miner.addresses))
+            from_blocks.assert_not_called()
+
+        self.assertTrue(client.verify_history())
+        self.assertIsNone(client.history_verifier)
+        self.assertTrue(verifier.result)
+
+    def test_reorg_to_heavier_fork(self):
+        """Tests that a node switches to a longer fork mined elsewhere"""
+        client1, client2 = Client(name='client1'), Client(name='client2')
+
+        # Mined apart, client1 confirms a transaction that client2 never saw
+        transaction = Transaction(outputs={'alice': 4})
+        transaction.sign(client1.key)
+        client1.accept_transaction(transaction)
+        self.assertIsNotNone(client1.mine_current_block())
+        for _ in range(2):
+            self.assertIsNotNone(client2.mine_current_block())
+        self.assertEqual(4, client1.total_value(['alice']))
+
+        # client1 hasn't seen the parent of client2's next block, so it
+        # syncs the fork, which has more work than its own chain
+        counts = {}
+        self.connect(client1, client2, counts)
+        self.assertIsNotNone(client2.mine_current_block())
+
+        self.assertEqual(1, counts[B_TYPE_GET_HEADERS])
+        self.assertEqual(3, client1.blockchain.height)
+        self.assertEqual(client2.blockchain.tip.hash,
+                         client1.blockchain.tip.hash)
+        self.assertEqual(0, client1.total_value())
+        self.assertEqual(3 * SOLUTION_REWARD,
+                         client1.total_value(client2.addresses))
+
+        # The transaction is unconfirmed again, and mined on the new tip
+        self.assertEqual(0, client1.total_value(['alice']))
+        self.assertIn(transaction.hash, client1.mempool)
+        self.assertTrue(client1.current_block.has_transaction(transaction))
+        self.assertEqual(client1.blockchain.tip.hash,
+                         client1.current_block.prev_hash)
+
+    def test_reorg_rechecks_inputs(self):
+        """Tests that a reorg doesn't return spends of vanished outputs"""
+        client1, client2 = Client(name='client1'), Client(name='client2')
+
+        # client1 spends the reward of its first block in its second
+        self.assertIsNotNone(client1.mine_current_block())
+        first = client1.blockchain.tip
+        spend = Transaction(
+            inputs=[{'hash': first.gen_transaction.hash, 'n': 0}],
+            outputs={'alice': SOLUTION_REWARD})
+        spend.sign(client1.key)
+        unspent = Transaction(outputs={'bob': 1})
+        unspent.sign(client1.key)
+        for transaction in (spend, unspent):
+            client1.accept_transaction(transaction)
+        self.assertIsNotNone(client1.mine_current_block())
+
+        for _ in range(2):
+            self.assertIsNotNone(client2.mine_current_block())
+        self.connect(client1, client2, {})
+        self.assertIsNotNone(client2.mine_current_block())
+        self.assertEqual(client2.blockchain.tip.hash,
+                         client1.blockchain.tip.hash)
+
+        # The reward it spent isn't on the new chain
+        self.assertNotIn(spend.hash, client1.mempool)
+        self.assertIn(unspent.hash, client1.mempool)
+
+    def test_conflicting_spend_confirmed(self):
+        """Tests that a block confirming a double spend evicts the other"""
+        client1, client2 = Client(name='client1'), Client(name='client2')
+        self.connect(client1, client2, {})
+        self.assertIsNotNone(client1.mine_current_block())
+        reward = {'hash': client1.blockchain.tip.gen_transaction.hash, 'n': 0}
+
+        # client1 pools a spend of its reward and a child of that spend
+        spend = Transaction(inputs=[reward],
+                            outputs={client1.addresses[0]: SOLUTION_REWARD})
+        spend.sign(client1.key)
+        child = Transaction(inputs=[{'hash': spend.hash, 'n': 0}],
+                            outputs={'alice': SOLUTION_REWARD})
+        child.sign(client1.key)
+        for transaction in (spend, child):
+            client1.accept_transaction(transaction)
+
+        # client2 only sees another spend of the same reward, and mines it
+        conflict = Transaction(inputs=[reward],
+                               outputs={'bob': SOLUTION_REWARD})
+        conflict.sign(client1.key)
+        client2.accept_transaction(conflict)
+        self.assertIsNotNone(client2.mine_current_block())
+        self.assertEqual(client2.blockchain.tip.hash,
+                         client1.blockchain.tip.hash)
+
+        self.assertNotIn(spend.hash, client1.mempool)
+        self.assertNotIn(child.hash, client1.mempool)
+        self.assertFalse(client1.current_block.has_transaction(spend))
+        self.assertEqual(SOLUTION_REWARD, client1.total_value(['bob']))
+
+    def test_low_target_fork_rejected(self):
+        """Tests that blocks below the chain's target can't win a reorg"""
+        client = Client(name='client')
+        self.assertIsNotNone(client.mine_current_block())
+        tip = client.blockchain.tip
+
+        # A longer fork of blocks that need no work at all
+        attacker = Client(name='attacker',
+                          blockchain=Blockchain(Block.genesis(), target=0))
+        for _ in range(5):
+            self.assertIsNotNone(attacker.mine_current_block())
+
+        counts = {}
+        self.connect(client, attacker, counts)
+        attacker.mine_current_block()
+        client.sync('attacker')
+
+        self.assertEqual(1, counts[B_TYPE_GET_BLOCKS])
+        self.assertIs(tip, client.blockchain.tip)
+        self.assertFalse(client.blockchain.side_blocks)
+        self.assertFalse(client.blockchain.orphans)
+        self.assertEqual(0, client.total_value(attacker.addresses))
+
+    def test_solution_without_parent_rejected(self):
+        """Tests that a solution not bound to a parent isn't added"""
+        client = Client(name='client')
+        block = Block(gen_transaction=Transaction(outputs={'mallory': 1}))
+        block.solution = Miner().mine(block.puzzle, block.target, 0, 100000)
+        self.assertTrue(block.verify())
+
+        client.receive_broadcast(wire.encode(client.package_for_broadcast(
+            B_TYPE_SOLUTION, block.to_dict()), FORMAT_JSON))
+        self.assertEqual(0, client.blockchain.height)
+        self.assertEqual(0, client.total_value(['mallory']))
+
+
+class AsyncBroadcastTests(unittest.TestCase):
+    def connect(self, clients, **kwargs):
+        """Connects every client to every other client"""
+        nodes = []
+        for client in clients:
+            for other in clients:
+                if other is not client:
+                    node = AsyncLocalBroadcastNode(other, **kwargs)
+                    client.register_broadcast_node(node)
+                    nodes.append(node)
+        return nodes
+
+    async def settle(self, clients, nodes):
+        """Waits until no messages are left in flight"""
+        while True:
+            for node in nodes:
+                await node.drain()
+            for client in clients:
+                await client.inbox.join()
+            if all(node.queue.empty() for node in nodes):
+                return
+
+    def test_async_transactions(self):
+        """Tests a transaction and solution spreading through async nodes"""
+        async def run():
+            clients = [Client(name='client{}'.format(i)) for i in range(3)]
+            nodes = self.connect(clients)
+            loops = [asyncio.ensure_future(c.receive_loop()) for c in clients]
+
+            transaction = Transaction(outputs={clients[2].addresses[0]: 5})
+            clients[0].broadcast_transaction(transaction)
+            await self.settle(clients, nodes)
+
+            for client in clients:
+                self.assertIn(transaction.hash, client.mempool)
+
+            clients[1].mine_current_block()
+            await self.settle(clients, nodes)
+
+            for client in clients:
+                self.assertEqual(1, client.blockchain.height)
+                self.assertEqual(5, client.total_value(clients[2].addresses))
+
+            for task in loops:
+                task.cancel()
+            for node in nodes:
+                node.close()
+                await node.wait_closed()
+
+        asyncio.run(run())
+
+    def test_slow_peer_isolated(self):
+        """Tests that a full queue to a slow peer doesn't hold up others"""
+        class SlowNode(AsyncLocalBroadcastNode):
+            async def deliver(self, data):
+                await asyncio.sleep(3600)
+
+        async def run():
+            sender = Client(name='sender')
+            fast = AsyncLocalBroadcastNode(Client(name='fast'))
+            slow = SlowNode(Client(name='slow'), max_queue=2)
+            sender.register_broadcast_node(slow)
+            sender.register_broadcast_node(fast)
+
+            for _ in range(5):
+                sender.broadcast_transaction(Transaction())
+            await fast.drain()
+
+            self.assertEqual(5, fast.sent)
+            self.assertEqual(5, fast.client.inbox.qsize())
+            self.assertEqual(0, slow.sent)
+            # The first two filled the queue before its task got to run
+            self.assertEqual(3, slow.dropped)
+
+            for node in (slow, fast):
+                node.close()
+                await node.wait_closed()
+
+        asyncio.run(run())
+
+
+class MiningSchedulerTests(unittest.TestCase):
+    def test_scheduler_follows_tip(self):
+        """
+        Tests that background mining drops its work when a competing block
+        arrives, then mines on top of it
+        """
+        async def run():
+            miner, other = Client(name='miner'), Client(name='other')
+            other.register_broadcast_node(LocalBroadcastNode(miner))
+            scheduler = miner.schedule_mining(round_size=10 ** 9)
+
+            # Too hard to solve, so the first round runs until interrupted
+            miner.current_block.target = 40
+            task = asyncio.ensure_future(scheduler.run())
+            while scheduler.template is None:
+                await asyncio.sleep(0.01)
+
+            other.broadcast_transaction(Transaction(outputs={'alice': 1}))
+            self.assertIsNotNone(other.mine_current_block())
+            while scheduler.blocks < 1:
+                await asyncio.sleep(0.01)
+            task.cancel()
+
+            self.assertEqual(1, scheduler.stale_rounds)
+            self.assertGreater(scheduler.stale_hashes, 0)
+            # Mined on top of the other client's block
+            self.assertEqual(other.blockchain.tip.hash,
+                             miner.blockchain.block_at(1).hash)
+            self.assertEqual(1 + scheduler.blocks, miner.blockchain.height)
+            self.assertEqual(scheduler.blocks, miner.total_value())
+
+            stats = scheduler.stats()
+            self.assertEqual(scheduler.hashes, stats['hashes'])
+            self.assertGreater(stats['hashrate'], 0)
+            self.assertEqual(1, miner.metrics.snapshot()[
+                'lambdacoin_mining_rounds_total']['stale'])
+
+        asyncio.run(run())
+
+
+class CommandLineTests(unittest.TestCase):
+    def test_mine_command(self):
+        """Tests mining blocks from the command line into a data directory"""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        argv = ['mine', '--name', 'miner', '--data-dir', directory,
+                '--listen', '127.0.0.1:0', '--regtest-target', '0',
+                '--blocks', '2', '--log-level', 'WARNING']
+
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout), \
+                contextlib.redirect_stderr(io.StringIO()) as stderr:
+            self.assertEqual(0, main(['profile', '--sample'] + argv))
+        summary = json.loads(stdout.getvalue())
+        self.assertEqual(2, summary['height'])
+        self.assertEqual(2, summary['mining']['blocks'])
+        self.assertIn('samples every', stderr.getvalue())
+
+        # The chain and key are picked up again on the next run
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            main(argv)
+        second = json.loads(stdout.getvalue())
+        self.assertEqual(summary['name'], second['name'])
+        self.assertEqual(4, second['height'])
+
+
+class SimulationTests(unittest.TestCase):
+    def simulate(self, seed):
+        simulation = Simulation(nodes=8, topology=TOPOLOGY_RING, seed=seed)
+        simulation.add_workload(transactions=5, blocks=2,
+                                transaction_interval=0.1, block_interval=5.0)
+        simulation.run()
+        self.ids = ([h for h, item in simulation.items.items()
+                     if item[0] == B_TYPE_TRANSACTION],
+                    [c.addresses for c in simulation.clients])
+        return simulation.report()
+
+    def test_propagation(self):
+        """Tests that every item reaches every node of a ring"""
+        report = self.simulate(seed=1)
+
+        self.assertEqual(5, report['transactions']['count'])
+        self.assertEqual(5, report['transactions']['fully_propagated'])
+        self.assertEqual(2, report['blocks']['count'])
+        # Each node receives every item from both neighbours
+        self.assertGreater(report['duplicates'], 0)
+        self.assertLessEqual(report['transactions']['latency']['p50'],
+                             report['transactions']['full_propagation']['p50'])
+
+    def test_deterministic(self):
+        """Tests that a seed gives the same timings every run"""
+        first = self.simulate(seed=2)
+        first_ids = self.ids
+        second = self.simulate(seed=2)
+        # So do transaction hashes and addresses
+        self.assertEqual(first_ids, self.ids)
+
+        self.assertEqual(first['time'], second['time'])
+        self.assertEqual(first['transactions'], second['transactions'])
+        self.assertEqual(first['deliveries'], second['deliveries'])
+
+
+class TCPBroadcastTests(unittest.TestCase):
+    def test_tcp_transactions(self):
+        """Tests a transaction and solution sent between clients over TCP"""
+        client1 = Client(name='client1')
+        client2 = Client(name='client2')
+        server1 = TCPBroadcastServer(client1).start()
+        server2 = TCPBroadcastServer(client2).start()
+        self.addCleanup(server1.close)
+        self.addCleanup(server2.close)
+
+        node_to_1 = TCPBroadcastNode(*server1.address)
+        node_to_2 = TCPBroadcastNode(*server2.address)
+        self.addCleanup(node_to_1.close)
+        self.addCleanup(node_to_2.close)
+        client1.register_broadcast_node(node_to_2)
+        client2.register_broadcast_node(node_to_1)
+
+        transactions = [Transaction(outputs={client2.addresses[0]: 1})
+                        for _ in range(20)]
+        for transaction in transactions:
+            client1.broadcast_transaction(transaction)
+        # Broadcasts are handed to the client from this thread
+        self.wait_for(lambda: server2.received == 20)
+        self.assertEqual(0, len(client2.mempool))
+        self.wait_for(lambda: len(client2.mempool) == 20, server2)
+
+        # Small broadcasts queued together go out in fewer writes
+        self.wait_for(lambda: node_to_2.sent == 20)
+        self.assertLessEqual(node_to_2.batches, node_to_2.sent)
+
+        client2.mine_current_block()
+        self.wait_for(lambda: client1.blockchain.height == 1, server1)
+        self.assertEqual(20 + SOLUTION_REWARD,
+                         client1.total_value(client2.addresses))
+
+    def test_tcp_reconnect(self):
+        """Tests that queued broadcasts are sent once the server is up"""
+        client = Client()
+        server = TCPBroadcastServer(client)
+        host, port = server.address
+        server._listener.close()
+
+        node = TCPBroadcastNode(host, port, min_backoff=0.01)
+        self.addCleanup(node.close)
+        Client().register_broadcast_node(node)
+        node.broadcast(json.dumps({'type': 'transaction', 'package':
+                                   Transaction().to_dict()}))
+        time.sleep(0.05)
+
+        server = TCPBroadcastServer(client, host, port).start()
+        self.addCleanup(server.close)
+        self.wait_for(lambda: server.received == 1)
+        self.assertEqual(1, node.sent)
+
+    def test_tcp_handshake(self):
+        """Tests that a node picks its wire format from the server's reply"""
+        json_server = TCPBroadcastServer(
+            Client(wire_formats=[FORMAT_JSON])).start()
+        binary_server = TCPBroadcastServer(Client()).start()
+        self.addCleanup(json_server.close)
+        self.addCleanup(binary_server.close)
+
+        to_json = TCPBroadcastNode(*json_server.address)
+        to_binary = TCPBroadcastNode(*binary_server.address)
+        self.addCleanup(to_json.close)
+        self.addCleanup(to_binary.close)
+        sender = Client()
+        sender.register_broadcast_node(to_json)
+        sender.register_broadcast_node(to_binary)
+        # Nothing is known about the servers before connecting
+        self.assertEqual(FORMAT_JSON, to_binary.wire_format)
+
+        sender.broadcast_transaction(Transaction())
+        self.wait_for(lambda: json_server.received == 1)
+        self.wait_for(lambda: binary_server.received == 1)
+        self.assertEqual(FORMAT_JSON, to_json.wire_format)
+        self.assertEqual(FORMAT_BINARY, to_binary.wire_format)
+
+    def test_tcp_event_loop(self):
+        """Tests a server handing broadcasts to a client's receive_loop"""
+        client = Client(name='client')
+        transaction = Transaction(outputs={client.addresses[0]: 2})
+        transaction.sign(Client().key)
+        data = json.dumps({'type': 'transaction',
+                           'package': transaction.to_dict()})
+
+        async def receive():
+            server = TCPBroadcastServer(
+                client, loop=asyncio.get_running_loop()).start()
+            node = TCPBroadcastNode(*server.address)
+            task = asyncio.ensure_future(client.receive_loop())
+            try:
+                node.broadcast(data)
+                deadline = time.monotonic() + 5.0
+                while transaction.hash not in client.mempool and \
+                        time.monotonic() < deadline:
+                    await asyncio.sleep(0.01)
+            finally:
+                task.cancel()
+                node.close()
+                server.close()
+
+        asyncio.run(receive())
+        self.assertIn(transaction.hash, client.mempool)
+
+    def test_tcp_event_loop_backpressure(self):
+        """Tests that a full inbox pauses reads rather than dropping"""
+        client = Client(name='client', inbox_size=2)
+        sender = Client()
+        transactions = [Transaction(outputs={client.addresses[0]: i})
+                        for i in range(1, 7)]
+        for transaction in transactions:
+            transaction.sign(sender.key)
+
+        async def receive():
+            server = TCPBroadcastServer(
+                client, loop=asyncio.get_running_loop()).start()
+            node = TCPBroadcastNode(*server.address)
+            task = None
+            try:
+                for transaction in transactions:
+                    node.broadcast(json.dumps(
+                        {'type': 'transaction',
+                         'package': transaction.to_dict()}))
+                deadline = time.monotonic() + 5.0
+                while not server.stalled and time.monotonic() < deadline:
+                    await asyncio.sleep(0.01)
+                self.assertEqual(2, client.inbox.qsize())
+
+                # Reading resumes as the client catches up
+                task = asyncio.ensure_future(client.receive_loop())
+                while len(client.mempool) < len(transactions) and \
+                        time.monotonic() < deadline:
+                    await asyncio.sleep(0.01)
+            finally:
+                if task is not None:
+                    task.cancel()
+                node.close()
+                server.close()
+            return server
+
+        server = asyncio.run(receive())
+        self.assertGreater(server.stalled, 0)
+        self.assertEqual(len(transactions), server.received)
+        self.assertEqual(len(transactions), len(client.mempool))
+
+    def wait_for(self, condition, server=None, timeout=5.0):
+        """:param server: Server to process messages from while waiting"""
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail('Timed out')
+            if server is not None:
+                server.process(0.01)
+            else:
+                time.sleep(0.01)
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -1,16 +1,1009 @@
+import io
+import json
 import os
+import shutil
 import sys
+import tempfile
+import time
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 import unittest
+from unittest import mock
 
+from lambdacoin.bench import compare
+from lambdacoin.broadcast import Hello, pack_frame, read_frames
+from lambdacoin.cache import LRUCache
+from lambdacoin.chain import Blockchain
+import lambdacoin.core
+from lambdacoin.keys import KeyPool, KeyStore
 from lambdacoin.core import Block, Transaction, Client, LocalBroadcastNode
-from lambdacoin.constants import SOLUTION_REWARD
+from lambdacoin.exceptions import MiningError, ParseMessageError, SnapshotError
+from lambdacoin.mempool import Mempool, REJECT_NEW
+from lambdacoin.merkle import MerkleTree, verify_proof
+from lambdacoin.metrics import Registry
+from lambdacoin.mining import Miner
+from lambdacoin.profiling import profile_call
+from lambdacoin.snapshot import (
+    HistoryVerifier, SnapshotReader, export_snapshot, load_snapshot,
+    snapshot_digest)
+import lambdacoin.storage
+from lambdacoin.storage import BlockStore
+from lambdacoin.utils import generate_hash, meets_target
+from lambdacoin.utxo import UTXOSet
+from lambdacoin.verify import SignatureVerifier
+import lambdacoin.constants as constants
+import lambdacoin.wire as wire
+
+
+def _exit_worker(*args):
+    """Stands in for a mining process that crashes"""
+    os._exit(1)
 
 
 class UnitTests(unittest.TestCase):
 
     def test_value_for_address(self):
-        pass
+        """Tests balances as blocks are appended to the chain"""
+        genesis = Block()
+        self.assertEqual(0, genesis.value_for_address('alice'))
+
+        block1 = Block(transactions=[Transaction(outputs={'alice': 5})],
+                       gen_transaction=Transaction(outputs={'bob': 1}))
+        genesis.add_next(block1)
+        self.assertEqual(5, block1.value_for_address('alice'))
+        self.assertEqual(1, block1.value_for_address('bob'))
+
+        block2 = Block(transactions=[Transaction(outputs={'alice': 2.5})])
+        block1.add_next(block2)
+        self.assertEqual(7.5, block2.value_for_address('alice'))
+        self.assertEqual(8.5, block2.chain_utxos().total_value(
+            ['alice', 'bob', 'carol']))
+
+        # Past blocks still report the value as of that block
+        self.assertEqual(5, block1.value_for_address('alice'))
+        self.assertIsNone(block1.utxos)
+        self.assertEqual(0, genesis.value_for_address('alice'))
+
+    def test_utxos_for_address(self):
+        """Tests that spent outputs are removed from an address's UTXOs"""
+        genesis = Block()
+        funding = Transaction(outputs={'alice': 5, 'bob': 3})
+        block1 = Block(transactions=[funding])
+        genesis.add_next(block1)
+
+        self.assertEqual([(funding.hash, 0, 'alice', 5)],
+                         block1.utxos_for_address('alice'))
+
+        spend = Transaction(inputs=[{'hash': funding.hash, 'n': 0}],
+                            outputs={'bob': 4, 'alice': 1})
+        block2 = Block(transactions=[spend])
+        block1.add_next(block2)
+
+        self.assertEqual([(spend.hash, 1, 'alice', 1)],
+                         block2.utxos_for_address('alice'))
+        self.assertEqual(1, block2.value_for_address('alice'))
+        self.assertEqual(7, block2.value_for_address('bob'))
+        self.assertEqual(2, len(block2.utxos_for_address('bob')))
+
+    def test_blockchain_index(self):
+        """Tests hash and height lookups as blocks are appended"""
+        genesis = Block()
+        blockchain = Blockchain(genesis)
+        blocks = [Block() for _ in range(3)]
+        for block in blocks:
+            self.assertTrue(blockchain.append(block))
+
+        self.assertEqual(3, blockchain.height)
+        self.assertEqual(4, len(blockchain))
+        self.assertIs(blocks[-1], blockchain.tip)
+        self.assertIs(genesis, blockchain.genesis)
+        self.assertIn(blocks[1].hash, blockchain)
+        self.assertNotIn(Block().hash, blockchain)
+        self.assertEqual(2, blockchain.height_of(blocks[1].hash))
+        self.assertIs(blocks[0], blockchain.block_at(1))
+        self.assertIsNone(blockchain.block_at(4))
+        self.assertEqual(blocks[:2], list(blockchain.iter_range(1, 3)))
+
+        # Appending a block that's already in the chain does nothing
+        self.assertFalse(blockchain.append(blocks[0]))
+        self.assertEqual(3, blockchain.height)
+
+    def test_blockchain_from_tip(self):
+        """Tests indexing an existing linked chain from its tip"""
+        genesis = Block()
+        block = Block(transactions=[Transaction(outputs={'alice': 5})])
+        genesis.add_next(block)
+
+        blockchain = Blockchain(block)
+        self.assertIs(genesis, blockchain.genesis)
+        self.assertEqual(1, blockchain.height_of(block.hash))
+        self.assertEqual(5, blockchain.value_for_address('alice'))
+
+    def test_block_store_reopen(self):
+        """Tests that a stored chain is served again after reopening"""
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+
+        key = Client().key
+        transaction = Transaction(outputs={'alice': 5})
+        transaction.sign(key)
+        blocks = [Block(transactions=[transaction], target=2, solution='7',
+                        gen_transaction=Transaction(outputs={'bob': 1}))]
+        blocks += [Block() for _ in range(3)]
+
+        store = BlockStore(path, segment_size=200)
+        blockchain = Blockchain(Block(), store=store)
+        for block in blocks:
+            blockchain.append(block)
+        genesis_hash = blockchain.genesis.hash
+        # Stored blocks don't hold the chain below them in memory
+        self.assertIsNone(blockchain.tip.prev_block)
+        self.assertIsNone(blocks[1].next_block)
+        store.close()
+
+        blockchain = Blockchain(store=BlockStore(path))
+        self.addCleanup(blockchain.store.close)
+
+        self.assertEqual(4, blockchain.height)
+        self.assertEqual(blocks[-1].hash, blockchain.tip.hash)
+        self.assertEqual(genesis_hash, blockchain.genesis.hash)
+        self.assertIn(blocks[0].hash, blockchain)
+        self.assertNotIn(Block().hash, blockchain)
+        self.assertEqual(3, blockchain.height_of(blocks[2].hash))
+        self.assertGreater(len(os.listdir(path)), 3)
+
+        loaded = blockchain.get(blocks[0].hash)
+        self.assertEqual(blocks[0].to_dict(), loaded.to_dict())
+        self.assertEqual(2, loaded.target)
+        self.assertTrue(loaded.transactions[0].verify())
+        self.assertEqual(5, blockchain.value_for_address('alice'))
+        self.assertEqual(1, blockchain.value_for_address('bob'))
+
+        # Blocks appended after reopening keep the balances up to date
+        blockchain.append(
+            Block(transactions=[Transaction(outputs={'alice': 2})]))
+        self.assertEqual(7, blockchain.value_for_address('alice'))
+        self.assertEqual(5, blockchain.height_of(blockchain.tip.hash))
+
+    def test_block_store_index_grows(self):
+        """Tests lookups after the on-disk hash index has been rehashed"""
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+
+        with mock.patch.object(lambdacoin.storage, 'INDEX_INITIAL_SLOTS', 4):
+            store = BlockStore(path)
+        blocks = [Block(hash='block-{}'.format(i)) for i in range(20)]
+        for block in blocks:
+            store.append(block)
+        store.close()
+
+        store = BlockStore(path)
+        self.addCleanup(store.close)
+        self.assertEqual(20, len(store))
+        self.assertGreaterEqual(store.slots, 40)
+        for height, block in enumerate(blocks):
+            self.assertEqual(height, store.height_of(block.hash))
+            self.assertEqual(block.hash, store.get(block.hash).hash)
+
+    def test_block_store_truncate(self):
+        """Tests that truncated blocks leave the index and can be replaced"""
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+
+        # A small index, so the dropped entries share probe runs with the
+        # ones that stay
+        with mock.patch.object(lambdacoin.storage, 'INDEX_INITIAL_SLOTS', 8):
+            store = BlockStore(path)
+        blocks = [Block() for _ in range(12)]
+        for block in blocks:
+            store.append(block)
+
+        store.truncate(5)
+        self.assertEqual(5, len(store))
+        for height, block in enumerate(blocks):
+            expected = height if height < 5 else None
+            self.assertEqual(expected, store.height_of(block.hash))
+        self.assertIsNone(store.block_at(5))
+
+        replacement = Block()
+        self.assertEqual(5, store.append(replacement))
+        store.close()
+
+        store = BlockStore(path)
+        self.addCleanup(store.close)
+        self.assertEqual(6, len(store))
+        self.assertEqual(replacement.hash, store.block_at(5).hash)
+        self.assertEqual(4, store.height_of(blocks[4].hash))
+        self.assertNotIn(blocks[5].hash, store)
+
+        # Dropped blocks are found in the index without being loaded
+        with mock.patch.object(lambdacoin.storage, 'decode_block') as decode:
+            store.truncate(5)
+        decode.assert_not_called()
+        self.assertEqual(5, len(store))
+        self.assertNotIn(replacement.hash, store)
+
+        # An index entry gone missing is reported rather than skipped
+        store._delete(store._find(lambdacoin.storage.block_key(
+            blocks[3].hash)))
+        with self.assertRaises(ValueError):
+            store.truncate(2)
+
+    def test_utxo_undo(self):
+        """Tests that undoing a block restores the UTXO set before it"""
+        genesis = Block()
+        funding = Transaction(outputs={'alice': 5})
+        block1 = Block(transactions=[funding])
+        genesis.add_next(block1)
+        utxos = block1.chain_utxos()
+        before = dict(utxos.outputs)
+
+        # Spends an output from before the block and one created in it
+        spend = Transaction(inputs=[{'hash': funding.hash, 'n': 0}],
+                            outputs={'bob': 5})
+        respend = Transaction(inputs=[{'hash': spend.hash, 'n': 0}],
+                              outputs={'carol': 4, 'bob': 1})
+        block2 = Block(transactions=[spend, respend],
+                       gen_transaction=Transaction(outputs={'dave': 1}))
+        undo = block1.add_next(block2)
+        self.assertEqual(4, utxos.balance('carol'))
+        self.assertEqual(0, utxos.balance('alice'))
+
+        utxos.undo_block(undo)
+        self.assertEqual(before, utxos.outputs)
+        self.assertEqual({'alice': 5}, utxos.balances)
+
+    def test_blockchain_reorg(self):
+        """Tests that the branch with the most work becomes the main chain"""
+        blockchain = Blockchain(Block.genesis())
+        updates = []
+        blockchain.on_update = lambda old, new: updates.append((old, new))
+
+        main = []
+        for value in (1, 2):
+            main.append(Block(
+                prev_hash=blockchain.tip.hash,
+                transactions=[Transaction(outputs={'alice': value})]))
+            blockchain.append(main[-1])
+        self.assertEqual(3, blockchain.value_for_address('alice'))
+
+        # A branch from the Genesis block, with the same work as the main
+        # chain after two blocks
+        branch = [Block(prev_hash=constants.GENESIS_HASH,
+                        transactions=[Transaction(outputs={'bob': 4})])]
+        branch.append(Block(prev_hash=branch[0].hash))
+        for block in branch:
+            self.assertTrue(blockchain.append(block))
+        self.assertIs(main[-1], blockchain.tip)
+        self.assertEqual(blockchain.work_of(main[-1].hash),
+                         blockchain.work_of(branch[-1].hash))
+        self.assertEqual({main[-1].hash, branch[-1].hash}, blockchain.tips)
+        self.assertIn(branch[0].hash, blockchain)
+        self.assertIsNone(blockchain.height_of(branch[0].hash))
+
+        # The fourth block of the branch arrives before the third, and waits
+        # for it
+        branch.append(Block(prev_hash=branch[-1].hash))
+        branch.append(Block(prev_hash=branch[-1].hash))
+        self.assertFalse(blockchain.append(branch[3]))
+        self.assertIn(branch[3].hash, blockchain.orphans)
+        self.assertIs(main[-1], blockchain.tip)
+
+        updates.clear()
+        self.assertTrue(blockchain.append(branch[2]))
+        self.assertFalse(blockchain.orphans)
+        self.assertIs(branch[-1], blockchain.tip)
+        self.assertEqual(4, blockchain.height)
+        self.assertEqual(branch[1:3], list(blockchain.iter_range(2, 4)))
+        self.assertEqual([(main[::-1], branch)], updates)
+        self.assertEqual(0, blockchain.value_for_address('alice'))
+        self.assertEqual(4, blockchain.value_for_address('bob'))
+
+        # Work comes from the chain's target, not the one a block claims. A
+        # higher target counts no more, and a lower one isn't accepted.
+        heavy = Block(prev_hash=main[-1].hash, target=3)
+        self.assertTrue(blockchain.append(heavy))
+        self.assertIs(branch[-1], blockchain.tip)
+        self.assertEqual(
+            blockchain.work_of(heavy.hash) + blockchain.block_work,
+            blockchain.work_of(branch[-1].hash))
+
+        light = [Block(prev_hash=heavy.hash, target=0)]
+        light.append(Block(prev_hash=light[0].hash, target=0))
+        for block in light:
+            self.assertFalse(blockchain.append(block))
+            self.assertNotIn(block.hash, blockchain)
+        self.assertNotIn(light[1].hash, blockchain.orphans)
+        self.assertIs(branch[-1], blockchain.tip)
+        self.assertEqual(4, blockchain.value_for_address('bob'))
+
+    def test_snapshot(self):
+        """Tests exporting the UTXO set and loading it back"""
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+
+        blockchain = Blockchain(Block.genesis())
+        funding = Transaction(outputs={'alice': 5, 'bob': 2.5})
+        blockchain.append(Block(transactions=[funding]))
+        spend = Transaction(inputs=[{'hash': funding.hash, 'n': 0}],
+                            outputs={'carol': 5})
+        blockchain.append(Block(transactions=[spend],
+                                gen_transaction=Transaction(
+                                    outputs={'not-a-digest': 1})))
+
+        snapshot_path = os.path.join(path, 'utxos.snap')
+        info = export_snapshot(blockchain, snapshot_path)
+        self.assertEqual((blockchain.tip.hash, 2, 3), info[:3])
+
+        # The same set at the same block gives the same digest
+        self.assertEqual(info.digest, snapshot_digest(
+            UTXOSet.from_blocks(blockchain), blockchain.tip.hash, 2))
+
+        with SnapshotReader(snapshot_path) as reader:
+            self.assertEqual(blockchain.tip.hash, reader.block_hash)
+            self.assertEqual(sorted(blockchain.chain_utxos().outputs.values()),
+                             list(reader))
+            self.assertEqual(info.digest, reader.digest)
+
+        loaded_info, utxos = load_snapshot(snapshot_path, info.digest)
+        self.assertEqual(info, loaded_info)
+        self.assertEqual(blockchain.chain_utxos().balances, utxos.balances)
+        self.assertIsInstance(utxos.balance('bob'), float)
+        self.assertEqual(1, utxos.balance('not-a-digest'))
+
+        # Snapshots of earlier blocks are rebuilt from the chain
+        other_path = os.path.join(path, 'other.snap')
+        earlier = export_snapshot(blockchain, other_path,
+                                  blockchain.block_at(1).hash)
+        self.assertEqual(2, earlier.count)
+        self.assertEqual({'alice': 5, 'bob': 2.5},
+                         load_snapshot(other_path)[1].balances)
+
+        with self.assertRaises(SnapshotError):
+            load_snapshot(snapshot_path, earlier.digest)
+
+        with open(snapshot_path, 'r+b') as f:
+            f.seek(-25, os.SEEK_END)
+            f.write(b'\xff')
+        with self.assertRaises(SnapshotError):
+            load_snapshot(snapshot_path)
+
+        with open(snapshot_path, 'r+b') as f:
+            f.truncate(30)
+        with self.assertRaises(SnapshotError):
+            load_snapshot(snapshot_path)
+
+    def test_snapshot_history_verifier(self):
+        """Tests checking a snapshot against the blocks below it"""
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        snapshot_path = os.path.join(path, 'utxos.snap')
+
+        blockchain = Blockchain(Block.genesis())
+        for i in range(5):
+            blockchain.append(Block(
+                transactions=[Transaction(outputs={'alice': i})]))
+        info = export_snapshot(blockchain, snapshot_path)
+
+        verifier = HistoryVerifier(blockchain, info, batch_size=2)
+        self.assertEqual([None, None, True],
+                         [verifier.step() for _ in range(3)])
+
+        # A chain with different history doesn't match
+        other = Blockchain(Block.genesis())
+        for i in range(5):
+            other.append(Block(transactions=[Transaction()]))
+        self.assertFalse(HistoryVerifier(other, info).run())
+
+        # A shorter chain waits for the rest
+        short = Blockchain(Block.genesis())
+        self.assertIsNone(HistoryVerifier(short, info).run())
+
+    def test_meets_target(self):
+        """Tests the byte-wise target check against the hex form"""
+        for digest in (bytes(20), b'\x00\x0f' + bytes(18),
+                       b'\x00\x10' + bytes(18), b'\x01' + bytes(19),
+                       b'\xff' * 20):
+            hex_digest = digest.hex()
+            for target in range(0, 42):
+                self.assertEqual(hex_digest[:target] == '0' * target
+                                 and target <= 40,
+                                 meets_target(digest, target))
+
+    def test_verify_after_add_transaction(self):
+        """Tests that the cached puzzle hash resets when the puzzle changes"""
+        block = Block(target=2)
+        solution = Miner().mine(block.puzzle, block.target, 0, 100000)
+        self.assertTrue(block.verify(solution))
+
+        block.add_transaction(Transaction())
+        expected = next(str(x) for x in range(100000) if block.verify(str(x)))
+        self.assertEqual(expected, Miner().mine(block.puzzle, block.target,
+                                                0, 100000))
+
+    def test_block_from_dict_target(self):
+        """Tests that a block doc must meet the required target"""
+        doc = Block(target=2, prev_hash=generate_hash()).to_dict()
+        self.assertEqual(2, Block.from_dict(doc, []).target)
+        self.assertEqual(2, Block.from_dict(doc, [], required_target=2).target)
+        with self.assertRaises(ParseMessageError):
+            Block.from_dict(doc, [], required_target=3)
+
+        for target in (0, '5', 1.5, True):
+            with self.assertRaises(ParseMessageError):
+                Block.from_dict(dict(doc, target=target), [])
+        self.assertEqual(0, Block.from_dict(dict(doc, target=0), [],
+                                            required_target=None).target)
+        self.assertEqual(constants.BLOCK_TARGET,
+                         Block.from_dict(dict(doc, target=None), []).target)
+
+    def test_add_transaction_extends_puzzle(self):
+        """Tests that the incrementally built puzzle matches a rebuilt one"""
+        transactions = [Transaction() for _ in range(3)]
+        block = Block(target=2)
+        block.verify('0')
+        for transaction in transactions:
+            block.add_transaction(transaction)
+            block.add_transaction(transaction)
+        rebuilt = Block(target=2, transactions=list(transactions))
+
+        self.assertEqual(3, len(block.transactions))
+        self.assertEqual(rebuilt.puzzle, block.puzzle)
+        self.assertEqual(rebuilt.midstate().digest(),
+                         block.midstate().digest())
+        self.assertTrue(block.has_transaction(transactions[1]))
+        self.assertFalse(block.has_transaction(Transaction()))
+
+    def test_merkle_tree(self):
+        """Tests incremental roots and inclusion proofs for every size"""
+        hashes = [Transaction().hash for _ in range(17)]
+        tree = MerkleTree()
+        roots = {tree.root}
+        for size in range(1, len(hashes) + 1):
+            tree.append(hashes[size - 1])
+            self.assertEqual(MerkleTree(hashes[:size]).root, tree.root)
+            roots.add(tree.root)
+
+            for h in hashes[:size]:
+                proof = tree.proof(h)
+                self.assertLessEqual(len(proof), size.bit_length())
+                self.assertTrue(verify_proof(h, proof, tree.root))
+
+        # Every prefix has its own root
+        self.assertEqual(len(hashes) + 1, len(roots))
+
+        proof = tree.proof(hashes[3])
+        self.assertFalse(verify_proof(hashes[4], proof, tree.root))
+        proof[0][1] = hashes[0]
+        self.assertFalse(verify_proof(hashes[3], proof, tree.root))
+        self.assertIsNone(tree.proof(Transaction().hash))
+
+    def test_merkle_proof_against_header(self):
+        """Tests checking a payment with only a block header and a proof"""
+        transactions = [Transaction(outputs={'alice': i}) for i in range(5)]
+        block = Block(transactions=transactions, target=2)
+        block.solution = Miner().mine(block.puzzle, block.target, 0, 100000)
+
+        header = block.header()
+        self.assertTrue(Block.verify_header(header))
+        self.assertTrue(verify_proof(
+            transactions[2].hash, block.merkle_proof(transactions[2].hash),
+            header['merkle_root']))
+
+        self.assertFalse(verify_proof(
+            transactions[2].hash, block.merkle_proof(transactions[2].hash),
+            Block().puzzle))
+
+    def test_mempool_order_and_removal(self):
+        """Tests that the mempool keeps arrival order and drops in bulk"""
+        mempool = Mempool()
+        transactions = [Transaction() for _ in range(4)]
+        for transaction in transactions:
+            self.assertTrue(mempool.add(transaction, 10))
+        self.assertFalse(mempool.add(transactions[0], 10))
+
+        self.assertEqual(transactions, list(mempool))
+        self.assertIn(transactions[2].hash, mempool)
+        self.assertEqual(40, mempool.bytes)
+
+        removed = mempool.remove_many(
+            [transactions[1].hash, transactions[3].hash, 'unknown'])
+        self.assertEqual(2, removed)
+        self.assertEqual([transactions[0], transactions[2]], list(mempool))
+        self.assertEqual(20, mempool.bytes)
+
+    def test_mempool_evicts_oldest(self):
+        """Tests that a full mempool evicts its oldest transactions"""
+        mempool = Mempool(max_count=3, max_bytes=100)
+        transactions = [Transaction() for _ in range(4)]
+        for transaction in transactions:
+            mempool.add(transaction, 30)
+
+        self.assertEqual(transactions[1:], list(mempool))
+        self.assertEqual(1, mempool.evictions)
+
+        big = Transaction()
+        self.assertTrue(mempool.add(big, 70))
+        self.assertEqual([transactions[3], big], list(mempool))
+        self.assertEqual(100, mempool.bytes)
+
+        # Too big to ever fit
+        self.assertFalse(mempool.add(Transaction(), 101))
+        self.assertEqual(2, len(mempool))
+
+    def test_mempool_evicts_descendants(self):
+        """Tests that evicting a transaction evicts the ones spending it"""
+        mempool = Mempool(max_count=4)
+        parent = Transaction(outputs={'alice': 2, 'bob': 1})
+        child = Transaction(inputs=[{'hash': parent.hash, 'n': 0}],
+                            outputs={'carol': 2})
+        grandchild = Transaction(inputs=[{'hash': child.hash, 'n': 0}],
+                                 outputs={'dave': 2})
+        other = Transaction()
+        for transaction in (parent, other, child, grandchild):
+            self.assertTrue(mempool.add(transaction, 1))
+
+        newest = Transaction()
+        self.assertTrue(mempool.add(newest, 1))
+        self.assertEqual([other, newest], list(mempool))
+        self.assertEqual(3, mempool.evictions)
+        self.assertEqual({}, mempool.spends)
+
+        # A new transaction's parent is kept, and what's older goes instead
+        mempool = Mempool(max_count=2)
+        mempool.add(parent, 1)
+        mempool.add(other, 1)
+        self.assertTrue(mempool.add(child, 1))
+        self.assertEqual([parent, child], list(mempool))
+
+        # Nothing can go without taking the new transaction's ancestors
+        self.assertFalse(mempool.add(grandchild, 1))
+        self.assertEqual([parent, child], list(mempool))
+
+    def test_mempool_rejects_new(self):
+        """Tests that the reject policy keeps the existing transactions"""
+        mempool = Mempool(max_count=2, eviction=REJECT_NEW)
+        transactions = [Transaction() for _ in range(3)]
+        results = [mempool.add(t, 1) for t in transactions]
+
+        self.assertEqual([True, True, False], results)
+        self.assertEqual(transactions[:2], list(mempool))
+        self.assertEqual(0, mempool.evictions)
+
+    def test_verify_many(self):
+        """Tests batch verification, including duplicates and bad sigs"""
+        key = Client().key
+        good = Transaction(outputs={'alice': 1})
+        good.sign(key)
+        unsigned = Transaction(outputs={'alice': 1})
+        tampered = Transaction(outputs={'alice': 1})
+        tampered.sign(key)
+        tampered.hash = good.hash[::-1]
+        duplicate = Transaction.from_dict(good.to_dict())
+
+        verifier = SignatureVerifier(workers=2)
+        self.addCleanup(verifier.close)
+        results = verifier.verify_many([good, unsigned, tampered, duplicate])
+
+        self.assertEqual([True, False, False, True], results)
+        self.assertEqual(3, len(verifier.cache))
+
+    def test_verify_cached(self):
+        """Tests that a transaction seen again isn't verified again"""
+        transaction = Transaction(outputs={'alice': 1})
+        transaction.sign(Client().key)
+
+        verifier = SignatureVerifier()
+        self.assertTrue(verifier.verify(transaction))
+
+        with mock.patch.object(Transaction, 'verify') as verify:
+            self.assertTrue(verifier.verify(transaction))
+        verify.assert_not_called()
+
+    def test_lru_cache(self):
+        """Tests eviction order and hit/miss counts"""
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(1, cache.get('a'))
+        cache.put('c', 3)
+
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(3, cache.get('c'))
+        self.assertEqual({'size': 2, 'maxsize': 2, 'hits': 2, 'misses': 1,
+                          'hit_rate': 2 / 3}, cache.stats())
+
+    def test_public_key_cache(self):
+        """Tests that transactions from one sender share a parsed key"""
+        key = Client().key
+        docs = []
+        for _ in range(3):
+            transaction = Transaction(outputs={'alice': 1})
+            transaction.sign(key)
+            docs.append(transaction.to_dict())
+
+        cache = lambdacoin.core.public_key_cache
+        hits = cache.hits
+        parsed = [Transaction.from_dict(doc) for doc in docs]
+
+        self.assertIs(parsed[0].public_key, parsed[2].public_key)
+        self.assertGreaterEqual(cache.hits - hits, 2)
+        self.assertTrue(all(t.verify() for t in parsed))
+
+    def test_transaction_json_cache(self):
+        """Tests that signed transactions reuse their JSON"""
+        transaction = Transaction(outputs={'alice': 1})
+        unsigned_json = transaction.to_json()
+        transaction.sign(Client().key)
+
+        signed_json = transaction.to_json()
+        self.assertNotEqual(unsigned_json, signed_json)
+        self.assertIs(signed_json, transaction.to_json())
+        self.assertEqual(signed_json, json.dumps(Transaction.from_dict(
+            json.loads(signed_json)).to_dict()))
+
+    def test_compact_transaction(self):
+        """Tests that hashes kept as digest bytes read back as hex"""
+        key = Client().key
+        parent = generate_hash()
+        address = generate_hash()
+        transaction = Transaction(
+            inputs=[{'hash': parent, 'n': 1}],
+            outputs={address: 5, 'not-a-hex-address': 2})
+        transaction.sign(key)
+
+        self.assertFalse(hasattr(transaction, '__dict__'))
+        self.assertEqual(bytes.fromhex(transaction.hash), transaction.digest)
+        self.assertEqual([{'hash': parent, 'n': 1}], transaction.inputs)
+        self.assertEqual({address: 5, 'not-a-hex-address': 2},
+                         transaction.outputs)
+        self.assertEqual(5, transaction.value_for_address(address))
+        self.assertNotIn(address.upper(), transaction.outputs)
+
+        received = Transaction.from_dict(json.loads(transaction.to_json()))
+        self.assertEqual(transaction.to_dict(), received.to_dict())
+        self.assertTrue(received.verify())
+        # Every transaction from one sender shares its public key
+        self.assertIs(transaction.public_key, received.public_key)
+
+        with self.assertRaises(ParseMessageError):
+            Transaction.from_dict({'inputs': ['not-a-dict']})
+
+        block = Block(transactions=[transaction], prev_hash=parent)
+        self.assertEqual(parent, block.prev_hash)
+        self.assertTrue(block.has_transaction(received))
+        self.assertEqual(MerkleTree([transaction.hash]).root,
+                         block.merkle_tree.root)
+
+    def test_wire_binary_transaction(self):
+        """Tests that a transaction survives the binary format"""
+        client = Client()
+        transaction = Transaction(
+            inputs=[{'hash': Transaction().hash, 'n': 3}],
+            outputs={client.addresses[0]: 20.5, 'not-a-hex-address': 2})
+        transaction.sign(client.key)
+        doc = client.package_for_broadcast(
+            constants.B_TYPE_TRANSACTION, transaction.to_dict())
+
+        data = wire.encode(doc, constants.FORMAT_BINARY)
+        self.assertEqual(constants.FORMAT_BINARY, wire.format_of(data))
+        self.assertLess(len(data),
+                        len(wire.encode(doc, constants.FORMAT_JSON)))
+
+        decoded = wire.decode(data)
+        received = Transaction.from_dict(decoded['package'])
+        self.assertEqual(transaction.hash, received.hash)
+        self.assertEqual(transaction.inputs, received.inputs)
+        self.assertEqual(transaction.outputs, received.outputs)
+        self.assertIsInstance(received.outputs['not-a-hex-address'], int)
+        self.assertTrue(received.verify())
+
+        # Re-encoding as JSON gives back the original document
+        self.assertEqual(json.loads(wire.encode(doc, constants.FORMAT_JSON)),
+                         json.loads(wire.encode(decoded,
+                                                constants.FORMAT_JSON)))
+
+    def test_wire_binary_solution(self):
+        """Tests that a solved block survives the binary format"""
+        block = Block(transactions=[Transaction(), Transaction()],
+                      gen_transaction=Transaction(outputs={'bob': 1}),
+                      solution='42')
+        doc = {'type': constants.B_TYPE_SOLUTION, 'package': block.to_dict()}
+
+        decoded = wire.decode(wire.encode(doc, constants.FORMAT_BINARY))
+        self.assertEqual(json.loads(json.dumps(doc)), decoded)
+
+        doc['package']['target'] = None
+        decoded = wire.decode(wire.encode(doc, constants.FORMAT_BINARY))
+        self.assertIsNone(decoded['package']['target'])
+
+    def test_wire_binary_sync(self):
+        """Tests that chain sync messages survive the binary format"""
+        block = Block(transactions=[Transaction(outputs={'alice': 2})],
+                      gen_transaction=Transaction(outputs={'bob': 1}),
+                      solution='7', prev_hash=generate_hash())
+        docs = [
+            {'type': constants.B_TYPE_GET_BLOCKS, 'package': {
+                'from': 'node1', 'request': 3, 'start': 1, 'count': 500}},
+            {'type': constants.B_TYPE_HEADERS, 'package': {
+                'from': 'node2', 'request': 3, 'start': 1, 'height': 1,
+                'headers': [block.header()]}},
+            {'type': constants.B_TYPE_BLOCKS, 'package': {
+                'from': 'node2', 'request': 4, 'start': 1,
+                'blocks': [block.to_dict()],
+                'transactions': [t.to_dict() for t in block.transactions]}},
+            {'type': constants.B_TYPE_GET_TRANSACTIONS, 'package': {
+                'from': 'node1', 'request': 5,
+                'hashes': [block.transactions[0].hash]}},
+        ]
+
+        for doc in docs:
+            decoded = wire.decode(wire.encode(doc, constants.FORMAT_BINARY))
+            self.assertEqual(json.loads(json.dumps(doc)), decoded)
+
+        # A missing request number stays missing rather than becoming 0
+        for request in (None, 0):
+            doc = {'type': constants.B_TYPE_GET_HEADERS, 'package': {
+                'from': 'node1', 'request': request, 'start': 1,
+                'count': 500}}
+            decoded = wire.decode(wire.encode(doc, constants.FORMAT_BINARY))
+            self.assertEqual(request, decoded['package']['request'])
+
+    def test_wire_message_id(self):
+        """Tests that a message has the same ID in either wire format"""
+        sender = Client()
+        transaction = Transaction(outputs={sender.addresses[0]: 3})
+        transaction.sign(sender.key)
+        doc = sender.package_for_broadcast(
+            constants.B_TYPE_TRANSACTION, transaction.to_dict())
+        as_json = wire.encode(doc, constants.FORMAT_JSON)
+        as_binary = wire.encode(doc, constants.FORMAT_BINARY)
+
+        # Identified without re-encoding, so without touching the key
+        with mock.patch.object(wire, '_der_key') as der_key:
+            self.assertEqual(wire.message_id(as_binary),
+                             wire.message_id(as_json))
+            self.assertEqual(wire.message_id(as_binary),
+                             wire.message_id(as_json, wire.decode(as_json)))
+        der_key.assert_not_called()
+
+        block = Block(prev_hash='0' * 64, solution='7')
+        block.gen_transaction = transaction
+        block.transactions = [transaction]
+        block_doc = sender.package_for_broadcast(
+            constants.B_TYPE_SOLUTION, block.to_dict())
+        self.assertEqual(
+            wire.message_id(wire.encode(block_doc, constants.FORMAT_BINARY)),
+            wire.message_id(wire.encode(block_doc, constants.FORMAT_JSON)))
+        self.assertNotEqual(wire.message_id(as_binary),
+                            wire.message_id(wire.encode(
+                                sender.package_for_broadcast(
+                                    constants.B_TYPE_TRANSACTION,
+                                    Transaction().to_dict()),
+                                constants.FORMAT_JSON)))
+        # Messages that can't be decoded still get an ID
+        self.assertEqual(wire.message_id('not json'),
+                         wire.message_id('not json'))
+
+        client = Client()
+        client.receive_broadcast(as_json)
+        client.receive_broadcast(as_binary)
+        self.assertEqual(1, client.duplicates)
+        self.assertEqual(1, len(client.mempool))
+
+    def test_wire_binary_malformed(self):
+        """Tests that truncated binary messages are rejected"""
+        doc = {'type': constants.B_TYPE_SOLUTION,
+               'package': Block(solution='1').to_dict()}
+        data = wire.encode(doc, constants.FORMAT_BINARY)
+
+        with self.assertRaises(ParseMessageError):
+            wire.decode(data[:-1])
+
+        # Types without a binary layout are carried as JSON
+        doc = {'type': 'DUMMY', 'package': {'a': [1]}}
+        self.assertEqual(doc, wire.decode(
+            wire.encode(doc, constants.FORMAT_BINARY)))
+
+    def test_wire_binary_inventory(self):
+        """Tests that an inventory survives the binary format"""
+        doc = {'type': constants.B_TYPE_INVENTORY, 'package': {
+            'from': 'client1',
+            'items': [{'type': constants.B_TYPE_TRANSACTION,
+                       'hash': Transaction().hash},
+                      {'type': constants.B_TYPE_SOLUTION, 'hash': 'genesis'}],
+        }}
+        self.assertEqual(doc, wire.decode(
+            wire.encode(doc, constants.FORMAT_BINARY)))
+
+    def test_wire_negotiation(self):
+        """Tests that nodes fall back to JSON unless both sides agree"""
+        json_client = Client(wire_formats=[constants.FORMAT_JSON])
+        binary_client = Client()
+
+        to_json_client = LocalBroadcastNode(json_client)
+        binary_client.register_broadcast_node(to_json_client)
+        self.assertEqual(constants.FORMAT_JSON, to_json_client.wire_format)
+
+        to_binary_client = LocalBroadcastNode(binary_client)
+        json_client.register_broadcast_node(to_binary_client)
+        self.assertEqual(constants.FORMAT_JSON, to_binary_client.wire_format)
+
+        to_binary_client = LocalBroadcastNode(binary_client)
+        Client().register_broadcast_node(to_binary_client)
+        self.assertEqual(constants.FORMAT_BINARY, to_binary_client.wire_format)
+
+    def test_tcp_frames(self):
+        """Tests reading frames that arrive split across reads"""
+        data = pack_frame('{"type": "transaction"}') + pack_frame(b'LC\x01')
+        buffer = bytearray(data[:10])
+
+        self.assertEqual([], read_frames(buffer))
+        buffer += data[10:-1]
+        self.assertEqual(['{"type": "transaction"}'], read_frames(buffer))
+        buffer += data[-1:]
+        self.assertEqual([b'LC\x01'], read_frames(buffer))
+        self.assertEqual(bytearray(), buffer)
+
+        buffer += pack_frame(Hello((constants.FORMAT_BINARY,
+                                    constants.FORMAT_JSON))) + \
+            pack_frame(Hello(()))
+        self.assertEqual([Hello((constants.FORMAT_BINARY,
+                                 constants.FORMAT_JSON)), Hello(())],
+                         read_frames(buffer))
+
+    def test_miner_single_process(self):
+        """Tests that the miner finds the first nonce that verifies"""
+        block = Block(target=2)
+        block.add_transaction(Transaction())
+
+        expected = next(str(x) for x in range(100000) if block.verify(str(x)))
+
+        miner = Miner()
+        self.assertEqual(expected, miner.mine(block.puzzle, block.target,
+                                              0, 100000))
+        self.assertEqual(int(expected) + 1, miner.hashes)
+
+    def test_miner_parallel(self):
+        """Tests that a multi-process miner finds a valid solution"""
+        block = Block(target=3)
+        block.add_transaction(Transaction())
+
+        miner = Miner(processes=2, chunk_size=500)
+        solution = miner.mine(block.puzzle, block.target, 0, 1000000)
+
+        self.assertIsNotNone(solution)
+        self.assertTrue(block.verify(solution))
+        self.assertGreater(miner.hashes, 0)
+
+    def test_miner_no_solution(self):
+        """Tests that the miner returns None when the range is exhausted"""
+        miner = Miner(processes=2, chunk_size=10)
+        self.assertIsNone(miner.mine('puzzle', 40, 0, 100))
+        self.assertEqual(100, miner.hashes)
+
+    def test_miner_worker_dies(self):
+        """Tests that the miner raises rather than waits on a dead worker"""
+        with mock.patch('lambdacoin.mining._worker', _exit_worker):
+            with self.assertRaises(MiningError):
+                Miner(processes=2, chunk_size=10).mine('puzzle', 40, 0, 100)
+
+    def test_generate_hash(self):
+        """Tests that generated IDs are unique 40 digit lowercase hex"""
+        hashes = [generate_hash() for _ in range(10000)]
+        self.assertEqual(len(hashes), len(set(hashes)))
+        for h in hashes[:10]:
+            self.assertEqual(h, '{:040x}'.format(int(h, 16)))
+
+    def test_key_store(self):
+        """Tests that a client signs with a key loaded from a key store"""
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+
+        store = KeyStore(path)
+        key = store.get_or_create('alice')
+        self.assertEqual(['alice'], store.names())
+        self.assertEqual(key.publickey().n, store.load('alice').publickey().n)
+        with self.assertRaises(KeyError):
+            store.load('bob')
+
+        client = Client(key=KeyStore(path).load('alice'))
+        transaction = Transaction()
+        client.broadcast_transaction(transaction)
+        self.assertEqual(key.publickey().n, transaction.public_key.n)
+        self.assertTrue(transaction.verify())
+
+    def test_lazy_key(self):
+        """Tests that a client only asks for a key when it first signs"""
+        pool = KeyPool(size=2)
+        self.addCleanup(pool.close)
+        self.assertTrue(pool.wait(timeout=30))
+
+        keys = []
+
+        def key_factory():
+            keys.append(pool.get())
+            return keys[-1]
+
+        client = Client(key_factory=key_factory)
+        self.assertEqual([], keys)
+
+        client.broadcast_transaction(Transaction())
+        client.broadcast_transaction(Transaction())
+        self.assertEqual(1, len(keys))
+        self.assertIs(keys[0], client.key)
+        self.assertEqual(0, pool.misses)
+
+    def test_metrics_registry(self):
+        """Tests labelled metrics in snapshots and the Prometheus format"""
+        registry = Registry()
+        received = registry.counter('received_total', 'Received', ['type'])
+        received.labels(type='transaction').inc()
+        received.labels(type='transaction').inc(2)
+        self.assertIs(received, registry.counter('received_total', 'Received',
+                                                 ['type']))
+
+        size = registry.gauge('size', 'Size')
+        size.set_function(lambda: 7)
+
+        seconds = registry.histogram('seconds', 'Seconds', buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 2):
+            seconds.observe(value)
+
+        snapshot = registry.snapshot()
+        self.assertEqual({'transaction': 3},
+                         snapshot['lambdacoin_received_total'])
+        self.assertEqual(7, snapshot['lambdacoin_size'])
+        self.assertEqual(4, snapshot['lambdacoin_seconds']['count'])
+        self.assertEqual(0.1, snapshot['lambdacoin_seconds']['p50'])
+        # Above the last bucket
+        self.assertIsNone(snapshot['lambdacoin_seconds']['p99'])
+
+        text = registry.to_prometheus().splitlines()
+        self.assertIn('# TYPE lambdacoin_received_total counter', text)
+        self.assertIn('lambdacoin_received_total{type="transaction"} 3', text)
+        self.assertIn('lambdacoin_size 7', text)
+        self.assertIn('lambdacoin_seconds_bucket{le="0.1"} 2', text)
+        self.assertIn('lambdacoin_seconds_bucket{le="+Inf"} 4', text)
+        self.assertIn('lambdacoin_seconds_count 4', text)
+
+        with self.assertRaises(ValueError):
+            registry.gauge('received_total', 'Received')
+
+    def test_bench_compare(self):
+        """Tests that only slowdowns beyond the tolerance are regressions"""
+        baseline = {
+            'verify': {'value': 100, 'higher_is_better': True},
+            'sync': {'value': 2.0, 'higher_is_better': False},
+            'relay': {'value': 100, 'higher_is_better': True},
+        }
+        results = {
+            'verify': {'value': 70, 'higher_is_better': True},
+            'sync': {'value': 3.0, 'higher_is_better': False},
+            'relay': {'value': 90, 'higher_is_better': True},
+            'new': {'value': 1, 'higher_is_better': True},
+        }
+
+        regressions = compare(results, baseline, tolerance=0.2)
+        self.assertEqual(['sync', 'verify'], [r['name'] for r in regressions])
+        self.assertAlmostEqual(-0.3, regressions[1]['change'])
+
+    def test_profile_call(self):
+        """Tests that both profilers report the function doing the work"""
+        def busy():
+            deadline = time.monotonic() + 0.2
+            while time.monotonic() < deadline:
+                pass
+            return 'done'
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        for sample in (False, True):
+            stream = io.StringIO()
+            path = os.path.join(directory, 'profile')
+            self.assertEqual('done', profile_call(busy, sample=sample,
+                                                  output=path, stream=stream))
+            self.assertIn('(busy)', stream.getvalue())
+            self.assertTrue(os.path.getsize(path))
 
 
 if __name__ == '__main__':